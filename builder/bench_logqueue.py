@@ -0,0 +1,59 @@
+"""
+Benchmark for the publisher side of LogQueue.
+
+Measures how many lines per second send() accepts on the disk spool path
+(used while RabbitMQ is unreachable) and on the in-memory queue path, so the
+spool can be checked against the output rate of a build. No broker is needed.
+
+    python bench_logqueue.py --lines 200000
+"""
+import argparse
+import os
+import tempfile
+import time
+from logQueue import LogQueue
+
+# A docker build rarely prints more than a few thousand lines per second
+REFERENCE_LINES_PER_SECOND = 5000
+
+
+def run(log_queue, lines):
+    line = "#12 [stage-1 4/9] RUN pip install --no-cache-dir -r requirements.txt  Downloading flask-3.0.2-py3-none-any.whl (101 kB)\n"
+    start = time.time()
+    for i in range(lines):
+        log_queue.send({"action_uid": "bench-action", "service": "builder", "time": time.time(), "log": line})
+    log_queue.flush()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LogQueue.send throughput")
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--batch-lines", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        spill_path = os.path.join(directory, "spill.jsonl")
+
+        # Never connected: every batch goes to the spool file
+        spool_queue = LogQueue(batch_lines=args.batch_lines, spill_path=spill_path)
+        spool_elapsed = run(spool_queue, args.lines)
+        spool_size = os.path.getsize(spill_path)
+        spool_queue.close(timeout=0)
+
+        # Marked connected without a publisher thread: batches stay in the memory queue
+        memory_queue = LogQueue(batch_lines=args.batch_lines, max_queued_lines=args.lines * 2,
+                                spill_path=os.path.join(directory, "unused.jsonl"))
+        memory_queue.connected = True
+        memory_elapsed = run(memory_queue, args.lines)
+        memory_queue.close(timeout=0)
+
+    print(f"{'path':<10}{'lines/sec':>14}{'x build rate':>14}")
+    for name, elapsed in (("spool", spool_elapsed), ("memory", memory_elapsed)):
+        rate = args.lines / elapsed
+        print(f"{name:<10}{rate:>14.0f}{rate / REFERENCE_LINES_PER_SECOND:>14.1f}")
+    print(f"spool file: {spool_size / args.lines:.0f} bytes/line")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+BUILDER_MODES = ("docker", "buildx")
+
+# "#7 [builder 3/6] RUN pip install ..." starts a Dockerfile step in --progress=plain output
+_STEP_HEADER = re.compile(r"^#(\d+) \[[^\]]*\d+/\d+\] ")
+_STEP_RESULT = re.compile(r"^#(\d+) (CACHED|DONE|ERROR)\b")
+
+
+class BuildStepStats:
+    """
+    Counts cached and executed Dockerfile steps from plain BuildKit progress output.
+    Internal steps (loading the context, exporting the image, ...) are not counted.
+    """
+    def __init__(self):
+        self.steps = set()
+        self.cached = set()
+        self.executed = set()
+
+    def feed(self, line):
+        header = _STEP_HEADER.match(line)
+        if header:
+            self.steps.add(header.group(1))
+            return
+        result = _STEP_RESULT.match(line)
+        if result and result.group(1) in self.steps:
+            if result.group(2) == "CACHED":
+                self.cached.add(result.group(1))
+            else:
+                self.executed.add(result.group(1))
+
+    @property
+    def hits(self):
+        return len(self.cached)
+
+    @property
+    def misses(self):
+        return len(self.executed - self.cached)
+
+
+class BuildKitCache:
+    """
+    Persistent BuildKit layer cache, one local cache directory per repository.
+
+    Builds import the repository's cache and export a fresh one with mode=max
+    next to it, which then replaces the old one: the local exporter never
+    removes blobs on its own, so rotating keeps each cache to the layers of the
+    last build. The repository's cache is a symlink to a versioned directory,
+    swapped with an atomic rename; each build pins the version it imports, and
+    a replaced version is deleted once no build reads it any more. Whole
+    repository caches are evicted least recently used first once the total
+    grows past max_bytes.
+
+    The default "docker" buildx driver cannot export a local cache unless the
+    daemon uses the containerd image store, so builds run on a builder of their
+    own with the docker-container driver, created by ensure_builder().
+    """
+    def __init__(self, cache_dir, max_bytes=20 * 1024 ** 3, prune_interval=3600, builder="continuum"):
+        self.cache_dir = cache_dir
+        self.builder = builder
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval  # seconds
+        self.lock = threading.Lock()
+        self.in_use = {}  # repository cache directory -> running builds
+        self.running = {}  # build id -> whether another build ran on the builder at the same time
+        self.pinned = {}  # build id -> cache version it imports
+        self.readers = {}  # cache version -> builds importing it
+        self.retired = set()  # replaced cache versions still imported by builds
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def builder_container(self):
+        # Name buildx gives the BuildKit container of a docker-container builder's first node
+        return f"buildx_buildkit_{self.builder}0"
+
+    def ensure_builder(self):
+        """
+        Creates and starts the docker-container builder unless it already exists.
+        :return: Whether the builder is ready.
+        """
+        inspect = subprocess.run(["docker", "buildx", "inspect", "--bootstrap", self.builder],
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if inspect.returncode == 0:
+            return True
+        create = subprocess.run(["docker", "buildx", "create", "--name", self.builder, "--driver", "docker-container", "--bootstrap"],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if create.returncode != 0:
+            print(f"Failed to create the BuildKit builder {self.builder}: {create.stdout.strip()}", flush=True)
+            return False
+        return True
+
+    def repo_dir(self, repo_name):
+        return os.path.join(self.cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", repo_name.lower()))
+
+    @staticmethod
+    def _current(cache):
+        # The version a repository's cache link points at; caches written before versioning are plain directories
+        if os.path.islink(cache):
+            return os.path.realpath(cache)
+        return cache if os.path.isdir(cache) else None
+
+    def _retire(self, version):
+        if version is None:
+            return
+        if self.readers.get(version):
+            self.retired.add(version)
+        else:
+            shutil.rmtree(version, ignore_errors=True)
+
+    def build_command(self, image_tag, context_path, repo_name, build_id):
+        """
+        Returns the docker buildx command building context_path with the cache version pinned by acquire().
+        The new cache is exported to a directory of its own per build_id.
+        """
+        cache = self.repo_dir(repo_name)
+        command = ["docker", "buildx", "build", "--builder", self.builder, "--progress=plain", "--load", "-t", image_tag]
+        version = self.pinned.get(build_id)
+        if version is not None:
+            command += ["--cache-from", f"type=local,src={version}"]
+        command += ["--cache-to", f"type=local,dest={cache}@{build_id}.new,mode=max", context_path]
+        return command
+
+    def acquire(self, repo_name, build_id):
+        """
+        Starts a build, pinning the repository's current cache version until release().
+        """
+        with self.lock:
+            cache = self.repo_dir(repo_name)
+            self.in_use[cache] = self.in_use.get(cache, 0) + 1
+            version = self._current(cache)
+            if version is not None:
+                self.readers[version] = self.readers.get(version, 0) + 1
+            self.pinned[build_id] = version
+            for other in self.running:
+                self.running[other] = True
+            self.running[build_id] = bool(self.running)
+
+    def shared(self, build_id):
+        """
+        Returns whether another build used the builder while this one ran, so its counters are not the build's alone.
+        """
+        with self.lock:
+            return self.running.get(build_id, False)
+
+    def release(self, repo_name, build_id, succeeded):
+        """
+        Ends a build, making the cache it exported the repository's current version if it succeeded.
+        Safe to call for a build whose acquire() did not complete.
+        """
+        cache = self.repo_dir(repo_name)
+        exported = f"{cache}@{build_id}.new"
+        with self.lock:
+            self.running.pop(build_id, None)
+            if cache in self.in_use:
+                self.in_use[cache] -= 1
+                if not self.in_use[cache]:
+                    del self.in_use[cache]
+            version = self.pinned.pop(build_id, None)
+            if version is not None:
+                self.readers[version] -= 1
+                if not self.readers[version]:
+                    del self.readers[version]
+                    if version in self.retired:
+                        self.retired.discard(version)
+                        shutil.rmtree(version, ignore_errors=True)
+
+            legacy = os.path.isdir(cache) and not os.path.islink(cache)
+            if not succeeded or not os.path.isdir(exported) or (legacy and self.readers.get(cache)):
+                # An unversioned cache still being imported cannot be replaced by a link yet
+                shutil.rmtree(exported, ignore_errors=True)
+                return
+            current = f"{cache}@{build_id}"
+            os.replace(exported, current)
+            previous = self._current(cache)
+            link = f"{cache}@link"
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(os.path.basename(current), link)
+            if legacy:
+                shutil.rmtree(cache, ignore_errors=True)
+                previous = None
+            os.replace(link, cache)
+            self._retire(previous)
+
+    @staticmethod
+    def _size(path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def prune(self):
+        """
+        Evicts the least recently used repository caches until the total fits in max_bytes,
+        then asks BuildKit to shrink its own cache to the same bound.
+        """
+        with self.lock:
+            paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+            caches = [path for path in paths if "@" not in os.path.basename(path) and not path.endswith(".new")]
+            current = {cache: self._current(cache) for cache in caches}
+            # Versions left behind by an interrupted swap; exports of running builds end with .new
+            for path in paths:
+                if ("@" in os.path.basename(path) and not path.endswith(".new") and not os.path.islink(path)
+                        and path not in current.values() and path not in self.readers):
+                    shutil.rmtree(path, ignore_errors=True)
+            sizes = {cache: self._size(version) if version else 0 for cache, version in current.items()}
+            total = sum(sizes.values())
+            for cache in sorted(caches, key=lambda path: os.lstat(path).st_mtime):
+                if total <= self.max_bytes:
+                    break
+                if cache in self.in_use:
+                    continue
+                if os.path.islink(cache):
+                    os.remove(cache)
+                    self._retire(current[cache])
+                else:
+                    self._retire(cache)
+                total -= sizes[cache]
+                print(f"Evicted build cache {cache} ({sizes[cache]} bytes)", flush=True)
+        subprocess.run(["docker", "buildx", "prune", "--builder", self.builder, "--force", "--keep-storage", str(self.max_bytes)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def start(self):
+        def loop():
+            while True:
+                try:
+                    self.prune()
+                except Exception as e:
+                    print(f"Build cache pruning failed: {e}", flush=True)
+                time.sleep(self.prune_interval)
+        threading.Thread(target=loop, daemon=True).start()
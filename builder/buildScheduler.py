@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class QueueFull(Exception):
+    pass
+
+
+class BuildJob:
+    def __init__(self, fn, args, priority, key):
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.key = key
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.position = None
+        self.done = threading.Event()
+        self.report_lock = threading.Lock()  # status reports of this job are made one at a time
+
+    @property
+    def wait_time(self):
+        return (self.started_at or time.time()) - self.enqueued_at
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the job has run and returns its result, re-raising its exception if it failed.
+        """
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"Build {self.key} still pending after {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class BuildScheduler:
+    """
+    Runs builds on a fixed number of slots, queueing the rest.
+
+    Queued jobs run by priority (lower first), then in arrival order. Submitting
+    past max_queued waiting jobs raises QueueFull so callers can shed load
+    instead of piling up builds that all finish slowly. on_position(job, position)
+    is called whenever a queued job's 1-based position changes, on_start(job)
+    when it gets a slot; both run outside the scheduler lock. Reports of one job
+    are serialized and a position is only reported if it is still current, so
+    a late "queued" report can never follow the job's start report.
+    """
+    def __init__(self, slots=2, max_queued=20, on_position=None, on_start=None):
+        self.slots = slots
+        self.max_queued = max_queued
+        self.on_position = on_position
+        self.on_start = on_start
+        self.queue = []  # heap of (priority, sequence, job)
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.running = 0
+        self.stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+        for index in range(slots):
+            threading.Thread(target=self._work, name=f"build-slot-{index}", daemon=True).start()
+
+    def submit(self, fn, *args, priority=0, key=None):
+        """
+        Queues fn(*args) for the next free slot.
+        :return: The BuildJob, whose wait() returns fn's result.
+        """
+        job = BuildJob(fn, args, priority, key)
+        with self.cond:
+            if len(self.queue) >= self.max_queued:
+                self.stats["rejected"] += 1
+                raise QueueFull(f"{len(self.queue)} builds already queued")
+            heapq.heappush(self.queue, (priority, next(self.sequence), job))
+            self.stats["submitted"] += 1
+            moved = self._reposition()
+            self.cond.notify()
+        self._report(moved)
+        return job
+
+    def _reposition(self):
+        # Must hold the lock; returns the jobs whose position changed
+        moved = []
+        for position, (_, _, job) in enumerate(sorted(self.queue), start=1):
+            if job.position != position:
+                job.position = position
+                moved.append((job, position))
+        return moved
+
+    def _report(self, moved):
+        if self.on_position is None:
+            return
+        for job, position in moved:
+            with job.report_lock:
+                with self.cond:
+                    # The job may have moved again or taken a slot since the position was computed
+                    current = job.position == position and job.started_at is None
+                if not current:
+                    continue
+                try:
+                    self.on_position(job, position)
+                except Exception as e:
+                    print(f"Queue position report failed: {e}", flush=True)
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                _, _, job = heapq.heappop(self.queue)
+                job.position = None
+                job.started_at = time.time()
+                self.running += 1
+                self.stats["wait_time_total"] += job.wait_time
+                self.stats["wait_time_max"] = max(self.stats["wait_time_max"], job.wait_time)
+                moved = self._reposition()
+            self._report(moved)
+            if self.on_start is not None:
+                with job.report_lock:
+                    try:
+                        self.on_start(job)
+                    except Exception as e:
+                        print(f"Build start report failed: {e}", flush=True)
+            try:
+                job.result = job.fn(*job.args)
+            except Exception as e:
+                job.error = e
+            job.finished_at = time.time()
+            with self.cond:
+                self.running -= 1
+                self.stats["completed" if job.error is None else "failed"] += 1
+            job.done.set()
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats["slots"] = self.slots
+            stats["running"] = self.running
+            stats["queued"] = len(self.queue)
+            stats["max_queued"] = self.max_queued
+            started = stats["submitted"] - stats["queued"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / started if started else 0.0
+        return stats
@@ -1,8 +1,15 @@
 from datetime import timedelta
+from contextlib import nullcontext
+import hashlib
 import io
 import subprocess
 import time
 from logQueue import LogQueue  # Assuming this is a custom module for handling log queue operations.
+from gitCache import MirrorCache, MirrorError
+from buildCache import BUILDER_MODES, BuildKitCache, BuildStepStats
+from buildScheduler import BuildScheduler, QueueFull
+from jobs import JobRegistry
+from resourceUsage import StageUsage
 from flask import Flask, redirect, url_for, session, request, jsonify, render_template
 import os
 from jwt.exceptions import InvalidTokenError
@@ -14,7 +21,34 @@ app = Flask(__name__)
 log_queue_host = os.getenv("LOG_QUEUE_HOST", "rabbitmq")
 log_queue_port = os.getenv("LOG_QUEUE_PORT", "5672")
 log_queue_name = os.getenv("LOG_QUEUE_NAME", "log-queue")
-log_queue = LogQueue(log_queue_host, log_queue_port, log_queue_name)
+log_queue = LogQueue(
+    log_queue_host, log_queue_port, log_queue_name,
+    batch_lines=int(os.getenv("LOG_BATCH_LINES", "200")),
+    batch_interval=int(os.getenv("LOG_BATCH_INTERVAL_MS", "500")) / 1000,
+    max_queued_lines=int(os.getenv("LOG_QUEUE_MAX_LINES", "50000")),
+    overflow=os.getenv("LOG_QUEUE_OVERFLOW", "block"),
+    spill_path=os.getenv("LOG_QUEUE_SPILL_PATH", "/tmp/log-queue-spill.jsonl"),
+    wire_format=os.getenv("LOG_WIRE_FORMAT", "frame"),
+    collapse_progress=os.getenv("LOG_COLLAPSE_PROGRESS", "true").lower() == "true"
+)
+
+# Bare mirrors of built repositories; each build fetches into its mirror and checks out a worktree.
+mirror_cache = MirrorCache(
+    os.getenv("GIT_MIRROR_DIR", "/var/cache/continuum/git-mirrors"),
+    max_bytes=int(os.getenv("GIT_MIRROR_MAX_MB", "10240")) * 1024 * 1024
+)
+
+# "buildx" builds with BuildKit and a persistent per-repository layer cache; "docker" runs a plain docker build,
+# whose resource usage cannot be measured.
+builder_mode = os.getenv("BUILDER_MODE", "buildx")
+if builder_mode not in BUILDER_MODES:
+    raise ValueError(f"BUILDER_MODE must be one of {', '.join(BUILDER_MODES)}")
+build_cache = BuildKitCache(
+    os.getenv("BUILDKIT_CACHE_DIR", "/var/cache/continuum/buildkit"),
+    max_bytes=int(os.getenv("BUILDKIT_CACHE_MAX_MB", "20480")) * 1024 * 1024,
+    prune_interval=int(os.getenv("BUILDKIT_PRUNE_INTERVAL", "3600")),
+    builder=os.getenv("BUILDKIT_BUILDER", "continuum")
+) if builder_mode == "buildx" else None
 
 def clone_repo(github_token, repo_url, clone_path):
     """
@@ -35,6 +69,57 @@ def clone_repo(github_token, repo_url, clone_path):
     except subprocess.CalledProcessError as e:
         print(f"Error cloning repository: {e}")
 
+def checkout_repo(github_token, repo_url, clone_path):
+    """
+    Checks out a GitHub repository from its local mirror, fetching only new objects.
+    Falls back to a plain clone if the mirror cannot be used.
+
+    Args:
+    - github_token (str): GitHub OAuth token.
+    - repo_url (str): The HTTPS URL of the GitHub repository.
+    - clone_path (str): Local path to check the repository out into.
+
+    Returns:
+    - commit (str): The checked out commit hash, or None if the checkout failed.
+    """
+    # The token is only passed to the fetch, it is never stored in the mirror's config.
+    auth_url = repo_url.replace("https://", f"https://{github_token}@")
+    try:
+        commit = mirror_cache.checkout(repo_url, clone_path, fetch_url=auth_url)
+        print(f"Checked out {commit} from the mirror into {clone_path}")
+        return commit
+    except MirrorError as e:
+        print(f"Mirror checkout failed, cloning instead: {e}")
+        clone_repo(github_token, repo_url, clone_path)
+    result = subprocess.run(["git", "-C", clone_path, "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def content_image_tag(repo_name, commit, clone_path):
+    """
+    Builds an image tag addressed by content: the commit and the Dockerfile it is built from.
+
+    Args:
+    - repo_name (str): The repository name.
+    - commit (str): The checked out commit hash.
+    - clone_path (str): Path of the checked out repository.
+
+    Returns:
+    - image_tag (str): Tag of the form "<repo>_image:<commit>-<dockerfile hash>".
+    """
+    try:
+        with open(os.path.join(clone_path, "Dockerfile"), "rb") as dockerfile:
+            dockerfile_hash = hashlib.sha256(dockerfile.read()).hexdigest()
+    except OSError:
+        dockerfile_hash = hashlib.sha256(b"").hexdigest()
+    return f"{repo_name}_image:{commit[:12]}-{dockerfile_hash[:12]}".lower()
+
+def image_exists(image_tag):
+    """
+    Checks whether the Docker daemon already has an image with the given tag.
+    """
+    result = subprocess.run(["docker", "image", "inspect", image_tag], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
 def format_time(total_seconds):
     """
     Formats a time duration given in seconds to a more readable format.
@@ -64,62 +149,205 @@ def format_time(total_seconds):
     
     return formatted_time
 
-@app.route("/api/v1/trigger-build", methods=["POST"])
-def trigger_scan():
+def report_updates(updates):
     """
-    Endpoint to trigger a build process, including repository cloning and Docker image creation.
+    Sends action field updates to the database proxy service in one batch.
+
+    Args:
+    - updates (list): Dicts with action_uid, field and value.
+    """
+    try:
+        requests.post('http://dbproxy:5000/api/v1/update-actions', json={"updates": updates})
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to report to dbproxy: {e}")
+
+def report_queue_position(job, position):
+    report_updates([{"action_uid": job.key, "field": "builder_status", "value": f"Queued ({position})"}])
+
+def report_build_start(job):
+    report_updates([
+        {"action_uid": job.key, "field": "builder_status", "value": "Running"},
+        {"action_uid": job.key, "field": "builder_queue_wait", "value": round(job.wait_time, 3)},
+    ])
+
+# At most BUILD_SLOTS builds run at once; up to BUILD_QUEUE_MAX more wait for a slot, beyond that requests get a 429.
+build_scheduler = BuildScheduler(
+    slots=int(os.getenv("BUILD_SLOTS", "2")),
+    max_queued=int(os.getenv("BUILD_QUEUE_MAX", "20")),
+    on_position=report_queue_position,
+    on_start=report_build_start
+)
+jobs = JobRegistry("builder", executor=build_scheduler)
+
+def run_build(data):
+    """
+    Checks out the repository, builds its Docker image and reports the outcome to dbproxy.
+
+    Args:
+    - data (dict): The trigger-build request payload.
+
+    Returns:
+    - result (dict): Build status, image tag, commit and cache statistics.
     """
-    dbproxy_url = 'http://dbproxy:5000/api/v1/update-action'
     total_time_str = "N/A"
-    status = request.json.get("status")
-    action_uid = request.json.get("action_uid")
-    repo_url = request.json.get("git_repo_url")
-    repo_name = request.json.get("repo_name")
-    image_tag = f"{repo_name}_image:latest".lower()
+    status = data.get("status")
+    action_uid = data.get("action_uid")
+    repo_url = data.get("git_repo_url")
+    repo_name = data.get("repo_name")
+    latest_tag = f"{repo_name}_image:latest".lower()
+    image_tag = latest_tag
+    commit = None
+    cache_hit = False
+    step_stats = BuildStepStats()
     
     if status == "OK":
         start_time = time.time()
+        usage = StageUsage(action_uid, "build")
         
         clone_path = f"/tmp/{action_uid}"
-        clone_repo(request.json.get("oauth_token")['access_token'], repo_url, clone_path)
+        commit = checkout_repo(data.get("oauth_token")['access_token'], repo_url, clone_path)
+        if commit:
+            image_tag = content_image_tag(repo_name, commit, clone_path)
+            cache_hit = image_exists(image_tag)
         
-        # Attempt to build Docker image from the cloned repository.
+        # Attempt to build Docker image from the cloned repository, unless this commit and Dockerfile were already built.
         try:
-            process = subprocess.Popen(["docker", "build", "-t", image_tag, clone_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            for line in io.TextIOWrapper(process.stdout, encoding="utf-8"):
-                log_queue.send({"action_uid": action_uid, "service": "builder", "time": time.time(), "log": line})
-            process.wait()
-            status = "OK" if process.returncode == 0 else "ERROR"
+            if cache_hit:
+                log_queue.send({"action_uid": action_uid, "service": "builder", "time": time.time(),
+                                "log": f"Image {image_tag} already built for commit {commit}, skipping build (cache hit)\n"})
+                status = "OK"
+            else:
+                try:
+                    if build_cache is not None:
+                        build_cache.acquire(repo_name, action_uid)
+                        command = build_cache.build_command(image_tag, clone_path, repo_name, action_uid)
+                    else:
+                        command = ["docker", "build", "-t", image_tag, clone_path]
+                    # Build steps run in the BuildKit builder container, whose counters are the build's usage
+                    # unless other builds ran on it meanwhile; plain docker builds run their steps inside
+                    # the daemon, where they cannot be observed, so they report none
+                    watch = usage.watch(build_cache.builder_container, shared=True) if build_cache is not None else nullcontext()
+                    with watch:
+                        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                        for line in io.TextIOWrapper(process.stdout, encoding="utf-8"):
+                            step_stats.feed(line)
+                            log_queue.send({"action_uid": action_uid, "service": "builder", "time": time.time(), "log": line})
+                        status = "OK" if process.wait() == 0 else "ERROR"
+                    if build_cache is not None and build_cache.shared(action_uid):
+                        usage.approximate = True
+                finally:
+                    if build_cache is not None:
+                        build_cache.release(repo_name, action_uid, status == "OK")
+                if step_stats.steps:
+                    log_queue.send({"action_uid": action_uid, "service": "builder", "time": time.time(),
+                                    "log": f"Build cache: {step_stats.hits} steps cached, {step_stats.misses} executed\n"})
+            log_queue.flush(action_uid, "builder")
+            # Keep :latest pointing at the most recent build for single-stage actions
+            if status == "OK" and image_tag != latest_tag:
+                subprocess.run(["docker", "tag", image_tag, latest_tag], check=True)
         except subprocess.CalledProcessError as e:
             print(f"Build failed: {e}")
             status = "ERROR"
         
-        # Clean up the cloned repository to free up space.
+        # Remove the worktree (or fallback clone) to free up space; the mirror is kept.
         try:
-            subprocess.run(["rm", "-rf", clone_path], check=True)
-        except subprocess.CalledProcessError as e:
+            mirror_cache.release(clone_path)
+        except MirrorError as e:
             print(f"Error cleaning up: {e}")
 
         end_time = time.time()
         total_time = end_time - start_time
         total_time_str = format_time(total_time)
+        usage.report()
     else:
         status = "N/A"
     
     # Report the build status and time taken to a database proxy service.
-    try:
-        requests.post(dbproxy_url, json={"action_uid": action_uid, "status_name": "builder_status", "status": status, "eta_name": "builder_eta", "eta": total_time_str})
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to report to dbproxy: {e}")
+    updates = [
+        {"action_uid": action_uid, "field": "builder_status", "value": status},
+        {"action_uid": action_uid, "field": "builder_eta", "value": total_time_str},
+    ]
+    if commit:
+        updates.append({"action_uid": action_uid, "field": "git_commit_hash", "value": commit})
+    if step_stats.steps:
+        updates.append({"action_uid": action_uid, "field": "builder_cache_hits", "value": step_stats.hits})
+        updates.append({"action_uid": action_uid, "field": "builder_cache_misses", "value": step_stats.misses})
+    report_updates(updates)
 
-    return jsonify({
+    return {
         "status": status,
-        "image_tag": image_tag
-    })
+        "image_tag": image_tag,
+        "commit": commit,
+        "cache_hit": cache_hit,
+        "cached_steps": step_stats.hits,
+        "executed_steps": step_stats.misses
+    }
+
+@app.route("/api/v1/trigger-build", methods=["POST"])
+def trigger_scan():
+    """
+    Endpoint to trigger a build process, including repository cloning and Docker image creation.
+    The build runs as a background job waiting for a free build slot; an optional "priority"
+    (lower runs first) orders the queue. Responds 202 with the job id; the finished job is
+    POSTed to "callback_url" if given and can be polled at /api/v1/jobs/<job_id>.
+    """
+    data = request.json
+    action_uid = data.get("action_uid")
+    try:
+        priority = int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "priority must be an integer"}), 400
+    # Skipped builds do no work, let them jump the queue
+    if data.get("status") != "OK":
+        priority = -1
+    try:
+        job = jobs.submit(run_build, data, data.get("callback_url"), priority=priority, key=action_uid)
+    except QueueFull as e:
+        report_updates([
+            {"action_uid": action_uid, "field": "builder_status", "value": "Rejected"},
+            {"action_uid": action_uid, "field": "builder_eta", "value": "N/A"},
+        ])
+        return jsonify({"status": "REJECTED", "error": f"Build queue full: {e}"}), 429, {"Retry-After": "30"}
+    return jsonify({"job_id": job.id, "state": job.state, "status_url": f"/api/v1/jobs/{job.id}"}), 202
+
+@app.route("/api/v1/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    Reports the state of a build job and, once finished, its result.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
 
+@app.route("/api/v1/log-queue-stats", methods=["GET"])
+def log_queue_stats():
+    """
+    Reports the publisher counters of the log queue (queued, published, dropped and spilled lines).
+    """
+    return jsonify(log_queue.get_stats())
+
+@app.route("/api/v1/build-queue-stats", methods=["GET"])
+def build_queue_stats():
+    """
+    Reports the build slots in use, the queue depth and the time builds waited for a slot.
+    """
+    return jsonify(build_scheduler.get_stats())
+
+@app.route("/api/v1/git-cache-stats", methods=["GET"])
+def git_cache_stats():
+    """
+    Reports the number and total size of the cached repository mirrors.
+    """
+    return jsonify(mirror_cache.stats())
 
 if __name__ == "__main__":
-    # Delay to ensure dependent services are up.
-    time.sleep(15)
+    # The publisher thread keeps retrying until RabbitMQ is up; lines are spooled meanwhile.
     log_queue.connect()
+    if build_cache is not None and not build_cache.ensure_builder():
+        # Without a docker-container builder the local cache export fails every build
+        print("BuildKit builder unavailable, falling back to BUILDER_MODE=docker; build resource usage is not measured", flush=True)
+        builder_mode, build_cache = "docker", None
+    if build_cache is not None:
+        build_cache.start()
     app.run(debug=True, host="0.0.0.0")
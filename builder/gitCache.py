@@ -0,0 +1,171 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# Ref the remote's default branch is fetched into
+HEAD_REF = "refs/continuum/HEAD"
+
+
+class MirrorError(Exception):
+    pass
+
+
+class MirrorCache:
+    """
+    Local bare mirrors of remote repositories, keyed by repository URL.
+
+    Each build fetches only what changed since the last build of the same
+    repository and gets a cheap detached worktree of the mirror instead of a
+    full clone. Mirrors are locked per repository, with a thread lock and a
+    file lock, so concurrent builds share them safely, and the least recently
+    used ones are evicted once the cache grows past max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.locks = {}  # mirror path -> threading.Lock
+        self.locks_guard = threading.Lock()
+        self.worktrees = {}  # worktree path -> mirror path
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def mirror_path(self, repo_url):
+        return os.path.join(self.cache_dir, hashlib.sha1(repo_url.encode("utf-8")).hexdigest() + ".git")
+
+    @contextmanager
+    def _locked(self, mirror, blocking=True):
+        with self.locks_guard:
+            lock = self.locks.setdefault(mirror, threading.Lock())
+        if not lock.acquire(blocking):
+            yield False
+            return
+        try:
+            with open(mirror + ".lock", "w") as lock_file:
+                # Also excludes other builder processes sharing the cache directory
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock.release()
+
+    @staticmethod
+    def _git(*args):
+        result = subprocess.run(["git", *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            # The command line is left out on purpose: fetch URLs carry the OAuth token
+            raise MirrorError(f"git {args[0] if args[0] != '-C' else args[2]} failed: {result.stderr.strip()}")
+        return result.stdout.strip()
+
+    def fetch(self, repo_url, fetch_url=None):
+        """
+        Creates or incrementally updates the mirror of a repository.
+
+        Args:
+        - repo_url (str): The repository URL, used as the cache key.
+        - fetch_url (str): URL to fetch from, e.g. with credentials; defaults to repo_url.
+
+        Returns:
+        - mirror (str): Path of the bare mirror.
+        """
+        mirror = self.mirror_path(repo_url)
+        with self._locked(mirror):
+            if not os.path.isdir(mirror):
+                self._git("init", "--bare", "--quiet", mirror)
+            self._git("-C", mirror, "fetch", "--quiet", "--prune", "--force", fetch_url or repo_url,
+                      "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*", f"+HEAD:{HEAD_REF}")
+            os.utime(mirror)
+        return mirror
+
+    def resolve(self, repo_url, ref=None):
+        """
+        Returns the commit hash a ref (default: the remote's default branch) points to in the mirror.
+        """
+        return self._git("-C", self.mirror_path(repo_url), "rev-parse", "--verify", f"{ref or HEAD_REF}^{{commit}}")
+
+    def checkout(self, repo_url, dest, fetch_url=None, ref=None):
+        """
+        Fetches the repository into its mirror and checks out a detached worktree.
+
+        Args:
+        - repo_url (str): The repository URL, used as the cache key.
+        - dest (str): Path of the worktree to create.
+        - fetch_url (str): URL to fetch from, e.g. with credentials; defaults to repo_url.
+        - ref (str): Branch, tag or commit to check out; defaults to the remote's default branch.
+
+        Returns:
+        - commit (str): The checked out commit hash.
+        """
+        mirror = self.fetch(repo_url, fetch_url)
+        with self._locked(mirror):
+            commit = self.resolve(repo_url, ref)
+            self._git("-C", mirror, "worktree", "add", "--force", "--detach", dest, commit)
+            self.worktrees[dest] = mirror
+        self.evict()
+        return commit
+
+    def release(self, dest):
+        """
+        Removes a worktree created by checkout.
+        """
+        mirror = self.worktrees.pop(dest, None)
+        if mirror is None:
+            shutil.rmtree(dest, ignore_errors=True)
+            return
+        with self._locked(mirror):
+            try:
+                self._git("-C", mirror, "worktree", "remove", "--force", dest)
+            except MirrorError:
+                shutil.rmtree(dest, ignore_errors=True)
+                self._git("-C", mirror, "worktree", "prune")
+
+    @staticmethod
+    def _size(path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def evict(self):
+        """
+        Deletes the least recently fetched mirrors until the cache fits in max_bytes.
+        Mirrors with a checked out worktree or held by another build are skipped.
+        """
+        mirrors = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".git")]
+        sizes = {mirror: self._size(mirror) for mirror in mirrors}
+        total = sum(sizes.values())
+        in_use = set(self.worktrees.values())
+        for mirror in sorted(mirrors, key=lambda path: os.stat(path).st_mtime):
+            if total <= self.max_bytes:
+                break
+            if mirror in in_use:
+                continue
+            with self._locked(mirror, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                shutil.rmtree(mirror, ignore_errors=True)
+                total -= sizes[mirror]
+                print(f"Evicted git mirror {mirror} ({sizes[mirror]} bytes)", flush=True)
+
+    def stats(self):
+        mirrors = [name for name in os.listdir(self.cache_dir) if name.endswith(".git")]
+        return {
+            "mirrors": len(mirrors),
+            "bytes": sum(self._size(os.path.join(self.cache_dir, name)) for name in mirrors),
+            "max_bytes": self.max_bytes,
+            "worktrees": len(self.worktrees),
+            "checked_at": time.time(),
+        }
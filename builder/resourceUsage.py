@@ -0,0 +1,227 @@
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+import requests
+
+# ru_inblock/ru_oublock count 512-byte blocks
+BLOCK_SIZE = 512
+DOCKER_SOCKET = "/var/run/docker.sock"
+
+
+class _DockerConnection(http.client.HTTPConnection):
+    """
+    HTTP connection to the Docker Engine API over its unix socket.
+    """
+    def __init__(self, socket_path=DOCKER_SOCKET, timeout=10):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def container_stats(container, socket_path=DOCKER_SOCKET):
+    """
+    Reads the cgroup counters of a running container from the Docker Engine API (what "docker stats" shows).
+    :return: Cumulative CPU seconds, current and peak memory bytes and block I/O bytes, or None if the container is not running.
+    """
+    connection = _DockerConnection(socket_path)
+    try:
+        connection.request("GET", f"/containers/{container}/stats?stream=false&one-shot=true")
+        response = connection.getresponse()
+        body = response.read()
+    finally:
+        connection.close()
+    if response.status != 200:
+        return None
+    stats = json.loads(body)
+    cpu = (stats.get("cpu_stats") or {}).get("cpu_usage") or {}
+    if not cpu.get("total_usage"):
+        return None  # created or exited containers report zeros
+    memory = stats.get("memory_stats") or {}
+    # Like docker stats, page cache that can be reclaimed does not count as used memory
+    cache = (memory.get("stats") or {}).get("inactive_file", (memory.get("stats") or {}).get("total_inactive_file", 0))
+    io = {"read": 0, "write": 0}
+    for entry in (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []:
+        operation = str(entry.get("op", "")).lower()
+        if operation in io:
+            io[operation] += entry.get("value", 0)
+    return {
+        "cpu_user": cpu.get("usage_in_usermode", 0) / 1e9,
+        "cpu_system": cpu.get("usage_in_kernelmode", 0) / 1e9,
+        "memory": max(memory.get("usage", 0) - cache, 0),
+        "memory_peak": memory.get("max_usage", 0),  # lifetime peak of the cgroup, cgroup v1 only
+        "read_bytes": io["read"],
+        "write_bytes": io["write"],
+    }
+
+
+class ContainerWatch:
+    """
+    Samples a container's counters on a thread until stopped.
+
+    CPU and I/O counters are cumulative, so the last sample taken while the
+    container runs covers all of its work up to then (minus at most one
+    interval); peak memory is the highest sample. A shared container, such as
+    a BuildKit builder serving several builds, only counts the growth of its
+    counters between the first and the last sample, and of its memory above
+    the first sample: its lifetime peak belongs to whatever work ran before.
+    """
+    def __init__(self, container, shared=False, interval=0.5):
+        self.container = container  # name or id, or a callable returning it once it is known
+        self.shared = shared
+        self.interval = interval
+        self.first = None
+        self.last = None
+        self.peak = 0
+        self.errors = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _sample(self):
+        container = self.container() if callable(self.container) else self.container
+        if not container:
+            return
+        try:
+            sample = container_stats(container)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self.errors += 1
+            if self.errors == 1:
+                print(f"Failed to read the stats of container {container}: {e}", flush=True)
+            return
+        if sample is None:
+            return
+        if self.first is None:
+            self.first = sample
+        self.last = sample
+        if self.shared:
+            self.peak = max(self.peak, sample["memory"] - self.first["memory"])
+        else:
+            self.peak = max(self.peak, sample["memory"], sample["memory_peak"])
+
+    def _loop(self):
+        self._sample()
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops sampling.
+        :return: The container's CPU seconds, peak memory and I/O bytes, or None if it was never seen running.
+        """
+        self.stopped.set()
+        self.thread.join()
+        if self.shared:
+            self._sample()
+        if self.last is None:
+            return None
+        base = self.first if self.shared else {}
+        return {
+            "cpu_user": self.last["cpu_user"] - base.get("cpu_user", 0),
+            "cpu_system": self.last["cpu_system"] - base.get("cpu_system", 0),
+            "max_rss_kb": self.peak // 1024,
+            "read_bytes": self.last["read_bytes"] - base.get("read_bytes", 0),
+            "write_bytes": self.last["write_bytes"] - base.get("write_bytes", 0),
+        }
+
+
+class StageUsage:
+    """
+    Accumulates the resource usage of the work a stage runs.
+
+    Work done by local subprocesses (grype, syft) is measured when they are
+    reaped with os.wait4, which returns the rusage of that one child, unlike
+    RUSAGE_CHILDREN which mixes in every concurrent job of the service.
+    Work the docker CLI delegates to the daemon (build steps, deployed and
+    test containers) is measured from the containers' cgroup counters with
+    watch(); the rusage of the CLI itself is not recorded. A stage where
+    nothing could be measured reports nothing rather than zeros, and one whose
+    numbers include other work, like a build sharing its BuildKit builder with
+    concurrent builds, is reported as approximate.
+    """
+    def __init__(self, action_uid, stage, sample_interval=0.5):
+        self.action_uid = action_uid
+        self.stage = stage
+        self.sample_interval = sample_interval  # seconds between container samples
+        self.started_at = time.time()
+        self.cpu_user = 0.0
+        self.cpu_system = 0.0
+        self.max_rss_kb = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.processes = 0
+        self.approximate = False  # the counters include work of other stages
+        self.lock = threading.Lock()  # stages may wait for several children from different threads
+
+    def _add(self, cpu_user, cpu_system, max_rss_kb, read_bytes, write_bytes):
+        with self.lock:
+            self.cpu_user += cpu_user
+            self.cpu_system += cpu_system
+            self.max_rss_kb = max(self.max_rss_kb, max_rss_kb)
+            self.read_bytes += read_bytes
+            self.write_bytes += write_bytes
+            self.processes += 1
+
+    def wait(self, process):
+        """
+        Waits for a subprocess.Popen child like process.wait() and records its usage.
+        Only for children that do the work themselves, not for docker CLI commands.
+        :return: The child's return code.
+        """
+        _, status, usage = os.wait4(process.pid, 0)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        self._add(usage.ru_utime, usage.ru_stime, usage.ru_maxrss,  # kilobytes on Linux
+                  usage.ru_inblock * BLOCK_SIZE, usage.ru_oublock * BLOCK_SIZE)
+        return process.returncode
+
+    @contextmanager
+    def watch(self, container, shared=False):
+        """
+        Records the usage of a container while the block runs.
+        :param container: Container name or id, or a callable returning it once known (e.g. from a --cidfile).
+        :param shared: The container also serves other work; only the growth of its counters is counted.
+        Set approximate if other work actually ran in it meanwhile.
+        """
+        watch = ContainerWatch(container, shared, self.sample_interval)
+        watch.start()
+        try:
+            yield
+        finally:
+            totals = watch.stop()
+            if totals is not None:
+                self._add(**totals)
+
+    def to_dict(self):
+        return {
+            "action_uid": self.action_uid,
+            "stage": self.stage,
+            "wall_time": time.time() - self.started_at,
+            "cpu_user": self.cpu_user,
+            "cpu_system": self.cpu_system,
+            "max_rss_kb": self.max_rss_kb,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+            "processes": self.processes,
+            "approximate": self.approximate,
+        }
+
+    def report(self, dbproxy_url="http://dbproxy:5000/api/v1/stage-resources"):
+        if not self.processes:
+            print(f"No resource usage measured for the {self.stage} stage of {self.action_uid}, not reporting it", flush=True)
+            return
+        try:
+            requests.post(dbproxy_url, json=self.to_dict(), timeout=10)
+        except requests.RequestException as e:
+            print(f"Failed to report stage resources: {e}", flush=True)
@@ -1,5 +1,5 @@
 import os
-from flask import Blueprint, jsonify, request, session
+from flask import Blueprint, jsonify, request, session, Response, stream_with_context
 from flask_login import login_required
 import requests
 
@@ -66,6 +66,8 @@ def get_logs():
     #get action_uid and service 
     action_uid = request.args.get("action_uid")
     service = request.args.get("service")
+    # Pagination parameters are forwarded so the client only fetches lines it has not seen
+    params = {key: request.args[key] for key in ("after", "since", "after_id", "limit") if key in request.args}
     
     print("Fetching logs for action", action_uid, "from service", service, flush=True)
     rest_server_url = f'http://dbproxy:5000/api/v1/logs/{action_uid}/{service}'
@@ -73,7 +75,7 @@ def get_logs():
 
     try:
         # Make a GET request to the orchestrator service
-        response = requests.get(rest_server_url, headers=headers)
+        response = requests.get(rest_server_url, headers=headers, params=params)
         if response.status_code == 200:
             # Assuming 200 indicates success
             return jsonify(response.json()), response.status_code
@@ -83,4 +85,38 @@ def get_logs():
             return jsonify({'error': error_message}), response.status_code
     except requests.exceptions.RequestException as e:
         # Handle errors from the requests library
-        return jsonify({'error': f'Request to orchestrator service failed: {str(e)}'}), 500
\ No newline at end of file
+        return jsonify({'error': f'Request to orchestrator service failed: {str(e)}'}), 500
+
+@actions_bp.route("/logs/stream", methods=["GET"])
+@login_required
+def stream_logs():
+    """
+    Relay the live log stream (Server-Sent Events) of an action and service.
+
+    The dbproxy stream is forwarded chunk by chunk; the Last-Event-ID header sent by a
+    reconnecting browser is passed through so the stream resumes where it stopped.
+    """
+    action_uid = request.args.get("action_uid")
+    service = request.args.get("service")
+    params = {"after": request.args["after"]} if request.args.get("after") else {}
+    rest_server_url = f'http://dbproxy:5000/api/v1/logs/{action_uid}/{service}/stream'
+    headers = {'Authorization': f'Bearer {session.get("jwt_token")}'}
+    if request.headers.get("Last-Event-ID"):
+        headers['Last-Event-ID'] = request.headers["Last-Event-ID"]
+
+    try:
+        response = requests.get(rest_server_url, headers=headers, params=params, stream=True, timeout=(5, None))
+    except requests.exceptions.RequestException as e:
+        return jsonify({'error': f'Request to dbproxy service failed: {str(e)}'}), 500
+    if response.status_code != 200:
+        return jsonify({'error': response.json().get('error', 'Failed to stream logs.')}), response.status_code
+
+    def relay():
+        try:
+            for chunk in response.iter_content(chunk_size=None):
+                yield chunk
+        finally:
+            response.close()
+
+    return Response(stream_with_context(relay()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,5 +1,5 @@
 import os
-from flask import Blueprint, render_template, session
+from flask import Blueprint, render_template, request, session
 from flask_login import login_required
 import requests
 from requests_oauthlib import OAuth2Session
@@ -10,6 +10,15 @@ if not os.getenv("GITHUB_CLIENT_ID"):
 
 profile_bp = Blueprint('profile', __name__)
 
+# Number of actions shown per page of a repository's history
+ACTIONS_PAGE_SIZE = int(os.getenv("ACTIONS_PAGE_SIZE", "50"))
+# Columns of the action history rendered by repo_details.html
+ACTION_FIELDS = [
+    "action_uid", "time_action_start", "current_status", "action_type",
+    "builder_status", "builder_eta", "scanner_status", "scanner_eta",
+    "deployer_status", "deployer_eta", "tester_status", "tester_eta",
+]
+
 @profile_bp.route("/profile", methods=["GET"])
 @login_required
 def profile():
@@ -41,7 +50,12 @@ def repo_details(repo_name):
 
     jwt_token = session.get("jwt_token")
     headers = {'Authorization': f'Bearer {jwt_token}'}
-    action_list = requests.get(f'http://dbproxy:5000/api/v1/read-action/{repo_name}', headers=headers).json()
+    params = {"limit": ACTIONS_PAGE_SIZE, "fields": ",".join(ACTION_FIELDS)}
+    before = request.args.get("before")
+    if before:
+        params["before"] = before
+    page = requests.get(f'http://dbproxy:5000/api/v1/read-action/{repo_name}', headers=headers, params=params).json()
+    action_list = page.get("actions", [])
   
     # Process action statuses
     for action in action_list:
@@ -54,4 +68,5 @@ def repo_details(repo_name):
             action['current_status'] = "OK"
             
 
-    return render_template('repo_details.html', repo_info=repo_info, action_list=action_list)
+    return render_template('repo_details.html', repo_info=repo_info, action_list=action_list,
+                           next_before=page.get("next_before"), is_first_page=not before)
@@ -0,0 +1,127 @@
+import threading
+import time
+import redis
+
+# Returned by generation() when Redis is unreachable; set() then skips the write
+GENERATION_UNAVAILABLE = object()
+# Generation counters outlive any database read by far, so an expired counter cannot be mistaken for an unchanged one
+GENERATION_TTL = 86400
+
+
+class ActionCache:
+    '''
+    Redis read-through cache of the serialized action history of a (user, repo).
+
+    Each (user, repo) maps to one Redis hash holding the serialized responses,
+    so a write to any action of the repo drops all of them with a single DEL.
+    Redis errors are counted and treated as misses; the database stays the
+    source of truth.
+
+    Every invalidation also bumps a generation counter of the (user, repo). A
+    reader takes the generation before querying the database and set() only
+    stores the response if it is unchanged, so an invalidation landing during
+    the read cannot leave stale history cached for the whole TTL.
+    '''
+    def __init__(self, host='localhost', port=6379, ttl=30):
+        self.client = redis.Redis(host=host, port=port, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.ttl = ttl  # seconds
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "errors": 0,
+            "invalidations": 0,
+            "stale_sets_skipped": 0,
+            "get_time_total": 0.0,
+            "get_time_max": 0.0,
+        }
+
+    @staticmethod
+    def _key(username, repo):
+        return f"actions:{username}:{repo}"
+
+    @staticmethod
+    def _generation_key(username, repo):
+        return f"actions-generation:{username}:{repo}"
+
+    def _record_get(self, outcome, elapsed):
+        with self.lock:
+            self.stats[outcome] += 1
+            self.stats["get_time_total"] += elapsed
+            self.stats["get_time_max"] = max(self.stats["get_time_max"], elapsed)
+
+    def get(self, username, repo, variant="all"):
+        '''
+        Returns the cached response body for a (user, repo), or None on a miss.
+        '''
+        start = time.time()
+        try:
+            body = self.client.hget(self._key(username, repo), variant)
+        except redis.RedisError as e:
+            print(f"Action cache unavailable: {e}", flush=True)
+            self._record_get("errors", time.time() - start)
+            return None
+        self._record_get("hits" if body is not None else "misses", time.time() - start)
+        return body
+
+    def generation(self, username, repo):
+        '''
+        Returns the invalidation generation of a (user, repo), to take before reading the database and pass to set().
+        '''
+        try:
+            return self.client.get(self._generation_key(username, repo))
+        except redis.RedisError as e:
+            print(f"Action cache unavailable: {e}", flush=True)
+            with self.lock:
+                self.stats["errors"] += 1
+            return GENERATION_UNAVAILABLE
+
+    def set(self, username, repo, body, variant="all", generation=None):
+        '''
+        Stores a response body, unless the (user, repo) was invalidated since generation was taken.
+        '''
+        if generation is GENERATION_UNAVAILABLE:
+            return
+        key = self._key(username, repo)
+        generation_key = self._generation_key(username, repo)
+        try:
+            with self.client.pipeline() as pipe:
+                # WATCH makes EXEC fail if an invalidation bumps the generation after the check
+                pipe.watch(generation_key)
+                if pipe.get(generation_key) != generation:
+                    raise redis.WatchError()
+                pipe.multi()
+                pipe.hset(key, variant, body)
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+        except redis.WatchError:
+            with self.lock:
+                self.stats["stale_sets_skipped"] += 1
+        except redis.RedisError as e:
+            print(f"Failed to populate action cache: {e}", flush=True)
+            with self.lock:
+                self.stats["errors"] += 1
+
+    def invalidate(self, username, repo):
+        generation_key = self._generation_key(username, repo)
+        try:
+            pipe = self.client.pipeline()
+            pipe.incr(generation_key)
+            pipe.expire(generation_key, GENERATION_TTL)
+            pipe.delete(self._key(username, repo))
+            pipe.execute()
+            with self.lock:
+                self.stats["invalidations"] += 1
+        except redis.RedisError as e:
+            print(f"Failed to invalidate action cache: {e}", flush=True)
+            with self.lock:
+                self.stats["errors"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"] + stats["errors"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        stats["get_time_avg"] = stats["get_time_total"] / lookups if lookups else 0.0
+        stats["ttl"] = self.ttl
+        return stats
@@ -0,0 +1,85 @@
+'''
+Benchmark for the log ingestion path of LogQueue.
+
+Compares the previous per-row executemany INSERT with the COPY FROM STDIN
+writer against a scratch table with the same columns as `logs`.
+Uses the same POSTGRES_* environment variables as dbproxy.
+
+    python bench_ingest.py --rows 50000 --batch 15 --batch 500 --batch 5000
+'''
+import argparse
+import os
+import time
+import uuid
+import psycopg2
+from psycopg2 import sql
+from logQueue import copy_logs
+
+BENCH_TABLE = "logs_bench"
+
+
+def make_rows(count):
+    action_uid = str(uuid.uuid4())
+    now = time.time()
+    return [
+        (action_uid, "builder", now + i * 0.001, f"#{i % 40} [stage 2/5] RUN pip install -r requirements.txt\tstep {i}\n")
+        for i in range(count)
+    ]
+
+
+def bench_executemany(conn, rows, batch_size):
+    query = sql.SQL("INSERT INTO {} (action_uid, service, time, log_text) VALUES (%s, %s, %s, %s)").format(sql.Identifier(BENCH_TABLE))
+    cur = conn.cursor()
+    start = time.time()
+    for i in range(0, len(rows), batch_size):
+        cur.executemany(query, rows[i:i + batch_size])
+        conn.commit()
+    elapsed = time.time() - start
+    cur.close()
+    return elapsed
+
+
+def bench_copy(conn, rows, batch_size):
+    cur = conn.cursor()
+    start = time.time()
+    for i in range(0, len(rows), batch_size):
+        copy_logs(cur, rows[i:i + batch_size], table=BENCH_TABLE)
+        conn.commit()
+    elapsed = time.time() - start
+    cur.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark log ingestion into Postgres")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--batch", type=int, action="append", help="Batch size to test (repeatable)")
+    args = parser.parse_args()
+    batch_sizes = args.batch or [15, 500, 5000]
+
+    conn = psycopg2.connect(
+        host=os.getenv("POSTGRES_HOST"),
+        database=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        port=os.getenv("POSTGRES_PORT")
+    )
+    cur = conn.cursor()
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} (action_uid TEXT, service TEXT, time DOUBLE PRECISION, log_text TEXT)").format(sql.Identifier(BENCH_TABLE)))
+    conn.commit()
+
+    rows = make_rows(args.rows)
+    print(f"{'method':<12}{'batch':>8}{'rows/sec':>14}")
+    for batch_size in batch_sizes:
+        for name, bench in (("executemany", bench_executemany), ("copy", bench_copy)):
+            cur.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(BENCH_TABLE)))
+            conn.commit()
+            elapsed = bench(conn, rows, batch_size)
+            print(f"{name:<12}{batch_size:>8}{len(rows) / elapsed:>14.0f}")
+
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''
+    Connection that remembers the server-side prepared statements it holds,
+    since those live as long as the session and the pool reuses sessions.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class DBPool:
+    '''
+    Bounded, thread-safe pool of psycopg2 connections shared by the Flask
+    handlers and the LogQueue consumer thread.
+    '''
+    def __init__(self, db_config, min_size=2, max_size=10, wait_timeout=10, health_check_after=30):
+        self.db_config = db_config
+        self.min_size = min_size
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout  # seconds a caller may wait for a free connection
+        self.health_check_after = health_check_after  # idle seconds before a connection is pinged
+        self.idle = []  # (connection, last_used) pairs, most recently used last
+        self.size = 0
+        self.cond = threading.Condition()
+        self.stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "connections_opened": 0,
+            "connections_discarded": 0,
+        }
+
+    def _open(self):
+        conn = psycopg2.connect(connection_factory=PooledConnection, **self.db_config)
+        with self.cond:
+            self.stats["connections_opened"] += 1
+        return conn
+
+    def fill(self):
+        '''
+        Opens connections until the pool holds at least min_size of them.
+        '''
+        while True:
+            with self.cond:
+                if self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                conn = self._open()
+            except Exception:
+                with self.cond:
+                    self.size -= 1
+                    self.cond.notify()
+                raise
+            with self.cond:
+                self.idle.append((conn, time.time()))
+                self.cond.notify()
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.health_check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.cond:
+            self.size -= 1
+            self.stats["connections_discarded"] += 1
+            self.cond.notify()
+
+    def getconn(self):
+        '''
+        Returns a healthy connection, opening a new one while below max_size and
+        otherwise waiting up to wait_timeout seconds for one to be released.
+        :return: An open psycopg2 connection.
+        '''
+        start = time.time()
+        waited = False
+        while True:
+            with self.cond:
+                while not self.idle and self.size >= self.max_size:
+                    remaining = self.wait_timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise PoolTimeout(f"No database connection available after {self.wait_timeout}s")
+                    waited = True
+                    self.cond.wait(remaining)
+                if self.idle:
+                    conn, last_used = self.idle.pop()
+                else:
+                    conn, last_used = None, None
+                    self.size += 1
+            if conn is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self.cond:
+                        self.size -= 1
+                        self.cond.notify()
+                    raise
+            elif not self._is_healthy(conn, last_used):
+                self._discard(conn)
+                continue
+            break
+
+        wait_time = time.time() - start
+        with self.cond:
+            self.stats["checkouts"] += 1
+            if waited:
+                self.stats["waits"] += 1
+            self.stats["wait_time_total"] += wait_time
+            self.stats["wait_time_max"] = max(self.stats["wait_time_max"], wait_time)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        '''
+        Returns a connection to the pool, rolling back any open transaction.
+        :param conn: The connection obtained from getconn.
+        :param discard: Close the connection instead of keeping it.
+        '''
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self):
+        '''
+        Context manager yielding a pooled connection. Connections that raised a
+        psycopg2 OperationalError/InterfaceError are closed instead of reused.
+        '''
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            # Also runs on GeneratorExit when a streaming response is abandoned
+            self.putconn(conn, discard=discard)
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats["size"] = self.size
+            stats["idle"] = len(self.idle)
+            stats["in_use"] = self.size - len(self.idle)
+            stats["min_size"] = self.min_size
+            stats["max_size"] = self.max_size
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        return stats
+
+    def close(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            self._discard(conn)
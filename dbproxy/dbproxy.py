@@ -1,11 +1,19 @@
 import time
 import jwt
 import redis
-from flask import Flask, redirect, url_for, session, request, jsonify, render_template
+import json
+import queue
+from flask import Flask, redirect, url_for, session, request, jsonify, render_template, Response, stream_with_context
 import os
 from jwt.exceptions import InvalidTokenError
 import psycopg2 as psycopg2
-from logQueue import LogQueue
+import psycopg2.errors
+from psycopg2.extras import execute_batch
+from logQueue import LogQueue, copy_rows
+from dbPool import DBPool
+from logTail import LogTail
+from actionCache import ActionCache
+from logPartitions import LogPartitionManager
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "supersecretkey")
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
@@ -19,7 +27,64 @@ db_config = {
     "password": os.getenv("POSTGRES_PASSWORD"),
     "port": os.getenv("POSTGRES_PORT")
 }
-log_queue = LogQueue(log_queue_host, log_queue_port, log_queue_name, db_config)
+db_pool = DBPool(
+    db_config,
+    min_size=int(os.getenv("POSTGRES_POOL_MIN", "2")),
+    max_size=int(os.getenv("POSTGRES_POOL_MAX", "10")),
+    wait_timeout=float(os.getenv("POSTGRES_POOL_TIMEOUT", "10")),
+    health_check_after=float(os.getenv("POSTGRES_POOL_HEALTH_CHECK_AFTER", "30"))
+)
+action_cache = ActionCache(
+    os.getenv("REDIS_HOST", "redis"),
+    int(os.getenv("REDIS_PORT", "6379")),
+    ttl=int(os.getenv("ACTION_CACHE_TTL", "30"))
+)
+log_partitions = LogPartitionManager(
+    db_pool,
+    os.getenv("LOG_ARCHIVE_DIR", "/archive/logs"),
+    partition_days=int(os.getenv("LOG_PARTITION_DAYS", "7")),
+    retention_days=int(os.getenv("LOG_RETENTION_DAYS", "30"))
+)
+ACTION_COLUMNS = (
+    "action_uid", "git_user_uid", "time_action_start", "git_repo_uid", "git_commit_hash",
+    "git_branch_name", "git_repo_name", "current_status", "builder_status", "tester_status",
+    "deployer_status", "builder_eta", "tester_eta", "deployer_eta", "action_type",
+    "scanner_status", "scanner_eta", "builder_cache_hits", "builder_cache_misses", "builder_queue_wait",
+    "scanner_cache_hit"
+)
+# Columns the update endpoints may write; anything else is rejected
+ACTION_UPDATE_FIELDS = (
+    "current_status", "git_commit_hash",
+    "builder_status", "builder_eta", "scanner_status", "scanner_eta",
+    "tester_status", "tester_eta", "deployer_status", "deployer_eta",
+    "builder_cache_hits", "builder_cache_misses", "builder_queue_wait",
+    "scanner_cache_hit"
+)
+STAGE_RESOURCE_COLUMNS = (
+    "wall_time", "cpu_user", "cpu_system", "max_rss_kb", "read_bytes", "write_bytes", "processes", "approximate"
+)
+VULNERABILITY_COLUMNS = (
+    "action_uid", "image_digest", "vulnerability_id", "severity", "package_name", "package_version",
+    "package_type", "fix_version"
+)
+TEST_RESULT_COLUMNS = (
+    "action_uid", "git_user_uid", "git_repo_name", "test_id", "shard", "outcome", "duration", "message"
+)
+# Outcomes whose duration reflects a full run of the test, used to balance test shards
+TEST_TIMED_OUTCOMES = ("passed", "failed")
+VULNERABILITY_PAGE_LIMIT = int(os.getenv("VULNERABILITY_PAGE_LIMIT", "500"))
+ACTION_PAGE_MAX_LIMIT = int(os.getenv("ACTION_PAGE_MAX_LIMIT", "1000"))
+ACTION_STREAM_ITERSIZE = int(os.getenv("ACTION_STREAM_ITERSIZE", "500"))
+LOG_PAGE_LIMIT = int(os.getenv("LOG_PAGE_LIMIT", "1000"))
+LOG_PAGE_MAX_LIMIT = int(os.getenv("LOG_PAGE_MAX_LIMIT", "10000"))
+LOG_STREAM_KEEPALIVE = float(os.getenv("LOG_STREAM_KEEPALIVE", "15"))
+log_queue = LogQueue(
+    log_queue_host, log_queue_port, log_queue_name, db_pool,
+    min_batch_size=int(os.getenv("LOG_BATCH_MIN", "15")),
+    max_batch_size=int(os.getenv("LOG_BATCH_MAX", "5000")),
+    flush_latency=float(os.getenv("LOG_FLUSH_LATENCY", "1.0")),
+    prefetch_count=int(os.getenv("LOG_PREFETCH", "5000"))
+)
 
 
 @app.route("/")
@@ -34,6 +99,76 @@ def info():
     })
 
 
+def ensure_schema():
+    '''
+    Adds the columns and indexes the API relies on to an existing database.
+    '''
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        # Tie-breaker for lines sharing the same timestamp in keyset pagination
+        cur.execute("ALTER TABLE logs ADD COLUMN IF NOT EXISTS id BIGSERIAL")
+        cur.execute("CREATE INDEX IF NOT EXISTS logs_action_service_time_idx ON logs (action_uid, service, time, id)")
+        # Cached and executed Dockerfile steps of the action's build
+        cur.execute("ALTER TABLE actions ADD COLUMN IF NOT EXISTS builder_cache_hits INTEGER")
+        cur.execute("ALTER TABLE actions ADD COLUMN IF NOT EXISTS builder_cache_misses INTEGER")
+        # Seconds the build waited for a free build slot
+        cur.execute("ALTER TABLE actions ADD COLUMN IF NOT EXISTS builder_queue_wait DOUBLE PRECISION")
+        # Whether the scan result was reused for an unchanged image and vulnerability DB
+        cur.execute("ALTER TABLE actions ADD COLUMN IF NOT EXISTS scanner_cache_hit BOOLEAN")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS stage_resources (
+                action_uid TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                wall_time DOUBLE PRECISION NOT NULL,
+                cpu_user DOUBLE PRECISION NOT NULL,
+                cpu_system DOUBLE PRECISION NOT NULL,
+                max_rss_kb BIGINT NOT NULL,
+                read_bytes BIGINT NOT NULL,
+                write_bytes BIGINT NOT NULL,
+                processes INTEGER NOT NULL,
+                approximate BOOLEAN NOT NULL DEFAULT false,
+                recorded_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (action_uid, stage)
+            )
+        """)
+        # Records whose counters include other work, e.g. concurrent builds on a shared BuildKit builder
+        cur.execute("ALTER TABLE stage_resources ADD COLUMN IF NOT EXISTS approximate BOOLEAN NOT NULL DEFAULT false")
+        cur.execute("CREATE INDEX IF NOT EXISTS stage_resources_stage_recorded_idx ON stage_resources (stage, recorded_at)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS vulnerabilities (
+                action_uid TEXT NOT NULL,
+                image_digest TEXT,
+                vulnerability_id TEXT NOT NULL,
+                severity TEXT NOT NULL,
+                package_name TEXT NOT NULL,
+                package_version TEXT NOT NULL,
+                package_type TEXT,
+                fix_version TEXT
+            )
+        """)
+        # "Which actions are affected by CVE-X" and "findings of an action by severity"
+        cur.execute("CREATE INDEX IF NOT EXISTS vulnerabilities_id_action_idx ON vulnerabilities (vulnerability_id, action_uid)")
+        cur.execute("CREATE INDEX IF NOT EXISTS vulnerabilities_action_severity_idx ON vulnerabilities (action_uid, severity)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS test_results (
+                action_uid TEXT NOT NULL,
+                git_user_uid TEXT,
+                git_repo_name TEXT,
+                test_id TEXT NOT NULL,
+                shard INTEGER,
+                outcome TEXT NOT NULL,
+                duration DOUBLE PRECISION NOT NULL,
+                message TEXT,
+                recorded_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        # "Results of an action" and "recent durations of a repository's tests" for shard balancing
+        cur.execute("CREATE INDEX IF NOT EXISTS test_results_action_idx ON test_results (action_uid)")
+        cur.execute("CREATE INDEX IF NOT EXISTS test_results_repo_recorded_idx ON test_results (git_user_uid, git_repo_name, recorded_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS actions_repo_user_start_idx ON actions (git_repo_name, git_user_uid, time_action_start DESC, action_uid DESC)")
+        conn.commit()
+        cur.close()
+
 def validate_token(token):
     '''
     Validates a JWT token and returns the username if valid.
@@ -48,72 +183,126 @@ def validate_token(token):
         # Handle invalid token (e.g., expired, tampered, etc.)
         return None
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.getenv("POSTGRES_HOST"),
-        database=os.getenv("POSTGRES_DB"),
-        user=os.getenv("POSTGRES_USER"),
-        password=os.getenv("POSTGRES_PASSWORD"),
-        port=os.getenv("POSTGRES_PORT")
-    )
-    return conn
+@app.route("/api/v1/pool-stats", methods=["GET"])
+def pool_stats():
+    '''
+    Reports usage and wait-time statistics of the shared database connection pool.
+    :return: A JSON object with the pool counters.
+    '''
+    return jsonify(db_pool.get_stats()), 200
+
+
+@app.route("/api/v1/cache-stats", methods=["GET"])
+def cache_stats():
+    '''
+    Reports hit/miss counters and lookup latency of the action history cache.
+    :return: A JSON object with the cache counters.
+    '''
+    return jsonify(action_cache.get_stats()), 200
 
+def serialize_action_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
 
+def parse_action_cursor(cursor):
+    '''
+    Parses an action history cursor of the form "<time_action_start isoformat>|<action_uid>".
+    :return: A (time_action_start, action_uid) tuple.
+    '''
+    time_action_start, separator, action_uid = cursor.partition("|")
+    if not separator or not time_action_start:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return time_action_start, action_uid
 
 @app.route("/api/v1/read-action/<repo>", methods=["GET"])
 def get_actions(repo):
     '''
-    Retrieves all actions for a specified repository, filtered by user and ordered by the latest.
+    Retrieves the actions for a specified repository, filtered by user and ordered by the latest.
+    The response is streamed from a server-side cursor as {"actions": [...], "next_before": cursor}.
+    Optional query parameters:
+    - limit: maximum number of actions to return, between 1 and ACTION_PAGE_MAX_LIMIT.
+    - before: the next_before cursor of a previous page, to fetch the actions started before it.
+    - fields: comma separated list of columns to return (default: all of ACTION_COLUMNS).
     :param repo: The name of the repository to retrieve actions for.
-    :return: A list of actions for the specified repository.
+    :return: A page of actions for the specified repository.
 
     '''
     username = validate_token(request.headers.get("Authorization").split(" ")[1])
     if username is None:
         return jsonify({"error": "Unauthorized"}), 401
 
-    query = """
-        SELECT action_uid, git_user_uid, time_action_start, git_repo_uid, git_commit_hash,
-               git_branch_name, git_repo_name, current_status, builder_status, tester_status,
-               deployer_status, builder_eta, tester_eta, deployer_eta, action_type,
-               scanner_status, scanner_eta
+    try:
+        limit = request.args.get("limit", type=int)
+        before = parse_action_cursor(request.args["before"]) if request.args.get("before") else None
+        fields = request.args.get("fields")
+        fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else list(ACTION_COLUMNS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Checked before streaming starts: once the 200 is sent, an error can only truncate the JSON
+    if limit is not None:
+        if limit < 1:
+            return jsonify({"error": "limit must be at least 1"}), 400
+        limit = min(limit, ACTION_PAGE_MAX_LIMIT)
+    unknown = [field for field in fields if field not in ACTION_COLUMNS]
+    if unknown:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    variant = f"{limit}|{request.args.get('before', '')}|{','.join(fields)}"
+    cached = action_cache.get(username, repo, variant)
+    if cached is not None:
+        return Response(cached, status=200, mimetype="application/json")
+
+    # Taken before the read: if the history is invalidated meanwhile, the response is not cached
+    generation = action_cache.generation(username, repo)
+    # The cursor columns are always selected, even when not part of the projection
+    columns = fields + [column for column in ("time_action_start", "action_uid") if column not in fields]
+    condition, params = "", [repo, username]
+    if before is not None:
+        condition = "AND (time_action_start, action_uid) < (%s::timestamptz, %s)"
+        params += list(before)
+    limit_clause = ""
+    if limit is not None:
+        limit_clause = "LIMIT %s"
+        params.append(limit)
+    query = f"""
+        SELECT {", ".join(columns)}
         FROM actions 
-        WHERE git_repo_name = %s AND git_user_uid = %s
-        ORDER BY time_action_start DESC
+        WHERE git_repo_name = %s AND git_user_uid = %s {condition}
+        ORDER BY time_action_start DESC, action_uid DESC
+        {limit_clause}
     """
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(query, (repo, username))
-        rows = cur.fetchall()
-        # Convert each row to a dict with properly formatted dates
-        builds = [
-            {
-                "action_uid": row[0],
-                "git_user_uid": row[1],
-                "time_action_start": row[2].isoformat() if row[2] else None,
-                "git_repo_uid": row[3],
-                "git_commit_hash": row[4],
-                "git_branch_name": row[5],
-                "git_repo_name": row[6],
-                "current_status": row[7],
-                "builder_status": row[8],
-                "tester_status": row[9],
-                "deployer_status": row[10],
-                "builder_eta": row[11],
-                "tester_eta": row[12],
-                "deployer_eta": row[13],
-                "action_type": row[14],
-                "scanner_status": row[15],
-                "scanner_eta": row[16],
-            } for row in rows
-        ]
-        cur.close()
-        conn.close()
-        return jsonify(builds), 200
-    except Exception as e:
-        print(e, flush=True)
-        return jsonify({"error": str(e)}), 500
+
+    def generate():
+        chunks = ['{"actions": [']
+        yield chunks[0]
+        count = 0
+        last = None
+        try:
+            with db_pool.connection() as conn:
+                # Named cursor: rows are fetched from the server itersize at a time
+                cur = conn.cursor(name="read_actions")
+                cur.itersize = ACTION_STREAM_ITERSIZE
+                cur.execute(query, params)
+                for row in cur:
+                    action = {column: serialize_action_value(value) for column, value in zip(columns, row)}
+                    last = action
+                    chunk = ("," if count else "") + json.dumps({field: action[field] for field in fields})
+                    count += 1
+                    chunks.append(chunk)
+                    yield chunk
+                cur.close()
+        except Exception as e:
+            # Headers are already sent; end the stream so the client sees truncated JSON
+            print(f"Failed to stream actions: {e}", flush=True)
+            return
+        next_before = None
+        if limit is not None and count == limit:
+            next_before = f"{last['time_action_start']}|{last['action_uid']}"
+        chunk = f"], \"next_before\": {json.dumps(next_before)}}}"
+        chunks.append(chunk)
+        yield chunk
+        action_cache.set(username, repo, "".join(chunks), variant, generation)
+
+    return Response(stream_with_context(generate()), status=200, mimetype="application/json")
 
 @app.route("/api/v1/write-action", methods=["POST"])
 def log_action():
@@ -167,48 +356,242 @@ def log_action():
     )
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(query,data)
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query,data)
+            conn.commit()
+            cur.close()
+        action_cache.invalidate(build_info["git_user_uid"], build_info["git_repo_name"])
         return jsonify({"message": "Build log successfully created"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
 
+def parse_log_cursor(cursor):
+    '''
+    Parses a log cursor of the form "<time>:<id>".
+    :param cursor: The cursor string returned as next_cursor by get_logs.
+    :return: A (time, id) tuple.
+    '''
+    log_time, log_id = cursor.split(":", 1)
+    return float(log_time), int(log_id)
+
+def fetch_log_page(action_uid, service, after_time=None, after_id=None, limit=LOG_PAGE_LIMIT):
+    '''
+    Fetches the next page of log lines ordered by (time, id), starting after the given position.
+    Lines of archived partitions are read from their archive files first, then the page is
+    completed from the database.
+    :return: A list of (id, time, log_text) rows.
+    '''
+    archived = []
+    if after_time is None or after_time < log_partitions.archive_horizon():
+        archived = log_partitions.read_archived(action_uid, service, after_time, after_id, limit)
+        if len(archived) >= limit:
+            return archived
+        if archived:
+            after_time, after_id, limit = archived[-1][1], archived[-1][0], limit - len(archived)
+
+    if after_time is None:
+        condition, params = "", (action_uid, service, limit)
+    elif after_id is None:
+        condition, params = "AND time > %s", (action_uid, service, after_time, limit)
+    else:
+        condition, params = "AND (time, id) > (%s, %s)", (action_uid, service, after_time, after_id, limit)
+
+    query = f"""
+        SELECT id, time, log_text
+        FROM logs
+        WHERE action_uid = %s AND service = %s {condition}
+        ORDER BY time, id
+        LIMIT %s
+    """
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        cur.close()
+    return archived + rows
+
+# Live tail fan-out, fed by the NOTIFYs LogQueue sends on commit
+log_tail = LogTail(db_config, fetch_log_page)
+
 @app.route("/api/v1/logs/<action_uid>/<service>", methods=["GET"])
 def get_logs(action_uid, service):
     '''
-    Retrieves logs for a specific action and service.
+    Retrieves a page of logs for a specific action and service.
+    Pages are keyed on (time, id): pass the next_cursor of a response as "after" to
+    fetch only the lines written since. "since" (a time) and "after_id" may be given
+    instead of a cursor.
     :param action_uid: The unique identifier of the action to retrieve logs for.
     :param service: The service to retrieve logs from.
 
-    :return: A list of logs for the specified action and service.
+    :return: The logs page, the cursor to continue from and whether more lines are available.
     '''
+    try:
+        if request.args.get("after"):
+            after_time, after_id = parse_log_cursor(request.args["after"])
+        else:
+            after_time = request.args.get("since", type=float)
+            after_id = request.args.get("after_id", type=int)
+        limit = min(request.args.get("limit", LOG_PAGE_LIMIT, type=int), LOG_PAGE_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error": "Invalid pagination parameters"}), 400
+    # An empty page would always report has_more and keep clients paging forever
+    if limit < 1:
+        return jsonify({"error": "limit must be at least 1"}), 400
+
+    try:
+        rows = fetch_log_page(action_uid, service, after_time, after_id, limit)
+        logs = [
+            {
+                "id": row[0],
+                "time": row[1],
+                "log_text": row[2]
+            } for row in rows
+        ]
+        if rows:
+            next_cursor = f"{rows[-1][1]!r}:{rows[-1][0]}"
+        else:
+            next_cursor = request.args.get("after")
+        return jsonify({"logs": logs, "next_cursor": next_cursor, "has_more": len(rows) == limit}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
 
+def latest_log_position(action_uid, service):
+    '''
+    Returns the (time, id) of the newest line of an action/service, or None if it has no logs.
+    '''
     query = """
-        SELECT time, log_text
+        SELECT time, id
         FROM logs
         WHERE action_uid = %s AND service = %s
-        ORDER BY time
+        ORDER BY time DESC, id DESC
+        LIMIT 1
     """
-    try:
-        conn = get_db_connection()
+    with db_pool.connection() as conn:
         cur = conn.cursor()
         cur.execute(query, (action_uid, service))
-        rows = cur.fetchall()
-        logs = [
-            {
-                #convert the time string to isoformat
-                "time": row[0],
-                "log_text": row[1]
-            } for row in rows
-        ]
+        row = cur.fetchone()
         cur.close()
-        conn.close()
-        return jsonify(logs), 200
+    return tuple(row) if row else None
+
+def format_log_event(rows):
+    # One SSE event per batch of rows; the event id is the cursor of its last row
+    lines = [{"id": row[0], "time": row[1], "log_text": row[2]} for row in rows]
+    return f"id: {rows[-1][1]!r}:{rows[-1][0]}\ndata: {json.dumps(lines)}\n\n"
+
+@app.route("/api/v1/logs/<action_uid>/<service>/stream", methods=["GET"])
+def stream_logs(action_uid, service):
+    '''
+    Streams the logs of an action and service as Server-Sent Events: first every line
+    after the given cursor, then new lines as LogQueue commits them.
+    The cursor is taken from the Last-Event-ID header (sent by reconnecting clients)
+    or the "after" query parameter.
+    :param action_uid: The unique identifier of the action to stream logs for.
+    :param service: The service to stream logs from.
+    '''
+    cursor = request.headers.get("Last-Event-ID") or request.args.get("after")
+    try:
+        position = parse_log_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    def generate():
+        subscriber = log_tail.subscribe(action_uid, service, latest_log_position(action_uid, service))
+        current = position
+        try:
+            # Replay what the client has not seen yet; lines committed meanwhile are queued
+            while True:
+                rows = fetch_log_page(action_uid, service, *(current or (None, None)))
+                if rows:
+                    current = (rows[-1][1], rows[-1][0])
+                    yield format_log_event(rows)
+                if len(rows) < LOG_PAGE_LIMIT:
+                    break
+            while not subscriber.closed:
+                try:
+                    rows = subscriber.get(timeout=LOG_STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if rows is None:
+                    break
+                rows = [row for row in rows if current is None or (row[1], row[0]) > current]
+                if rows:
+                    current = (rows[-1][1], rows[-1][0])
+                    yield format_log_event(rows)
+        finally:
+            log_tail.unsubscribe(subscriber)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/api/v1/logs/watchers", methods=["GET"])
+def log_watchers():
+    '''
+    Reports how many live log streams are currently open.
+    '''
+    return jsonify({"watchers": log_tail.watcher_count()}), 200
+
+def apply_action_updates(updates):
+    '''
+    Applies (action_uid, field, value) updates in a single transaction and invalidates
+    the cached history of every repository touched.
+    Each field has its own prepared UPDATE statement, created once per pooled session,
+    so the plan is reused instead of being rebuilt from request strings.
+    :param updates: List of (action_uid, field, value) tuples; fields must be in ACTION_UPDATE_FIELDS.
+    '''
+    by_field = {}
+    for action_uid, field, value in updates:
+        by_field.setdefault(field, []).append((value, action_uid))
+
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            for field, rows in by_field.items():
+                statement = f"update_action_{field}"
+                if statement not in conn.prepared:
+                    cur.execute(f"PREPARE {statement} AS UPDATE actions SET {field} = $1 WHERE action_uid = $2")
+                    conn.prepared.add(statement)
+                execute_batch(cur, f"EXECUTE {statement} (%s, %s)", rows)
+            cur.execute(
+                "SELECT DISTINCT git_user_uid, git_repo_name FROM actions WHERE action_uid = ANY(%s)",
+                (list({action_uid for action_uid, _, _ in updates}),)
+            )
+            touched = cur.fetchall()
+            conn.commit()
+        except psycopg2.errors.InvalidSqlStatementName:
+            # The session lost its prepared statements; they are recreated on the next call
+            conn.prepared.clear()
+            raise
+        finally:
+            cur.close()
+    for git_user_uid, git_repo_name in touched:
+        action_cache.invalidate(git_user_uid, git_repo_name)
+
+@app.route("/api/v1/update-actions", methods=["POST"])
+def update_actions():
+    '''
+    Applies many action field updates in one transaction.
+    Expects {"updates": [{"action_uid": ..., "field": ..., "value": ...}, ...]} where every
+    field is one of ACTION_UPDATE_FIELDS.
+    :return: A JSON response indicating the success or failure of the operation.
+    '''
+    payload = request.get_json(silent=True) or {}
+    try:
+        updates = [(update["action_uid"], update["field"], update["value"]) for update in payload.get("updates", [])]
+    except (KeyError, TypeError):
+        return jsonify({"error": "Each update needs action_uid, field and value"}), 400
+    invalid = sorted({field for _, field, _ in updates if field not in ACTION_UPDATE_FIELDS})
+    if invalid:
+        return jsonify({"error": f"Fields not updatable: {', '.join(invalid)}"}), 400
+    if not updates:
+        return jsonify({"message": "Nothing to update"}), 200
+
+    try:
+        apply_action_updates(updates)
+        return jsonify({"message": f"{len(updates)} action fields successfully updated"}), 200
     except Exception as e:
         print(e, flush=True)
         return jsonify({"error": str(e)}), 500
@@ -224,35 +607,354 @@ def update_action():
     build_info = request.get_json()
     print(build_info,flush=True)
 
-    query = f"""
-        UPDATE actions
-        SET 
-            {build_info['status_name']} = %s,
-            {build_info['eta_name']} = %s
-        WHERE action_uid = %s
-    """
-    
-    data = (
-        build_info["status"],
-        build_info["eta"],
-        build_info["action_uid"]
-    )
+    if build_info.get("status_name") not in ACTION_UPDATE_FIELDS or build_info.get("eta_name") not in ACTION_UPDATE_FIELDS:
+        return jsonify({"error": "Fields not updatable"}), 400
+
+    updates = [
+        (build_info["action_uid"], build_info["status_name"], build_info["status"]),
+        (build_info["action_uid"], build_info["eta_name"], build_info["eta"]),
+    ]
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(query,data)
-        conn.commit()
-        cur.close()
-        conn.close()
+        apply_action_updates(updates)
         return jsonify({"message": "Build log successfully updated"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    
+
+@app.route("/api/v1/stage-resources", methods=["POST"])
+def write_stage_resources():
+    '''
+    Stores the resource usage of one stage of an action, replacing an earlier record of the same stage.
+    Expects action_uid, stage and every column of STAGE_RESOURCE_COLUMNS.
+    :return: A JSON response indicating the success or failure of the operation.
+    '''
+    usage = request.get_json(silent=True) or {}
+    missing = [key for key in ("action_uid", "stage") + STAGE_RESOURCE_COLUMNS if usage.get(key) is None]
+    if missing:
+        return jsonify({"error": f"Missing fields: {', '.join(missing)}"}), 400
+
+    columns = ", ".join(STAGE_RESOURCE_COLUMNS)
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f"""INSERT INTO stage_resources (action_uid, stage, {columns})
+                    VALUES (%s, %s, {", ".join(["%s"] * len(STAGE_RESOURCE_COLUMNS))})
+                    ON CONFLICT (action_uid, stage) DO UPDATE SET
+                    {", ".join(f"{column} = EXCLUDED.{column}" for column in STAGE_RESOURCE_COLUMNS)}, recorded_at = now()""",
+                [usage["action_uid"], usage["stage"]] + [usage[column] for column in STAGE_RESOURCE_COLUMNS]
+            )
+            conn.commit()
+            cur.close()
+        return jsonify({"message": "Stage resources recorded"}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/v1/stage-resources/<action_uid>", methods=["GET"])
+def read_stage_resources(action_uid):
+    '''
+    Returns the recorded resource usage of every stage of an action.
+    :param action_uid: The action to look up.
+    :return: {"stages": [{"stage": ..., "wall_time": ..., ...}]}
+    '''
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f"SELECT stage, {', '.join(STAGE_RESOURCE_COLUMNS)}, recorded_at FROM stage_resources WHERE action_uid = %s ORDER BY recorded_at",
+                (action_uid,)
+            )
+            names = [column.name for column in cur.description]
+            stages = [{name: serialize_action_value(value) for name, value in zip(names, row)} for row in cur.fetchall()]
+            cur.close()
+        return jsonify({"stages": stages}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/v1/stage-resources/summary", methods=["GET"])
+def summarize_stage_resources():
+    '''
+    Aggregates stage resource usage for host sizing: per stage, the average and 95th percentile
+    of CPU time, peak RSS and I/O over the records of the last "days" days (default 30).
+    Approximate records, which include the usage of concurrent work, are left out.
+    '''
+    try:
+        days = int(request.args.get("days", 30))
+    except ValueError:
+        return jsonify({"error": "days must be an integer"}), 400
+
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT stage, count(*),
+                       avg(wall_time), percentile_cont(0.95) WITHIN GROUP (ORDER BY wall_time),
+                       avg(cpu_user + cpu_system), percentile_cont(0.95) WITHIN GROUP (ORDER BY cpu_user + cpu_system),
+                       avg(max_rss_kb), max(max_rss_kb),
+                       avg(read_bytes), avg(write_bytes)
+                FROM stage_resources
+                WHERE recorded_at >= now() - make_interval(days => %s) AND NOT approximate
+                GROUP BY stage ORDER BY stage
+            """, (days,))
+            summary = {
+                stage: {
+                    "runs": runs,
+                    "wall_time_avg": wall_avg, "wall_time_p95": wall_p95,
+                    "cpu_time_avg": cpu_avg, "cpu_time_p95": cpu_p95,
+                    "max_rss_kb_avg": float(rss_avg), "max_rss_kb_max": rss_max,
+                    "read_bytes_avg": float(read_avg), "write_bytes_avg": float(write_avg),
+                }
+                for stage, runs, wall_avg, wall_p95, cpu_avg, cpu_p95, rss_avg, rss_max, read_avg, write_avg in cur.fetchall()
+            }
+            cur.close()
+        return jsonify({"days": days, "stages": summary}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/v1/vulnerabilities", methods=["POST"])
+def write_vulnerabilities():
+    '''
+    Bulk inserts the findings of a scan with COPY.
+    Expects {"action_uid": ..., "image_digest": ..., "replace": bool, "findings": [{"vulnerability_id", "severity",
+    "package_name", "package_version", "package_type", "fix_version"}, ...]}. With replace, findings stored
+    earlier for the action are deleted first, so a repeated scan does not duplicate them.
+    :return: A JSON response indicating the success or failure of the operation.
+    '''
+    payload = request.get_json(silent=True) or {}
+    action_uid = payload.get("action_uid")
+    if not action_uid:
+        return jsonify({"error": "action_uid is required"}), 400
+    try:
+        rows = [
+            (action_uid, payload.get("image_digest"), finding["vulnerability_id"], finding["severity"],
+             finding["package_name"], finding["package_version"], finding.get("package_type"), finding.get("fix_version"))
+            for finding in payload.get("findings", [])
+        ]
+    except (KeyError, TypeError, AttributeError):
+        return jsonify({"error": "Each finding needs vulnerability_id, severity, package_name and package_version"}), 400
+
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            if payload.get("replace"):
+                cur.execute("DELETE FROM vulnerabilities WHERE action_uid = %s", (action_uid,))
+            if rows:
+                copy_rows(cur, rows, "vulnerabilities", VULNERABILITY_COLUMNS)
+            conn.commit()
+            cur.close()
+        return jsonify({"message": f"{len(rows)} findings stored"}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/v1/vulnerabilities/<vulnerability_id>/actions", methods=["GET"])
+def read_affected_actions(vulnerability_id):
+    '''
+    Lists the user's actions whose image has a given vulnerability, with the affected packages.
+    Optional query parameters:
+    - limit: maximum number of actions to return (default and cap: VULNERABILITY_PAGE_LIMIT).
+    - after: the next_after action_uid of a previous page.
+    :param vulnerability_id: The vulnerability id, e.g. CVE-2024-3094.
+    :return: {"actions": [...], "next_after": action_uid or None}
+    '''
+    username = validate_token(request.headers.get("Authorization", " ").split(" ")[-1])
+    if username is None:
+        return jsonify({"error": "Unauthorized"}), 401
+    limit = min(request.args.get("limit", VULNERABILITY_PAGE_LIMIT, type=int), VULNERABILITY_PAGE_LIMIT)
+    if limit < 1:
+        return jsonify({"error": "limit must be at least 1"}), 400
+    after = request.args.get("after", "")
+
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            # Walks the (vulnerability_id, action_uid) index in order; one row per affected action
+            cur.execute("""
+                SELECT affected.action_uid, a.git_repo_name, a.git_commit_hash, a.time_action_start, affected.packages
+                FROM (
+                    SELECT action_uid, json_agg(json_build_object(
+                        'package_name', package_name, 'package_version', package_version,
+                        'severity', severity, 'fix_version', fix_version)) AS packages
+                    FROM vulnerabilities
+                    WHERE vulnerability_id = %s AND action_uid > %s
+                    GROUP BY action_uid
+                ) affected
+                JOIN actions a ON a.action_uid = affected.action_uid
+                WHERE a.git_user_uid = %s
+                ORDER BY affected.action_uid
+                LIMIT %s
+            """, (vulnerability_id, after, username, limit + 1))
+            rows = cur.fetchall()
+            cur.close()
+
+        actions = [
+            {"action_uid": action_uid, "git_repo_name": repo, "git_commit_hash": commit,
+             "time_action_start": serialize_action_value(started), "packages": packages}
+            for action_uid, repo, commit, started, packages in rows[:limit]
+        ]
+        next_after = actions[-1]["action_uid"] if len(rows) > limit else None
+        return jsonify({"vulnerability_id": vulnerability_id, "actions": actions, "next_after": next_after}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/v1/vulnerabilities/severity-counts", methods=["GET"])
+def read_severity_counts():
+    '''
+    Counts the findings by severity of the latest successful scan of each of the user's repositories.
+    Optional query parameter "repo" restricts the result to one repository.
+    :return: {"repos": {repo: {"action_uid": ..., "counts": {severity: count}}}}
+    '''
+    username = validate_token(request.headers.get("Authorization", " ").split(" ")[-1])
+    if username is None:
+        return jsonify({"error": "Unauthorized"}), 401
+    repo = request.args.get("repo")
+    condition, params = "", [username]
+    if repo:
+        condition = "AND git_repo_name = %s"
+        params.append(repo)
+
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT latest.git_repo_name, latest.action_uid, v.severity, count(v.severity)
+                FROM (
+                    SELECT DISTINCT ON (git_repo_name) git_repo_name, action_uid
+                    FROM actions
+                    WHERE git_user_uid = %s AND scanner_status = 'OK' {condition}
+                    ORDER BY git_repo_name, time_action_start DESC, action_uid DESC
+                ) latest
+                LEFT JOIN vulnerabilities v ON v.action_uid = latest.action_uid
+                GROUP BY latest.git_repo_name, latest.action_uid, v.severity
+            """, params)
+            rows = cur.fetchall()
+            cur.close()
+
+        repos = {}
+        for repo_name, action_uid, severity, count in rows:
+            entry = repos.setdefault(repo_name, {"action_uid": action_uid, "counts": {}})
+            if severity is not None:  # a clean scan has no findings at all
+                entry["counts"][severity] = count
+        return jsonify({"repos": repos}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/v1/test-results", methods=["POST"])
+def write_test_results():
+    '''
+    Bulk inserts the per-test results of a test run with COPY.
+    Expects {"action_uid": ..., "git_user_uid": ..., "git_repo_name": ..., "replace": bool, "results": [{"test_id",
+    "outcome", "duration", "shard", "message"}, ...]}. With replace, results stored earlier for the action are
+    deleted first, so a repeated run does not duplicate them.
+    :return: A JSON response indicating the success or failure of the operation.
+    '''
+    payload = request.get_json(silent=True) or {}
+    action_uid = payload.get("action_uid")
+    if not action_uid:
+        return jsonify({"error": "action_uid is required"}), 400
+    try:
+        rows = [
+            (action_uid, payload.get("git_user_uid"), payload.get("git_repo_name"), result["test_id"],
+             result.get("shard"), result["outcome"], float(result["duration"]), result.get("message"))
+            for result in payload.get("results", [])
+        ]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return jsonify({"error": "Each result needs test_id, outcome and duration"}), 400
+
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            if payload.get("replace"):
+                cur.execute("DELETE FROM test_results WHERE action_uid = %s", (action_uid,))
+            if rows:
+                copy_rows(cur, rows, "test_results", TEST_RESULT_COLUMNS)
+            conn.commit()
+            cur.close()
+        return jsonify({"message": f"{len(rows)} test results stored"}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/v1/test-results/<action_uid>", methods=["GET"])
+def read_test_results(action_uid):
+    '''
+    Returns the per-test results of an action, failures first.
+    :param action_uid: The action to look up.
+    :return: {"results": [{"test_id": ..., "outcome": ..., ...}], "counts": {outcome: count}}
+    '''
+    username = validate_token(request.headers.get("Authorization", " ").split(" ")[-1])
+    if username is None:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT test_id, shard, outcome, duration, message
+                FROM test_results
+                WHERE action_uid = %s AND git_user_uid = %s
+                ORDER BY outcome IN ('passed', 'skipped'), test_id
+            """, (action_uid, username))
+            results = [
+                {"test_id": test_id, "shard": shard, "outcome": outcome, "duration": duration, "message": message}
+                for test_id, shard, outcome, duration, message in cur.fetchall()
+            ]
+            cur.close()
+
+        counts = {}
+        for result in results:
+            counts[result["outcome"]] = counts.get(result["outcome"], 0) + 1
+        return jsonify({"action_uid": action_uid, "results": results, "counts": counts}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/v1/test-durations", methods=["GET"])
+def read_test_durations():
+    '''
+    Averages the duration of each test of a repository over its runs of the last "days" days (default 30),
+    for the tester to balance its shards. Query parameters "user" and "repo" are required.
+    :return: {"durations": {test_id: seconds}}
+    '''
+    username = request.args.get("user")
+    repo = request.args.get("repo")
+    if not username or not repo:
+        return jsonify({"error": "user and repo are required"}), 400
+    try:
+        days = int(request.args.get("days", 30))
+    except ValueError:
+        return jsonify({"error": "days must be an integer"}), 400
+
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT test_id, avg(duration)
+                FROM test_results
+                WHERE git_user_uid = %s AND git_repo_name = %s AND outcome = ANY(%s)
+                  AND recorded_at >= now() - make_interval(days => %s)
+                GROUP BY test_id
+            """, (username, repo, list(TEST_TIMED_OUTCOMES), days))
+            durations = dict(cur.fetchall())
+            cur.close()
+        return jsonify({"days": days, "durations": durations}), 200
+    except Exception as e:
+        print(e, flush=True)
+        return jsonify({"error": str(e)}), 500
 
 
 if __name__ == "__main__":
 
     time.sleep(15)
+    db_pool.fill()
+    ensure_schema()
+    log_partitions.setup()
+    log_partitions.start()
+    log_tail.start()
     log_queue.connect()
     log_queue.start_consuming()
     app.run(debug=True, host="0.0.0.0")
@@ -0,0 +1,402 @@
+import bisect
+import gzip
+import heapq
+import io
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, archives fall back to gzip
+    zstandard = None
+
+# Partition boundaries are aligned on this epoch (Monday 1970-01-05 00:00 UTC) so weekly partitions start on Mondays
+PARTITION_ANCHOR = 4 * 86400
+# Lines per independently compressed chunk of an archive file; reads seek to the chunk holding their cursor
+ARCHIVE_CHUNK_LINES = 1000
+# Suffix of the index file written next to each archive file
+INDEX_SUFFIX = ".idx"
+
+
+@contextmanager
+def open_archive(path, offset=0):
+    '''
+    Opens an archive file for text reading from a chunk boundary, picking the codec from its extension.
+    Archives are concatenated gzip members or zstd frames, so reading can start at any chunk.
+    '''
+    with open(path, "rb") as raw:
+        raw.seek(offset)
+        if path.endswith(".zst"):
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+        else:
+            stream = gzip.GzipFile(fileobj=raw, mode="rb")
+        with io.TextIOWrapper(stream, encoding="utf-8") as text:
+            yield text
+
+
+class ArchiveWriter:
+    '''
+    Writes the lines of one action, ordered by (service, time, id), as chunks compressed
+    independently of each other, and an index of the first (service, time, id) and offset of every chunk.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.index = []
+        self.lines = []
+        self.service = None
+
+    def _compress(self, data):
+        if self.path.endswith(".zst"):
+            return zstandard.ZstdCompressor(level=10).compress(data)
+        return gzip.compress(data)
+
+    def _flush(self):
+        if self.lines:
+            self.file.write(self._compress(("\n".join(self.lines) + "\n").encode("utf-8")))
+            self.lines = []
+
+    def write(self, service, log_id, log_time, log_text):
+        if self.lines and (service != self.service or len(self.lines) >= ARCHIVE_CHUNK_LINES):
+            self._flush()
+        if not self.lines:
+            self.index.append([service, log_time, log_id, self.file.tell()])
+            self.service = service
+        self.lines.append(json.dumps([service, log_id, log_time, log_text]))
+
+    def close(self):
+        self._flush()
+        self.file.close()
+        with open(self.path + INDEX_SUFFIX, "w") as index:
+            json.dump(self.index, index)
+
+
+class LogPartitionManager:
+    '''
+    Keeps the logs table range-partitioned on time and moves partitions older
+    than the retention period into compressed per-action files on local disk.
+    '''
+    def __init__(self, db_pool, archive_dir, partition_days=7, retention_days=30, partitions_ahead=2,
+                 maintenance_interval=3600):
+        self.db_pool = db_pool
+        self.archive_dir = archive_dir
+        self.period = partition_days * 86400
+        self.retention = retention_days * 86400
+        self.partitions_ahead = partitions_ahead
+        self.maintenance_interval = maintenance_interval  # seconds
+        self.extension = ".jsonl.zst" if zstandard is not None else ".jsonl.gz"
+
+    def _period_start(self, epoch):
+        return (int(epoch) - PARTITION_ANCHOR) // self.period * self.period + PARTITION_ANCHOR
+
+    @staticmethod
+    def _partition_name(start):
+        return "logs_p" + datetime.fromtimestamp(start, tz=timezone.utc).strftime("%Y%m%d")
+
+    def _create_partitions(self, cur, first_start, last_start):
+        '''
+        Creates the missing partitions of a range. Postgres refuses to create a partition while the default
+        partition holds rows of its range, so those rows are moved into the new partition: the default
+        partition is detached, the partition created, the rows copied over and the default reattached.
+        '''
+        for start in range(first_start, last_start + self.period, self.period):
+            name = self._partition_name(start)
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL, to_regclass('logs_default') IS NOT NULL", (name,))
+            exists, has_default = cur.fetchone()
+            if exists:
+                continue
+            create = f"CREATE TABLE {name} PARTITION OF logs FOR VALUES FROM (%s) TO (%s)"
+            bounds = (start, start + self.period)
+            stray = False
+            if has_default:
+                cur.execute("SELECT EXISTS (SELECT 1 FROM logs_default WHERE time >= %s AND time < %s)", bounds)
+                stray = cur.fetchone()[0]
+            if not stray:
+                cur.execute(create, bounds)
+                continue
+            print(f"Moving lines out of the default partition into {name}", flush=True)
+            cur.execute("ALTER TABLE logs DETACH PARTITION logs_default")
+            cur.execute(create, bounds)
+            cur.execute("INSERT INTO logs SELECT * FROM logs_default WHERE time >= %s AND time < %s", bounds)
+            cur.execute("DELETE FROM logs_default WHERE time >= %s AND time < %s", bounds)
+            cur.execute("ALTER TABLE logs ATTACH PARTITION logs_default DEFAULT")
+
+    def setup(self):
+        '''
+        Converts an unpartitioned logs table into a partitioned one (copying its rows)
+        and creates the archive index table and the upcoming partitions.
+        '''
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with self.db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS archived_logs (
+                    action_uid TEXT NOT NULL,
+                    partition_name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    archived_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (action_uid, partition_name)
+                )
+            """)
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('logs')")
+            if cur.fetchone()[0] != "p":
+                print("Migrating logs to a partitioned table", flush=True)
+                cur.execute("ALTER TABLE logs RENAME TO logs_unpartitioned")
+                # Keep the id sequence alive when the old table is dropped; the new table's default uses it
+                cur.execute("SELECT pg_get_serial_sequence('logs_unpartitioned', 'id')")
+                sequence = cur.fetchone()[0]
+                if sequence:
+                    cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+                cur.execute("CREATE TABLE logs (LIKE logs_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (time)")
+                # Catches lines with a clock far outside the managed range instead of failing the batch
+                cur.execute("CREATE TABLE logs_default PARTITION OF logs DEFAULT")
+                cur.execute("SELECT min(time), max(time) FROM logs_unpartitioned")
+                oldest, newest = cur.fetchone()
+                if oldest is not None:
+                    self._create_partitions(cur, self._period_start(oldest), self._period_start(newest))
+                cur.execute("INSERT INTO logs SELECT * FROM logs_unpartitioned")
+                cur.execute("DROP TABLE logs_unpartitioned")
+                if sequence:
+                    cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY logs.id")
+                cur.execute("CREATE INDEX IF NOT EXISTS logs_action_service_time_idx ON logs (action_uid, service, time, id)")
+            conn.commit()
+            cur.close()
+        self.ensure_partitions()
+
+    def ensure_partitions(self):
+        '''
+        Creates the partitions for the current period and the next partitions_ahead ones.
+        '''
+        current = self._period_start(time.time())
+        with self.db_pool.connection() as conn:
+            cur = conn.cursor()
+            self._create_partitions(cur, current, current + self.partitions_ahead * self.period)
+            conn.commit()
+            cur.close()
+
+    def _expired_partitions(self, cur):
+        cur.execute("""
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = 'logs' AND child.relname LIKE 'logs\\_p%'
+        """)
+        cutoff = self._period_start(time.time() - self.retention)
+        expired = []
+        for (name,) in cur.fetchall():
+            start = int(datetime.strptime(name[len("logs_p"):], "%Y%m%d").replace(tzinfo=timezone.utc).timestamp())
+            if start + self.period <= cutoff:
+                expired.append(name)
+        return sorted(expired)
+
+    def archive_expired(self):
+        '''
+        Archives every partition past the retention period in two steps, so ingestion and
+        log reads are only blocked for a moment:
+        1. its lines are exported from the still attached partition with a plain SELECT,
+           which only takes a shared lock on that partition, into one compressed file per action;
+        2. a short transaction checks that no line arrived in the meantime, records the files
+           in archived_logs, detaches the partition and drops it.
+        Expired lines in the default partition are archived the same way and then deleted.
+        A failed or outdated export leaves the lines in place and is simply retried;
+        archive files are overwritten, never appended to.
+        '''
+        with self.db_pool.connection() as conn:
+            cur = conn.cursor()
+            expired = self._expired_partitions(cur)
+            conn.commit()
+            cur.close()
+
+        for name in expired:
+            archived, exported = self._export(name, name)
+            with self.db_pool.connection() as conn:
+                cur = conn.cursor()
+                # Blocks late lines routed to this partition, not the rest of the logs table
+                cur.execute(f"LOCK TABLE {name} IN SHARE MODE")
+                cur.execute(f"SELECT count(*) FROM {name}")
+                if cur.fetchone()[0] != exported:
+                    conn.rollback()
+                    cur.close()
+                    print(f"Partition {name} changed while it was archived, retrying later", flush=True)
+                    continue
+                self._record_archives(cur, archived)
+                cur.execute(f"ALTER TABLE logs DETACH PARTITION {name}")
+                cur.execute(f"DROP TABLE {name}")
+                conn.commit()
+                cur.close()
+            print(f"Archived partition {name}: {len(archived)} actions", flush=True)
+
+        self._archive_expired_default()
+
+    def _archive_expired_default(self):
+        '''
+        Archives the lines of the default partition older than the retention period. Each run gets
+        its own archive name, as the default partition keeps receiving lines.
+        '''
+        cutoff = self._period_start(time.time() - self.retention)
+        with self.db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT to_regclass('logs_default') IS NOT NULL")
+            has_default = cur.fetchone()[0]
+            if has_default:
+                cur.execute("SELECT EXISTS (SELECT 1 FROM logs_default WHERE time < %s)", (cutoff,))
+                has_default = cur.fetchone()[0]
+            conn.commit()
+            cur.close()
+        if not has_default:
+            return
+
+        batch = "logs_default_" + datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+        archived, exported = self._export("logs_default", batch, "WHERE time < %s", (cutoff,))
+        with self.db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("LOCK TABLE logs_default IN SHARE MODE")
+            cur.execute("SELECT count(*) FROM logs_default WHERE time < %s", (cutoff,))
+            if cur.fetchone()[0] != exported:
+                conn.rollback()
+                cur.close()
+                print("Default log partition changed while it was archived, retrying later", flush=True)
+                return
+            self._record_archives(cur, archived)
+            cur.execute("DELETE FROM logs_default WHERE time < %s", (cutoff,))
+            conn.commit()
+            cur.close()
+        print(f"Archived {exported} expired lines of the default partition: {len(archived)} actions", flush=True)
+
+    @staticmethod
+    def _record_archives(cur, archived):
+        cur.executemany(
+            """INSERT INTO archived_logs (action_uid, partition_name, path) VALUES (%s, %s, %s)
+               ON CONFLICT (action_uid, partition_name) DO UPDATE SET path = EXCLUDED.path""",
+            archived
+        )
+
+    def _export(self, table, batch, condition="", params=()):
+        '''
+        Writes the lines of a table into one compressed file per action, with its chunk index.
+        :param table: The partition to read.
+        :param batch: The name the files are recorded under in archived_logs.
+        :param condition: An optional WHERE clause selecting the lines to export, with its params.
+        :return: The (action_uid, partition_name, path) rows of the files written and the number of lines exported.
+        '''
+        archived = []
+        exported = 0
+        with self.db_pool.connection() as conn:
+            reader = conn.cursor(name=f"archive_{table}")
+            reader.itersize = 5000
+            reader.execute(
+                f"SELECT action_uid, service, id, time, log_text FROM {table} {condition} "
+                "ORDER BY action_uid, service, time, id",
+                params
+            )
+            current_uid, archive = None, None
+            try:
+                for action_uid, service, log_id, log_time, log_text in reader:
+                    if action_uid != current_uid:
+                        if archive is not None:
+                            archive.close()
+                        current_uid = action_uid
+                        path = os.path.join(self.archive_dir, f"{action_uid}.{batch}{self.extension}")
+                        archive = ArchiveWriter(path)
+                        archived.append((action_uid, batch, path))
+                    archive.write(service, log_id, log_time, log_text)
+                    exported += 1
+            finally:
+                if archive is not None:
+                    archive.close()
+            reader.close()
+            # Ends the read-only transaction, releasing the partition's shared lock
+            conn.commit()
+        return archived, exported
+
+    def archive_horizon(self):
+        '''
+        Returns the epoch time before which lines may have been archived; newer lines are always in the database.
+        '''
+        return self._period_start(time.time() - self.retention)
+
+    @staticmethod
+    def _archive_lines(path, service, after_time, after_id):
+        '''
+        Yields the (id, time, log_text) lines of a service in one archive file in (time, id) order,
+        starting after the given position. The index locates the first chunk to decompress;
+        files written before there was an index are scanned from the start.
+        '''
+        offset, indexed = 0, os.path.exists(path + INDEX_SUFFIX)
+        if indexed:
+            with open(path + INDEX_SUFFIX) as index_file:
+                chunks = [(log_time, log_id, chunk_offset)
+                          for line_service, log_time, log_id, chunk_offset in json.load(index_file)
+                          if line_service == service]
+            if not chunks:
+                return
+            offset = chunks[0][2]
+            if after_time is not None:
+                position = (after_time, after_id if after_id is not None else float("inf"))
+                # The last chunk starting at or before the position holds the first line after it
+                chunk = bisect.bisect_right([chunk[:2] for chunk in chunks], position)
+                offset = chunks[max(chunk - 1, 0)][2]
+
+        with open_archive(path, offset) as archive:
+            for line in archive:
+                line_service, log_id, log_time, log_text = json.loads(line)
+                if line_service != service:
+                    if indexed:
+                        return  # the lines of a service are contiguous in indexed files
+                    continue
+                if after_time is not None:
+                    if after_id is None and log_time <= after_time:
+                        continue
+                    if after_id is not None and (log_time, log_id) <= (after_time, after_id):
+                        continue
+                yield log_id, log_time, log_text
+
+    def read_archived(self, action_uid, service, after_time=None, after_id=None, limit=1000):
+        '''
+        Reads archived lines of an action/service in (time, id) order, starting after the given position.
+        Each archive file is read from the chunk holding the position and only until the page is full.
+        :return: A list of (id, time, log_text) rows, empty if the action was never archived.
+        '''
+        with self.db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT path FROM archived_logs WHERE action_uid = %s ORDER BY partition_name", (action_uid,))
+            paths = [row[0] for row in cur.fetchall()]
+            cur.close()
+
+        sources = []
+        for path in paths:
+            if not os.path.exists(path):
+                print(f"Archive file missing: {path}", flush=True)
+                continue
+            sources.append(self._archive_lines(path, service, after_time, after_id))
+        try:
+            # Lines of the default partition may fall between those of other archives
+            merged = heapq.merge(*sources, key=lambda row: (row[1], row[0]))
+            return list(itertools.islice(merged, limit))
+        finally:
+            for source in sources:
+                source.close()
+
+    def run_maintenance(self):
+        # Separate steps, so a partition that cannot be created does not stop archiving
+        try:
+            self.ensure_partitions()
+        except Exception as e:
+            print(f"Log partition creation failed: {e}", flush=True)
+        try:
+            self.archive_expired()
+        except Exception as e:
+            print(f"Log partition archiving failed: {e}", flush=True)
+
+    def start(self):
+        def loop():
+            while True:
+                self.run_maintenance()
+                time.sleep(self.maintenance_interval)
+        threading.Thread(target=loop, daemon=True).start()
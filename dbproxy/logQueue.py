@@ -1,22 +1,94 @@
+import io
 import json
 import pika
+import struct
 import threading
 import time
-import psycopg2
-from psycopg2 import sql
+
+LOG_COLUMNS = ("action_uid", "service", "time", "log_text")
+LOG_NOTIFY_CHANNEL = "log_lines"  # payload "<action_uid>/<service>", sent on commit of new lines
+# Content type of a binary log frame, see encode_frame in the publisher LogQueue
+LOG_FRAME_CONTENT_TYPE = "application/x-log-frame"
+_FRAME_HEADER = struct.Struct(">H")
+_FRAME_COUNT = struct.Struct(">I")
+_FRAME_LINE = struct.Struct(">dI")
+
+
+def _copy_escape(value):
+    # Escape a value for the COPY text format (tab separated, \N for NULL)
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_rows(cur, rows, table, columns):
+    '''
+    Streams rows into the given columns of a table with COPY FROM STDIN.
+    :param cur: An open psycopg2 cursor.
+    :param rows: Iterable of tuples ordered like columns.
+    :param table: Name of the destination table.
+    :param columns: Names of the destination columns.
+    '''
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_escape(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def copy_logs(cur, rows, table="logs"):
+    '''
+    Streams log rows into the given table with COPY FROM STDIN.
+    :param cur: An open psycopg2 cursor.
+    :param rows: Iterable of (action_uid, service, time, log_text) tuples.
+    :param table: Name of the destination table.
+    '''
+    copy_rows(cur, rows, table, LOG_COLUMNS)
+
+
+def decode_frame(body):
+    '''
+    Decodes a log frame straight into (action_uid, service, time, log_text) rows.
+    '''
+    view = memoryview(body)
+    offset = 0
+    header = []
+    for _ in range(2):
+        (length,) = _FRAME_HEADER.unpack_from(view, offset)
+        offset += _FRAME_HEADER.size
+        header.append(str(view[offset:offset + length], "utf-8"))
+        offset += length
+    action_uid, service = header
+    (count,) = _FRAME_COUNT.unpack_from(view, offset)
+    offset += _FRAME_COUNT.size
+    rows = []
+    for _ in range(count):
+        log_time, length = _FRAME_LINE.unpack_from(view, offset)
+        offset += _FRAME_LINE.size
+        rows.append((action_uid, service, log_time, str(view[offset:offset + length], "utf-8")))
+        offset += length
+    return rows
+
 
 class LogQueue:
-    def __init__(self, host='localhost', port=5672, queue_name='log', db_config=None):
+    def __init__(self, host='localhost', port=5672, queue_name='log', db_pool=None,
+                 min_batch_size=15, max_batch_size=5000, flush_latency=1.0, prefetch_count=5000):
         self.host = host
         self.port = port
         self.queue_name = queue_name
         self.connection = None
         self.channel = None
-        self.db_config = db_config
-        self.messages = []
+        self.db_pool = db_pool
+        self.messages = []  # (action_uid, service, time, log_text) rows waiting to be written
+        self.last_delivery_tag = None  # highest unacked tag covered by self.messages
         self.lock = threading.Lock()
-        self.batch_size = 15
-        self.timeout = 3  # seconds
+        self.prefetch_count = prefetch_count
+        # A batch can never grow past the number of unacked messages the broker will deliver
+        self.min_batch_size = min(min_batch_size, prefetch_count)
+        self.max_batch_size = min(max_batch_size, prefetch_count)
+        self.batch_size = self.min_batch_size  # adapted after every flush
+        self.flush_latency = flush_latency  # seconds a buffered line may wait before being written
         self.last_message_time = None
         self.running = True
 
@@ -36,42 +108,95 @@ class LogQueue:
         threading.Thread(target=self._consume_messages, daemon=True).start()
 
     def _consume_messages(self):
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_message)
         while self.running:
-            method_frame, header_frame, body = self.channel.basic_get(queue=self.queue_name)
-            if method_frame:
-                self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-                message = json.loads(body.decode('utf-8'))
-                with self.lock:
-                    self.messages.append(message)
-                    if not self.last_message_time:
-                        self.last_message_time = time.time()
-                self._check_batch_conditions()
-            else:
-                time.sleep(0.1)  # No message, wait a bit
+            # Block on the socket until messages arrive or the oldest buffered line is due
+            with self.lock:
+                if self.last_message_time:
+                    time_limit = max(0, self.flush_latency - (time.time() - self.last_message_time))
+                else:
+                    time_limit = self.flush_latency
+            self.connection.process_data_events(time_limit=time_limit)
+            self._check_batch_conditions()
+
+    def _on_message(self, channel, method, properties, body):
+        try:
+            rows = self._decode(properties.content_type, body)
+        except (ValueError, KeyError, struct.error) as e:
+            print(f"Dropping malformed log message: {e}")
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        with self.lock:
+            self.messages.extend(rows)
+            self.last_delivery_tag = method.delivery_tag
+            if not self.last_message_time:
+                self.last_message_time = time.time()
+        if len(self.messages) >= self.batch_size:
+            self._check_batch_conditions()
+
+    @staticmethod
+    def _decode(content_type, body):
+        '''
+        Decodes a message into rows according to its content type: a binary log frame, or
+        JSON holding either one line or a batch of lines sharing action_uid/service.
+        '''
+        if content_type == LOG_FRAME_CONTENT_TYPE:
+            return decode_frame(body)
+        message = json.loads(body.decode('utf-8'))
+        if "lines" in message:
+            return [(message['action_uid'], message['service'], line['time'], line['log']) for line in message['lines']]
+        return [(message['action_uid'], message['service'], message['time'], message['log'])]
 
     def _check_batch_conditions(self):
         with self.lock:
-            if len(self.messages) >= self.batch_size or (time.time() - self.last_message_time >= self.timeout and self.messages):
-                self._write_to_db()
+            if not self.messages:
+                return
+            full = len(self.messages) >= self.batch_size
+            if full or time.time() - self.last_message_time >= self.flush_latency:
+                count = len(self.messages)
+                start = time.time()
+                if self._write_to_db():
+                    # Acknowledge the whole batch only once it is committed
+                    self.channel.basic_ack(delivery_tag=self.last_delivery_tag, multiple=True)
+                    self._adapt_batch_size(full, count, time.time() - start)
+                else:
+                    # Hand the batch back to the broker so no line is lost
+                    self.channel.basic_nack(delivery_tag=self.last_delivery_tag, multiple=True, requeue=True)
+                    time.sleep(1)
                 self.messages = []
+                self.last_delivery_tag = None
                 self.last_message_time = None
 
+    def _adapt_batch_size(self, full, count, flush_duration):
+        '''
+        Grows the batch while the backlog keeps filling it before the latency
+        target, and shrinks it when batches are mostly flushed by timeout or
+        a single write takes longer than the latency target.
+        '''
+        if flush_duration > self.flush_latency:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        elif full:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+        elif count < self.batch_size // 4:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+
     def _write_to_db(self):
-        # Implement the logic to write messages to the database
-        conn = None
+        # Borrow a connection from the pool shared with the Flask handlers
         try:
-            conn = psycopg2.connect(**self.db_config)
-            cur = conn.cursor()
-            query = sql.SQL("INSERT INTO logs (action_uid,service, time, log_text) VALUES (%s, %s, %s, %s)")
-            cur.executemany(query, [(msg['action_uid'],msg['service'], msg['time'], msg['log']) for msg in self.messages])
-            conn.commit()
-            cur.close()
-            print(f"Wrote {len(self.messages)} messages to the database.")
+            with self.db_pool.connection() as conn:
+                cur = conn.cursor()
+                copy_logs(cur, self.messages)
+                # Wake up live tail watchers; notifications are only delivered if the batch commits
+                for key in {f"{row[0]}/{row[1]}" for row in self.messages}:
+                    cur.execute("SELECT pg_notify(%s, %s)", (LOG_NOTIFY_CHANNEL, key))
+                conn.commit()
+                cur.close()
+            print(f"Wrote {len(self.messages)} messages to the database (batch size {self.batch_size}).")
+            return True
         except Exception as e:
             print(f"Failed to write to the database: {e}")
-        finally:
-            if conn is not None:
-                conn.close()
+            return False
 
     def close(self):
         self.running = False
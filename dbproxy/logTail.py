@@ -0,0 +1,142 @@
+import queue
+import select
+import threading
+import time
+import psycopg2
+from logQueue import LOG_NOTIFY_CHANNEL
+
+
+class Subscriber:
+    def __init__(self, key, max_pending=1000):
+        self.key = key
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.closed = False
+
+    def get(self, timeout):
+        '''
+        Waits for the next list of (id, time, log_text) rows.
+        :return: The rows, or None once the subscriber has been closed.
+        '''
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        '''
+        Marks the subscriber closed and wakes up a reader blocked in get().
+        '''
+        self.closed = True
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except queue.Full:
+                # Pending rows are not needed any more, the client reconnects from its last event id
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+class LogTail:
+    '''
+    Fans newly committed log lines out to live watchers.
+
+    LogQueue sends a NOTIFY with "<action_uid>/<service>" after each commit. A
+    single listener thread receives them and runs one query per notified key,
+    however many watchers that key has, then pushes the rows to each of them.
+    '''
+    def __init__(self, db_config, fetch_rows, reconnect_delay=5):
+        self.db_config = db_config
+        self.fetch_rows = fetch_rows  # fetch_rows(action_uid, service, after_time, after_id) -> [(id, time, log_text)]
+        self.reconnect_delay = reconnect_delay
+        self.keys = {}  # key -> {"subscribers": set, "cursor": (time, id) or None}
+        self.lock = threading.Lock()
+        self.running = True
+
+    def start(self):
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def subscribe(self, action_uid, service, cursor):
+        '''
+        Registers a watcher for an action/service.
+        :param cursor: The (time, id) of the newest line already in the database,
+                       used as the starting point when the key has no watchers yet.
+        :return: A Subscriber receiving every line committed after registration.
+        '''
+        key = (action_uid, service)
+        subscriber = Subscriber(key)
+        with self.lock:
+            entry = self.keys.setdefault(key, {"subscribers": set(), "cursor": cursor})
+            entry["subscribers"].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            entry = self.keys.get(subscriber.key)
+            if entry is None:
+                return
+            entry["subscribers"].discard(subscriber)
+            if not entry["subscribers"]:
+                del self.keys[subscriber.key]
+
+    def watcher_count(self):
+        with self.lock:
+            return sum(len(entry["subscribers"]) for entry in self.keys.values())
+
+    def _listen(self):
+        while self.running:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.db_config)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {LOG_NOTIFY_CHANNEL}")
+                print(f"Listening for log notifications on '{LOG_NOTIFY_CHANNEL}'", flush=True)
+                while self.running:
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    keys = set()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        action_uid, _, service = notify.payload.partition("/")
+                        keys.add((action_uid, service))
+                    for key in keys:
+                        self._dispatch(key)
+            except Exception as e:
+                print(f"Log tail listener failed: {e}", flush=True)
+                time.sleep(self.reconnect_delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _dispatch(self, key):
+        with self.lock:
+            entry = self.keys.get(key)
+            if entry is None:
+                return
+            cursor = entry["cursor"]
+
+        rows = []
+        while True:
+            after_time, after_id = cursor if cursor else (None, None)
+            page = self.fetch_rows(key[0], key[1], after_time, after_id)
+            if not page:
+                break
+            rows.extend(page)
+            cursor = (page[-1][1], page[-1][0])
+        if not rows:
+            return
+
+        with self.lock:
+            entry = self.keys.get(key)
+            if entry is None:
+                return
+            entry["cursor"] = cursor
+            subscribers = list(entry["subscribers"])
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(rows)
+            except queue.Full:
+                # Too slow to keep up: close it so the client reconnects from its last event id
+                subscriber.close()
+                self.unsubscribe(subscriber)
@@ -1,6 +1,8 @@
 from datetime import timedelta
 import io
+import shutil
 import subprocess
+import tempfile
 import time
 import jwt
 import redis
@@ -9,6 +11,8 @@ import os
 from jwt.exceptions import InvalidTokenError
 import requests
 from logQueue import LogQueue
+from jobs import JobRegistry
+from resourceUsage import StageUsage
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -19,7 +23,19 @@ log_queue_port = os.getenv("LOG_QUEUE_PORT", "5672")
 log_queue_name = os.getenv("LOG_QUEUE_NAME", "log-queue")
 
 # Initialize log queue with environment configuration
-log_queue = LogQueue(log_queue_host, log_queue_port, log_queue_name)
+log_queue = LogQueue(
+    log_queue_host, log_queue_port, log_queue_name,
+    batch_lines=int(os.getenv("LOG_BATCH_LINES", "200")),
+    batch_interval=int(os.getenv("LOG_BATCH_INTERVAL_MS", "500")) / 1000,
+    max_queued_lines=int(os.getenv("LOG_QUEUE_MAX_LINES", "50000")),
+    overflow=os.getenv("LOG_QUEUE_OVERFLOW", "block"),
+    spill_path=os.getenv("LOG_QUEUE_SPILL_PATH", "/tmp/log-queue-spill.jsonl"),
+    wire_format=os.getenv("LOG_WIRE_FORMAT", "frame"),
+    collapse_progress=os.getenv("LOG_COLLAPSE_PROGRESS", "true").lower() == "true"
+)
+
+# Deployments run as background jobs on a bounded thread pool
+jobs = JobRegistry("deployer", max_workers=int(os.getenv("JOB_WORKERS", "4")))
 
 def format_time(total_seconds):
     """
@@ -50,30 +66,53 @@ def format_time(total_seconds):
     
     return formatted_time
 
-@app.route("/api/v1/trigger-deploy", methods=["POST"])
-def trigger_scan():
+def read_cid(cid_file):
     """
-    Endpoint to trigger a deployment based on the status received in the request.
+    Returns the container id docker run wrote to its --cidfile, or None while it is not there yet.
+    """
+    try:
+        with open(cid_file) as cid:
+            return cid.read().strip() or None
+    except OSError:
+        return None
+
+def run_deploy(data):
+    """
+    Runs a deployment based on the status received in a trigger-deploy request payload.
     Logs the deployment process and updates deployment status in a database proxy.
 
+    Args:
+        data (dict): The request payload.
+
     Returns:
-        json: The status of the deployment process.
+        dict: The status of the deployment process.
     """
-    dbproxy_url = 'http://dbproxy:5000/api/v1/update-action'
-    action_uid = request.json.get("action_uid")
-    status = request.json.get("status")
-    image_tag = request.json.get("image_tag")
+    dbproxy_url = 'http://dbproxy:5000/api/v1/update-actions'
+    action_uid = data.get("action_uid")
+    status = data.get("status")
+    image_tag = data.get("image_tag")
     total_time_str = "N/A"
 
     if status == "OK":
         start_time = time.time()
+        usage = StageUsage(action_uid, "deploy")
         time.sleep(5)  # Simulate deployment preparation time
         
         try:
-            process = subprocess.Popen(["docker", "run", image_tag], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            for line in io.TextIOWrapper(process.stdout, encoding="utf-8"):
-                log_queue.send({"action_uid": action_uid, "service": "deployer", "time": time.time(), "log": line})
-                status = "OK"
+            # The container id is only known once docker run has created it
+            cid_dir = tempfile.mkdtemp()
+            cid_file = os.path.join(cid_dir, "cid")
+            try:
+                with usage.watch(lambda: read_cid(cid_file)):
+                    process = subprocess.Popen(["docker", "run", "--cidfile", cid_file, image_tag],
+                                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                    for line in io.TextIOWrapper(process.stdout, encoding="utf-8"):
+                        log_queue.send({"action_uid": action_uid, "service": "deployer", "time": time.time(), "log": line})
+                        status = "OK"
+                    process.wait()
+            finally:
+                shutil.rmtree(cid_dir, ignore_errors=True)
+            log_queue.flush(action_uid, "deployer")
         except subprocess.CalledProcessError as e:
             print(f"Deploy failed: {e}")
             status = "ERROR"
@@ -82,18 +121,50 @@ def trigger_scan():
         end_time = time.time()
         total_time = end_time - start_time
         total_time_str = format_time(total_time)
+        usage.report()
     else:
         status = "N/A"
 
     try:
         # Attempt to send deployment status to the database proxy
-        requests.post(dbproxy_url, json={"action_uid": action_uid, "status_name": "deployer_status", "status": status, "eta_name": "deployer_eta", "eta": total_time_str})
+        requests.post(dbproxy_url, json={"updates": [
+            {"action_uid": action_uid, "field": "deployer_status", "value": status},
+            {"action_uid": action_uid, "field": "deployer_eta", "value": total_time_str},
+        ]})
     except requests.exceptions.RequestException as e:
         print(f"Failed to update deployment status: {e}")
 
-    return jsonify({"status": status})
+    return {"status": status, "image_tag": image_tag}
+
+@app.route("/api/v1/trigger-deploy", methods=["POST"])
+def trigger_scan():
+    """
+    Endpoint to trigger a deployment as a background job.
+
+    Returns:
+        json: The job id (202); the finished job is POSTed to "callback_url" if given
+        and can be polled at /api/v1/jobs/<job_id>.
+    """
+    job = jobs.submit(run_deploy, request.json, request.json.get("callback_url"))
+    return jsonify({"job_id": job.id, "state": job.state, "status_url": f"/api/v1/jobs/{job.id}"}), 202
+
+@app.route("/api/v1/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    Reports the state of a deployment job and, once finished, its result.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/api/v1/log-queue-stats", methods=["GET"])
+def log_queue_stats():
+    """
+    Reports the publisher counters of the log queue (queued, published, dropped and spilled lines).
+    """
+    return jsonify(log_queue.get_stats())
 
 if __name__ == "__main__":
-    time.sleep(15)  # Wait for dependent services to be up
-    log_queue.connect()
+    log_queue.connect()  # Retries in the background until RabbitMQ is up
     app.run(debug=True, host="0.0.0.0")
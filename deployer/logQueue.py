@@ -1,42 +1,526 @@
+import atexit
+import collections
+import fcntl
+import glob
 import json
+import os
 import pika
+import re
+import struct
+import threading
+import time
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "spill")
+WIRE_FORMATS = ("json", "frame")
+# Content type of a binary log frame: one action_uid/service header shared by many lines
+LOG_FRAME_CONTENT_TYPE = "application/x-log-frame"
+_FRAME_HEADER = struct.Struct(">H")
+_FRAME_COUNT = struct.Struct(">I")
+_FRAME_LINE = struct.Struct(">dI")
+
+
+def encode_frame(batch):
+    '''
+    Encodes a batch as a log frame:
+    action_uid and service (each a uint16 length + UTF-8), a uint32 line count, then per line
+    a float64 time and a uint32 length + UTF-8 text. All integers are big-endian.
+    '''
+    parts = []
+    for value in (batch["action_uid"], batch["service"]):
+        encoded = value.encode("utf-8")
+        parts.append(_FRAME_HEADER.pack(len(encoded)))
+        parts.append(encoded)
+    parts.append(_FRAME_COUNT.pack(len(batch["lines"])))
+    for line in batch["lines"]:
+        encoded = line["log"].encode("utf-8")
+        parts.append(_FRAME_LINE.pack(line["time"], len(encoded)))
+        parts.append(encoded)
+    return b"".join(parts)
+
+# A line is a progress update if it carries a percentage, a byte size, an "n/m" counter or a spinner
+_PROGRESS_MARKER = re.compile(r"\d(\.\d+)?\s*(%|[kKMGT]?i?B\b)|\d+\s*/\s*\d+|[⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏]")
+_PROGRESS_NOISE = re.compile(r"\d+(\.\d+)?|\[[=>\-# ]*\]|[⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏|\\]|\s+")
+
+
+class ProgressFilter:
+    '''
+    Collapses the log stream of one action/service before it is batched.
+
+    Carriage-return redraws keep only their final state, consecutive progress updates
+    that differ only in numbers, bars or spinners are replaced by the last one, and
+    runs of identical lines are emitted once. The last line of a collapsed run is
+    annotated with how many lines it stands for, so the count is not lost.
+    '''
+    def __init__(self):
+        self.pending = None  # line held back until we know whether the next one replaces it
+        self.pending_since = None
+        self.progress_key = None
+        self.repeats = 0  # exact duplicates of the pending line
+        self.collapsed = 0  # earlier progress updates replaced by the pending line
+        self.suppressed = 0
+
+    @staticmethod
+    def _final_redraw(text):
+        body = text.rstrip("\r\n")
+        if "\r" not in body:
+            return text, 0
+        segments = [segment for segment in body.split("\r") if segment.strip()]
+        if not segments:
+            return text, 0
+        return segments[-1] + text[len(body):].replace("\r", ""), len(segments) - 1
+
+    @staticmethod
+    def _progress_key(text):
+        if not _PROGRESS_MARKER.search(text):
+            return None
+        return _PROGRESS_NOISE.sub("", text)
+
+    def feed(self, line):
+        '''
+        Takes the next line and returns the lines that can be published now.
+        '''
+        text, redraws = self._final_redraw(line["log"])
+        self.suppressed += redraws
+        line = {"time": line["time"], "log": text}
+        if self.pending is not None and text == self.pending["log"]:
+            self.repeats += 1
+            self.suppressed += 1
+            return []
+        key = self._progress_key(text)
+        if self.pending is not None and key is not None and key == self.progress_key:
+            self.collapsed += 1 + self.repeats
+            self.suppressed += 1 + self.repeats
+            self.repeats = 0
+            self.pending = line
+            return []
+        ready = self.drain()
+        self.pending, self.pending_since, self.progress_key = line, time.time(), key
+        return ready
+
+    def drain(self):
+        '''
+        Returns the held back line, annotated with the run it collapsed, if any.
+        '''
+        if self.pending is None:
+            return []
+        line = self.pending
+        notes = []
+        if self.collapsed:
+            notes.append(f"{self.collapsed} progress updates collapsed")
+        if self.repeats:
+            notes.append(f"repeated {self.repeats + 1} times")
+        if notes:
+            text = line["log"].rstrip("\n")
+            line = {"time": line["time"], "log": f"{text} [{', '.join(notes)}]" + line["log"][len(text):]}
+        self.pending, self.pending_since, self.progress_key = None, None, None
+        self.repeats = self.collapsed = 0
+        return [line]
+
 
 class LogQueue:
-    def __init__(self, host='localhost', port=5672, queue_name='log'):
+    '''
+    Publishes log lines to RabbitMQ from a dedicated I/O thread.
+
+    send() only buffers: lines are grouped per action/service into batches, and
+    ready batches go to a bounded in-memory queue drained by the publisher thread,
+    which owns the (not thread-safe) pika connection and waits for broker confirms.
+    When the queue is full, the overflow policy decides what happens:
+    "block" waits for room, "drop-oldest" discards the oldest queued batches and
+    "spill" appends batches to a file on disk that is replayed in order later.
+    While the broker is unreachable every batch is spilled, whatever the policy,
+    and the publisher reconnects with exponential backoff. Batches keep going to
+    the spool until it has been replayed, so lines are always published in order.
+    Spooled lines that cannot be decoded are moved to a ".corrupt" file.
+    Several processes may share a spool path, like the two processes of the
+    werkzeug reloader: appends are serialized with flock and a process claims
+    the spool for replay by renaming it to a name of its own, so every spooled
+    batch is replayed by exactly one of them.
+    '''
+    def __init__(self, host='localhost', port=5672, queue_name='log', batch_lines=200, batch_interval=0.5,
+                 max_queued_lines=50000, overflow="block", spill_path="/tmp/log-queue-spill.jsonl", wire_format="frame",
+                 collapse_progress=True, progress_hold=5):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of {OVERFLOW_POLICIES}")
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError(f"Unknown wire format '{wire_format}', expected one of {WIRE_FORMATS}")
         self.host = host
         self.port = port
         self.queue_name = queue_name
         self.connection = None
         self.channel = None
+        self.batch_lines = batch_lines  # publish once this many lines are buffered for an action/service
+        self.batch_interval = batch_interval  # seconds a buffered line may wait before being published
+        self.max_queued_lines = max_queued_lines
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.wire_format = wire_format
+        self.collapse_progress = collapse_progress
+        self.progress_hold = progress_hold  # seconds a collapsing line may be held back before it is published
+        self.filters = {}  # (action_uid, service) -> ProgressFilter
+        # Once spilling, later batches spill too so order is kept; a spill left by a previous run is replayed
+        self.spill_active = os.path.exists(spill_path) or bool(glob.glob(glob.escape(spill_path) + ".replay*"))
+        self.spill_file = None
+        self.connected = False
+        self.min_reconnect_delay = 0.5  # seconds, doubled after every failed attempt
+        self.max_reconnect_delay = 30
+        self.reconnect_delay = self.min_reconnect_delay
+        self.buffers = {}  # (action_uid, service) -> [{"time": ..., "log": ...}]
+        self.buffer_started = {}  # (action_uid, service) -> time of the oldest buffered line
+        self.outbound = collections.deque()  # batches waiting for the publisher thread, oldest first
+        self.queued_lines = 0
+        self.cond = threading.Condition()
+        self.stats = {
+            "enqueued_lines": 0,
+            "published_lines": 0,
+            "published_messages": 0,
+            "dropped_lines": 0,
+            "spilled_lines": 0,
+            "corrupt_spill_lines": 0,
+            "publish_failures": 0,
+            "reconnects": 0,
+            "suppressed_lines": 0,
+            "blocked_seconds": 0.0,
+        }
+        self.running = True
+        self.publisher = None
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+        atexit.register(self.close)
 
     def connect(self):
-        try:
-            self.connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=self.host, port=self.port, heartbeat=0)
-            )
-            self.channel = self.connection.channel()
-            self.channel.queue_declare(queue=self.queue_name, durable=True)
-            print(f"Connected to RabbitMQ on {self.host}:{self.port}, queue '{self.queue_name}'")
-        except pika.exceptions.AMQPConnectionError as error:
-            print(f"Failed to connect to RabbitMQ: {error}")
-            # Handle connection error (e.g., retry connection)
+        '''
+        Starts the publisher thread, which opens and owns the RabbitMQ connection.
+        '''
+        if self.publisher is None:
+            self.publisher = threading.Thread(target=self._publish_loop, daemon=True)
+            self.publisher.start()
+
+    def _open_channel(self):
+        self.connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=self.host, port=self.port, heartbeat=60)
+        )
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=self.queue_name, durable=True)
+        self.channel.confirm_delivery()
+        with self.cond:
+            self.connected = True
+            self.stats["reconnects"] += 1
+        self.reconnect_delay = self.min_reconnect_delay
+        print(f"Connected to RabbitMQ on {self.host}:{self.port}, queue '{self.queue_name}'")
 
+    def _close_channel(self):
+        with self.cond:
+            self.connected = False
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+        self.connection = None
+        self.channel = None
 
     def send(self, message):
-        if self.channel is not None:
-            message_str = json.dumps(message)
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=self.queue_name,
-                body=message_str.encode('utf-8'),  # Ensure message is in bytes
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # Make message persistent
-                )
-            )
+        '''
+        Buffers a log line; lines of the same action and service are published together
+        as one message once batch_lines are buffered or batch_interval has elapsed.
+        With collapse_progress, the line first goes through the ProgressFilter of its action/service.
+        :param message: Dict with action_uid, service, time and log.
+        '''
+        key = (message["action_uid"], message["service"])
+        line = {"time": message["time"], "log": message["log"]}
+        with self.cond:
+            if not self.collapse_progress:
+                self._buffer_line(key, line)
+                return
+            progress_filter = self.filters.setdefault(key, ProgressFilter())
+            suppressed = progress_filter.suppressed
+            for ready in progress_filter.feed(line):
+                self._buffer_line(key, ready)
+            self.stats["suppressed_lines"] += progress_filter.suppressed - suppressed
+
+    def _buffer_line(self, key, line):
+        # Caller holds self.cond
+        buffer = self.buffers.setdefault(key, [])
+        if not buffer:
+            self.buffer_started[key] = time.time()
+        buffer.append(line)
+        if len(buffer) >= self.batch_lines or time.time() - self.buffer_started[key] >= self.batch_interval:
+            self._enqueue_buffer(key)
+
+    def _drain_filter(self, key):
+        # Caller holds self.cond; the filter is dropped so finished actions do not accumulate state
+        progress_filter = self.filters.pop(key, None)
+        if progress_filter is not None:
+            for line in progress_filter.drain():
+                self._buffer_line(key, line)
+
+    def flush(self, action_uid=None, service=None):
+        '''
+        Queues the buffered lines of one action/service, or of all of them when called without arguments.
+        '''
+        with self.cond:
+            keys = [(action_uid, service)] if action_uid is not None else list(set(self.buffers) | set(self.filters))
+            for key in keys:
+                self._drain_filter(key)
+                self._enqueue_buffer(key)
+
+    def _flush_periodically(self):
+        while self.running:
+            time.sleep(self.batch_interval)
+            with self.cond:
+                now = time.time()
+                # Lines held back by a filter for too long are released, so live tails stay current
+                for key in [key for key, progress_filter in self.filters.items()
+                            if progress_filter.pending_since is not None and now - progress_filter.pending_since >= self.progress_hold]:
+                    self._drain_filter(key)
+                for key in [key for key, started in self.buffer_started.items() if now - started >= self.batch_interval]:
+                    self._enqueue_buffer(key)
+
+    def _enqueue_buffer(self, key):
+        # Caller holds self.cond
+        lines = self.buffers.pop(key, None)
+        self.buffer_started.pop(key, None)
+        if lines:
+            self._enqueue({"action_uid": key[0], "service": key[1], "lines": lines})
+
+    def _enqueue(self, batch):
+        # Caller holds self.cond
+        count = len(batch["lines"])
+        self.stats["enqueued_lines"] += count
+        full = self.queued_lines + count > self.max_queued_lines and self.queued_lines > 0
+        # Newer lines must not overtake spooled ones, so nothing bypasses the spool until it is replayed
+        if not self.connected or self.spill_active or (self.overflow == "spill" and full):
+            self._spill(batch)
+            return
+        if self.overflow == "block" and full:
+            start = time.time()
+            while self.queued_lines + count > self.max_queued_lines and self.queued_lines > 0 and self.running:
+                self.cond.wait(1)
+            self.stats["blocked_seconds"] += time.time() - start
+        elif self.overflow == "drop-oldest":
+            while self.queued_lines + count > self.max_queued_lines and self.outbound:
+                dropped = self.outbound.popleft()
+                self.queued_lines -= len(dropped["lines"])
+                self.stats["dropped_lines"] += len(dropped["lines"])
+        self.outbound.append(batch)
+        self.queued_lines += count
+        self.cond.notify_all()
+
+    def _open_spill(self):
+        # Caller holds self.cond. Returns the spool file locked against other processes, reopening it
+        # if another process claimed it for replay since it was opened here.
+        while True:
+            fresh = self.spill_file is None
+            if fresh:
+                self.spill_file = open(self.spill_path, "a", encoding="utf-8")
+            fcntl.flock(self.spill_file, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.spill_path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(self.spill_file.fileno()).st_ino:
+                break
+            fcntl.flock(self.spill_file, fcntl.LOCK_UN)
+            self.spill_file.close()
+            self.spill_file = None
+        if fresh and os.path.getsize(self.spill_path):
+            with open(self.spill_path, "rb") as spilled:
+                spilled.seek(-1, os.SEEK_END)
+                if spilled.read(1) != b"\n":
+                    # A line cut off by a crash mid-write must not swallow the next batch
+                    self.spill_file.write("\n")
+        return self.spill_file
+
+    def _spill(self, batch):
+        # Caller holds self.cond; the spool file stays open between batches, it is append-only
+        try:
+            spill_file = self._open_spill()
+            try:
+                spill_file.write(json.dumps(batch) + "\n")
+                spill_file.flush()
+            finally:
+                fcntl.flock(spill_file, fcntl.LOCK_UN)
+        except OSError as error:
+            self.stats["dropped_lines"] += len(batch["lines"])
+            print(f"Failed to spill logs, dropping {len(batch['lines'])} lines: {error}")
+            return
+        self.spill_active = True
+        self.stats["spilled_lines"] += len(batch["lines"])
+        self.cond.notify_all()
+
+    def _publish_loop(self):
+        while self.running or self.outbound:
+            if self.channel is None:
+                try:
+                    self._open_channel()
+                except Exception as error:
+                    print(f"Failed to connect to RabbitMQ, retrying in {self.reconnect_delay}s: {error}")
+                    self._backoff()
+                    continue
+            with self.cond:
+                if not self.outbound and not self.spill_active and self.running:
+                    self.cond.wait(1)
+                batch = self.outbound[0] if self.outbound else None
+                replay = batch is None and self.spill_active
+            try:
+                if batch is not None:
+                    self._publish(batch)
+                    with self.cond:
+                        # drop-oldest may already have discarded it while it was being published
+                        if self.outbound and self.outbound[0] is batch:
+                            self.outbound.popleft()
+                            self.queued_lines -= len(batch["lines"])
+                        self.cond.notify_all()
+                elif replay:
+                    self._replay_spill()
+                else:
+                    # Keeps heartbeats flowing while idle
+                    self.connection.process_data_events(time_limit=0)
+            except pika.exceptions.AMQPError as error:
+                with self.cond:
+                    self.stats["publish_failures"] += 1
+                print(f"Failed to publish logs, reconnecting: {error!r}")
+                self._close_channel()
+                self._backoff()
+            except Exception as error:
+                # Anything else must not end the only publisher thread, or send() would block for good
+                with self.cond:
+                    self.stats["publish_failures"] += 1
+                    if batch is not None and self.outbound and self.outbound[0] is batch:
+                        # A batch that cannot be encoded would fail again on every attempt
+                        self.outbound.popleft()
+                        self.queued_lines -= len(batch["lines"])
+                        self.stats["dropped_lines"] += len(batch["lines"])
+                    self.cond.notify_all()
+                print(f"Log publisher error: {error!r}")
+                time.sleep(self.min_reconnect_delay)
+        self._close_channel()
+
+    def _backoff(self):
+        time.sleep(self.reconnect_delay)
+        self.reconnect_delay = min(self.reconnect_delay * 2, self.max_reconnect_delay)
+
+    def _publish(self, batch):
+        # Raises NackError/UnroutableError if the broker does not confirm the message
+        if self.wire_format == "frame":
+            body, content_type = encode_frame(batch), LOG_FRAME_CONTENT_TYPE
         else:
-            print("RabbitMQ channel is not established. Message not sent.")
+            body, content_type = json.dumps(batch).encode('utf-8'), "application/json"
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=self.queue_name,
+            body=body,
+            properties=pika.BasicProperties(
+                content_type=content_type,  # Tells the consumer how to decode the body
+                delivery_mode=2,  # Make message persistent
+            )
+        )
+        with self.cond:
+            self.stats["published_messages"] += 1
+            self.stats["published_lines"] += len(batch["lines"])
+
+    @staticmethod
+    def _process_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _claim_spill(self, replay_path):
+        '''
+        Moves a spool to replay into this process's replay file: the replay file of a process
+        that is gone first, then the spool itself. Renames are atomic, so of several processes
+        sharing the spool only one gets each file.
+        :return: Whether there was a spool to replay.
+        '''
+        prefix = self.spill_path + ".replay"
+        for path in glob.glob(glob.escape(prefix) + "*"):
+            owner = path[len(prefix) + 1:]
+            if owner.isdigit() and self._process_alive(int(owner)):
+                continue
+            try:
+                os.rename(path, replay_path)
+                return True
+            except FileNotFoundError:
+                continue  # claimed by another process
+        try:
+            spool = open(self.spill_path, "rb")
+        except FileNotFoundError:
+            return False
+        with spool:
+            # Waits for an append in progress; appenders notice the rename and start a new spool
+            fcntl.flock(spool, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.spill_path).st_ino != os.fstat(spool.fileno()).st_ino:
+                    return True  # claimed by another process meanwhile, look again next round
+                os.rename(self.spill_path, replay_path)
+            except FileNotFoundError:
+                return True
+        return True
+
+    def _replay_spill(self):
+        '''
+        Publishes spilled batches in order. Batches spilled meanwhile are appended to a fresh
+        spill file and replayed in the next round; spilling stops once no file is left.
+        Lines that cannot be decoded are set aside in the ".corrupt" file instead of blocking the replay.
+        '''
+        replay_path = f"{self.spill_path}.replay.{os.getpid()}"
+        with self.cond:
+            if not os.path.exists(replay_path):
+                if self.spill_file is not None:
+                    self.spill_file.close()
+                    self.spill_file = None
+                if not self._claim_spill(replay_path):
+                    self.spill_active = False
+                    return
+                if not os.path.exists(replay_path):
+                    return
+        with open(replay_path, encoding="utf-8") as replay:
+            pending = replay.readlines()
+        for index, line in enumerate(pending):
+            if not line.strip():
+                continue
+            try:
+                self._publish(json.loads(line))
+            except pika.exceptions.AMQPError:
+                # Keep what is left for the next attempt
+                with open(replay_path, "w", encoding="utf-8") as replay:
+                    replay.writelines(pending[index:])
+                raise
+            except (ValueError, KeyError, TypeError, AttributeError, struct.error) as error:
+                self._quarantine(line, error)
+        os.remove(replay_path)
+
+    def _quarantine(self, line, error):
+        with self.cond:
+            self.stats["corrupt_spill_lines"] += 1
+        print(f"Skipping unreadable spilled batch: {error!r}")
+        try:
+            with open(self.spill_path + ".corrupt", "a", encoding="utf-8") as corrupt:
+                corrupt.write(line if line.endswith("\n") else line + "\n")
+        except OSError as write_error:
+            print(f"Failed to keep unreadable spilled batch: {write_error}")
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats["queued_lines"] = self.queued_lines
+            stats["buffered_lines"] = sum(len(lines) for lines in self.buffers.values())
+            stats["spill_active"] = self.spill_active
+            stats["overflow"] = self.overflow
+            stats["connected"] = self.connected
+        return stats
 
-    def close(self):
-        if self.connection and self.connection.is_open:
-            self.connection.close()
-            print("RabbitMQ connection closed.")
\ No newline at end of file
+    def close(self, timeout=10):
+        '''
+        Flushes buffered lines and waits up to timeout seconds for the publisher to drain the queue.
+        '''
+        self.flush()
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+        if self.publisher is not None and self.publisher.is_alive():
+            self.publisher.join(timeout)
+            print("RabbitMQ connection closed.")
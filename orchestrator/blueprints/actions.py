@@ -45,24 +45,52 @@ def log_action_to_db(app, action_info):
     except requests.RequestException as e:
         print(f"Communication with dbproxy failed: {str(e)}")
 
+# Service name of each pipeline stage, as used in the actions table columns
+STAGE_SERVICES = {"build": "builder", "scan": "scanner", "deploy": "deployer", "test": "tester"}
+
+def update_action_fields(updates):
+    """
+    Applies several action field updates through a single dbproxy batch request.
+
+    :param updates: List of dicts with action_uid, field and value.
+    """
+    dbproxy_url = 'http://dbproxy:5000/api/v1/update-actions'
+    try:
+        response = requests.post(dbproxy_url, json={"updates": updates})
+        if response.status_code != 200:
+            print(f"Failed to update actions in dbproxy: {response.text}", flush=True)
+    except requests.RequestException as e:
+        print(f"Communication with dbproxy failed: {str(e)}", flush=True)
+
+# Stage services POST finished jobs here; pipelines advance from these callbacks
+JOB_CALLBACK_URL = os.getenv("JOB_CALLBACK_URL", "http://orchestrator:5000/api/v1/jobs/callback")
+# Seconds after which a stage job that has not called back is polled instead
+JOB_POLL_INTERVAL = int(os.getenv("JOB_POLL_INTERVAL", "60"))
+
+# In-flight pipelines by action_uid, each waiting on the job of its current stage
+pipelines = {}
+pipelines_lock = threading.Lock()
+
+def stage_url(action_type):
+    return f'http://{STAGE_SERVICES[action_type]}:5000'
+
 def start_action(action_type, resp, repo_name, auth_token, jwt_token, action_uid, username, git_repo_url):
     """
-    Starts a specified action for a repository.
+    Submits a specified action for a repository as a job of its stage service.
 
     :param action_type: The type of action to start (build, scan, deploy, test).
-    :param resp: The response status from the previous action.
+    :param resp: The result of the previous action.
     :param repo_name: The name of the repository.
     :param auth_token: OAuth token for authentication.
     :param jwt_token: JWT token for user identification.
     :param action_uid: Unique identifier for the action.
     :param username: Username of the user initiating the action.
-    :return: Status of the action triggered.
+    :return: The accepted job ({"job_id": ...}), or a dict with a non-OK "status" if it was not accepted.
     """
     print(f"Starting action {action_type}", flush=True)
     print(f"action_uid : {action_uid}", flush=True)
 
-    # Adjust URL based on action type
-    url = f'http://{action_type}er:5000/api/v1/trigger-{action_type}' if action_type != "scan" else f'http://scanner:5000/api/v1/trigger-scan'
+    url = f'{stage_url(action_type)}/api/v1/trigger-{action_type}'
     
     data = {
         "repo_name": repo_name,
@@ -72,27 +100,151 @@ def start_action(action_type, resp, repo_name, auth_token, jwt_token, action_uid
         "username": username,
         "status": resp.get("status"),
         "git_repo_url": git_repo_url,
-        "image_tag": resp.get("image_tag")
+        "image_tag": resp.get("image_tag"),
+        "callback_url": JOB_CALLBACK_URL
     }
     
-    response = requests.post(url, json=data)
+    try:
+        response = requests.post(url, json=data, timeout=30)
+    except requests.RequestException as e:
+        print(f"Communication with {STAGE_SERVICES[action_type]} failed: {str(e)}", flush=True)
+        return {"status": "ERROR"}
+    if response.status_code != 202:
+        print(f"{action_type.capitalize()} not accepted ({response.status_code}): {response.text}", flush=True)
+        return {"status": "REJECTED" if response.status_code == 429 else "ERROR"}
     return response.json()
 
-def start_process(repo_name, auth_token, jwt_token, action_uid, username, git_repo_url):
+def skip_stages(action_uid, stages):
+    # Record all skipped stages in one write instead of one call per stage
+    if stages:
+        update_action_fields([
+            {"action_uid": action_uid, "field": f"{STAGE_SERVICES[stage]}_{column}", "value": "N/A"}
+            for stage in stages for column in ("status", "eta")
+        ])
+
+def advance_pipeline(action_uid, resp):
     """
-    Starts the full process for a repository action (build, scan, deploy, test).
+    Submits the next stage of a pipeline, or ends the pipeline after its last stage.
+    Stages that cannot be submitted end the pipeline like a failed stage.
+
+    :param action_uid: Unique identifier for the action.
+    :param resp: The result of the previous stage, or the initial {"status": "OK"}.
+    """
+    with pipelines_lock:
+        pipeline = pipelines.get(action_uid)
+        if pipeline is None:
+            return
+        if resp.get("image_tag"):
+            pipeline["image_tag"] = resp["image_tag"]
+        if pipeline["index"] >= len(pipeline["stages"]):
+            del pipelines[action_uid]
+            print(f"Pipeline {action_uid} finished", flush=True)
+            return
+        stage = pipeline["stages"][pipeline["index"]]
+        pipeline["index"] += 1
+        pipeline.update(stage=stage, submitting=True, early={})
+
+    resp = dict(resp, image_tag=pipeline["image_tag"])
+    job = start_action(stage, resp, *pipeline["args"])
+    if "job_id" in job:
+        with pipelines_lock:
+            pipeline.update(job_id=job["job_id"], submitted_at=time.time(), submitting=False)
+            early = pipeline["early"].pop(job["job_id"], None)
+        if early is not None:
+            complete_stage(early)
+        return
+    with pipelines_lock:
+        pipelines.pop(action_uid, None)
+    if job.get("status") == "ERROR":
+        # The stage never ran, record it as failed (a rejected build records itself)
+        update_action_fields([{"action_uid": action_uid, "field": f"{STAGE_SERVICES[stage]}_status", "value": "ERROR"}])
+    skip_stages(action_uid, pipeline["stages"][pipeline["index"]:])
+    print(f"Skipped stages after unaccepted {stage}", flush=True)
+
+def complete_stage(job):
+    """
+    Handles a finished stage job, from its callback or from polling: advances the
+    pipeline when the stage succeeded and skips the remaining stages otherwise.
+    Each job is handled once, later deliveries of the same job are ignored.
+
+    :param job: The job state reported by the stage service.
+    """
+    action_uid = job.get("action_uid")
+    with pipelines_lock:
+        pipeline = pipelines.get(action_uid)
+        if pipeline is not None and pipeline["submitting"]:
+            # Called back before the submit returned its job id; handled once the id is known
+            pipeline["early"][job.get("job_id")] = job
+            return False
+        if pipeline is None or pipeline.get("job_id") != job.get("job_id"):
+            return False
+        pipeline["job_id"] = None
+        stage = pipeline["stage"]
+
+    resp = job.get("result") or {"status": "ERROR"}
+    print(f"{stage.capitalize()} response: {resp}", flush=True)
+    if resp.get("status") == "OK":
+        advance_pipeline(action_uid, resp)
+        return True
+    with pipelines_lock:
+        pipelines.pop(action_uid, None)
+    skipped = pipeline["stages"][pipeline["index"]:]
+    skip_stages(action_uid, skipped)
+    print(f"Skipped stages after failed {stage}: {skipped}", flush=True)
+    return True
+
+def poll_stale_jobs():
+    """
+    Polls the stage jobs that have not called back within JOB_POLL_INTERVAL seconds,
+    so a lost callback does not stall its pipeline. Jobs unknown to their service
+    (e.g. after a restart) are treated as failed.
+    """
+    while True:
+        time.sleep(JOB_POLL_INTERVAL)
+        cutoff = time.time() - JOB_POLL_INTERVAL
+        with pipelines_lock:
+            stale = [(action_uid, pipeline["stage"], pipeline["job_id"]) for action_uid, pipeline in pipelines.items()
+                     if pipeline.get("job_id") and pipeline["submitted_at"] < cutoff]
+        for action_uid, stage, job_id in stale:
+            try:
+                response = requests.get(f'{stage_url(stage)}/api/v1/jobs/{job_id}', timeout=10)
+            except requests.RequestException as e:
+                print(f"Polling job {job_id} failed: {str(e)}", flush=True)
+                continue
+            if response.status_code == 404:
+                update_action_fields([{"action_uid": action_uid, "field": f"{STAGE_SERVICES[stage]}_status", "value": "ERROR"}])
+                complete_stage({"job_id": job_id, "action_uid": action_uid, "state": "failed", "result": None})
+            elif response.ok and response.json().get("state") in ("finished", "failed"):
+                complete_stage(response.json())
+
+threading.Thread(target=poll_stale_jobs, daemon=True).start()
+
+def start_process(repo_name, auth_token, jwt_token, action_uid, username, git_repo_url, stages=None, image_tag=None):
+    """
+    Starts the process for a repository action: its stages run one after the other
+    (build, scan, deploy, test by default), each started when the previous one calls back.
 
     :param repo_name: The name of the repository.
     :param auth_token: OAuth token for authentication.
     :param jwt_token: JWT token for user identification.
     :param action_uid: Unique identifier for the action.
     :param username: Username of the user initiating the action.
+    :param stages: The stages to run, in order.
+    :param image_tag: Image to use when the stages do not include a build.
     """
-    actions = ["build", "scan", "deploy", "test"]
-
-    for action in actions:
-        resp = start_action(action, resp if action != "build" else {"status" : "OK"}, repo_name, auth_token, jwt_token, action_uid, username, git_repo_url)
-        print(f"{action.capitalize()} response: {resp}", flush=True)
+    with pipelines_lock:
+        pipelines[action_uid] = {
+            "stages": stages or ["build", "scan", "deploy", "test"],
+            "index": 0,
+            "args": (repo_name, auth_token, jwt_token, action_uid, username, git_repo_url),
+            "image_tag": image_tag,
+            "job_id": None,
+            "stage": None,
+            "submitted_at": None,
+            "submitting": False,
+            "early": {},
+        }
+    advance_pipeline(action_uid, {"status": "OK"})
 
 def trigger_build_action(repo_name, auth_token, jwt_token, action_uid, username, action_type, git_repo_url):
     """
@@ -111,7 +263,8 @@ def trigger_build_action(repo_name, auth_token, jwt_token, action_uid, username,
         start_process(repo_name, auth_token, jwt_token, action_uid, username, git_repo_url)
     else:
         print(f"{action_type.capitalize()} triggered")
-        start_action(action_type, {"status" : "OK", "image_tag":f"{repo_name}_image:latest".lower()}, repo_name, auth_token, jwt_token, action_uid, username, git_repo_url)
+        start_process(repo_name, auth_token, jwt_token, action_uid, username, git_repo_url,
+                      stages=[action_type], image_tag=f"{repo_name}_image:latest".lower())
 
 def trigger_async_action(action_type, repo_name, auth_token, jwt_token, username):
     """
@@ -199,3 +352,24 @@ def trigger_action():
     # Trigger the action asynchronously
     message, status_code = trigger_async_action(action_type, repo_name, auth_token, jwt_token, username)
     return jsonify(message), status_code
+
+@actions_bp.route("/api/v1/jobs/callback", methods=["POST"])
+def job_callback():
+    """
+    Receives the final state of a stage job and advances its pipeline.
+    """
+    job = request.get_json(silent=True)
+    if not isinstance(job, dict) or not job.get("job_id"):
+        return jsonify({"error": "Invalid job"}), 400
+    threading.Thread(target=complete_stage, args=(job,)).start()
+    return jsonify({"message": "Job received"}), 200
+
+@actions_bp.route("/api/v1/pipelines", methods=["GET"])
+def list_pipelines():
+    """Lists the in-flight pipelines and the stage job each one is waiting on."""
+    with pipelines_lock:
+        return jsonify({
+            action_uid: {"stage": pipeline["stage"], "job_id": pipeline["job_id"], "submitted_at": pipeline["submitted_at"],
+                         "remaining": pipeline["stages"][pipeline["index"]:]}
+            for action_uid, pipeline in pipelines.items()
+        }), 200
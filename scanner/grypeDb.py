@@ -0,0 +1,153 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Name of the symlink pointing at the active DB directory, so a restart keeps using it
+CURRENT_LINK = "current"
+# Prefix of the versioned DB directories managed here; only these are ever deleted
+VERSION_PREFIX = "db-"
+
+
+class GrypeDatabase:
+    """
+    Keeps grype's vulnerability DB downloaded ahead of scans.
+
+    Scans run with GRYPE_DB_AUTO_UPDATE=false so none of them checks for or
+    downloads a DB; warm() loads it once at startup and start() refreshes it on
+    a schedule. A refresh downloads into a fresh staging directory without any
+    lock held, then makes it the active directory in a short critical section.
+    Each scan pins the directory that was active when it started, and a replaced
+    directory is deleted once its last scan is done, so no scan ever waits for
+    an update and no DB files are swapped under a running scan.
+    """
+    def __init__(self, cache_dir, refresh_interval=6 * 3600, on_update=None):
+        self.cache_dir = cache_dir
+        self.refresh_interval = refresh_interval  # seconds
+        self.on_update = on_update
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()  # one download at a time
+        self.readers = {}  # DB directory -> number of scans using it
+        self.retired = set()  # replaced DB directories still used by scans
+        os.makedirs(cache_dir, exist_ok=True)
+        link = os.path.join(cache_dir, CURRENT_LINK)
+        # Without a link, a DB downloaded straight into cache_dir by earlier versions is used until the first refresh
+        self.active = os.path.realpath(link) if os.path.islink(link) else cache_dir
+        # Staging directories of an interrupted refresh
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name.startswith(VERSION_PREFIX) and path != self.active:
+                self._remove(path)
+        self.stats = {"refreshes": 0, "refresh_failures": 0, "last_refresh": None, "last_refresh_duration": None}
+
+    def env(self, db_dir=None):
+        """
+        Returns the environment running grype against a DB directory, the active one by default.
+        """
+        return dict(os.environ, GRYPE_DB_AUTO_UPDATE="false", GRYPE_DB_CACHE_DIR=db_dir or self.active)
+
+    @contextmanager
+    def reading(self):
+        """
+        Pins the active DB directory for the duration of a scan and yields the environment to run grype with.
+        """
+        with self.lock:
+            db_dir = self.active
+            self.readers[db_dir] = self.readers.get(db_dir, 0) + 1
+        try:
+            yield self.env(db_dir)
+        finally:
+            with self.lock:
+                self.readers[db_dir] -= 1
+                done = not self.readers[db_dir]
+                if done:
+                    del self.readers[db_dir]
+                remove = done and db_dir in self.retired
+                if remove:
+                    self.retired.discard(db_dir)
+            if remove:
+                self._remove(db_dir)
+
+    def _run(self, *args, db_dir=None):
+        return subprocess.run(["grype", "db", *args], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                              env=self.env(db_dir))
+
+    @staticmethod
+    def _remove(db_dir):
+        if os.path.basename(db_dir).startswith(VERSION_PREFIX):
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+    def _activate(self, db_dir):
+        # Points the link at the new directory with an atomic rename, then retires the old one
+        link = os.path.join(self.cache_dir, CURRENT_LINK)
+        staged_link = link + ".new"
+        if os.path.lexists(staged_link):
+            os.remove(staged_link)
+        os.symlink(os.path.basename(db_dir), staged_link)
+        os.replace(staged_link, link)
+        with self.lock:
+            previous, self.active = self.active, db_dir
+            remove = previous not in self.readers
+            if not remove:
+                self.retired.add(previous)
+        if remove:
+            self._remove(previous)
+
+    def refresh(self, force=False):
+        """
+        Downloads a newer DB, if there is one, into a staging directory and makes it active.
+        Running and new scans keep going meanwhile; only scans started after the switch use the new DB.
+        :return: Whether a DB is available afterwards.
+        """
+        with self.refresh_lock:
+            start_time = time.time()
+            if not force:
+                check = self._run("check")
+                if check.returncode == 0 and "no update available" in check.stdout.lower():
+                    self.stats["last_refresh"] = time.time()
+                    return True
+            staging = tempfile.mkdtemp(prefix=VERSION_PREFIX, dir=self.cache_dir)
+            result = self._run("update", db_dir=staging)
+            self.stats["last_refresh_duration"] = time.time() - start_time
+            if result.returncode != 0 or self._run("status", db_dir=staging).returncode != 0:
+                shutil.rmtree(staging, ignore_errors=True)
+                self.stats["refresh_failures"] += 1
+                print(f"Vulnerability DB update failed: {result.stdout.strip()}", flush=True)
+                return self._run("status").returncode == 0
+            self._activate(staging)
+            self.stats["refreshes"] += 1
+            self.stats["last_refresh"] = time.time()
+            print(f"Vulnerability DB refreshed: {result.stdout.strip()}", flush=True)
+        if self.on_update is not None:
+            self.on_update()
+        return True
+
+    def warm(self):
+        """
+        Makes sure a valid DB is present before the first scan, downloading one if needed.
+        """
+        if self._run("status").returncode == 0:
+            print("Vulnerability DB present", flush=True)
+            return True
+        return self.refresh(force=True)
+
+    def start(self):
+        def loop():
+            while True:
+                time.sleep(self.refresh_interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Vulnerability DB refresh failed: {e}", flush=True)
+        threading.Thread(target=loop, daemon=True).start()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        with self.lock:
+            stats["active_dir"] = self.active
+            stats["scans_running"] = sum(self.readers.values())
+            stats["retired_dirs"] = len(self.retired)
+        return stats
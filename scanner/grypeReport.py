@@ -0,0 +1,84 @@
+import json
+
+# Column widths of the findings table written to the scan logs
+TABLE_COLUMNS = (("NAME", 30), ("INSTALLED", 20), ("FIXED-IN", 20), ("TYPE", 10), ("VULNERABILITY", 20), ("SEVERITY", 0))
+
+
+def iter_matches(stream, chunk_size=64 * 1024):
+    """
+    Yields the entries of the "matches" array of a grype JSON report as they are read,
+    so findings can be handled before grype has finished writing the whole report.
+
+    :param stream: Text stream of the report (e.g. grype's stdout).
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    # Skip to the opening bracket of the matches array, the first key grype writes
+    while True:
+        key = buffer.find('"matches"')
+        bracket = buffer.find("[", key) if key >= 0 else -1
+        if bracket >= 0:
+            buffer = buffer[bracket + 1:]
+            break
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        # Keep a tail in case the key is split across chunks
+        buffer = buffer[-len('"matches"'):] + chunk if key < 0 else buffer + chunk
+
+    eof = False
+    while True:
+        buffer = buffer.lstrip(" \t\r\n,")
+        if buffer.startswith("]"):
+            return
+        if buffer:
+            try:
+                match, end = decoder.raw_decode(buffer)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                yield match
+                buffer = buffer[end:]
+                continue
+        elif eof:
+            raise ValueError("grype report ended inside the matches array")
+        chunk = stream.read(chunk_size)
+        if chunk:
+            buffer += chunk
+        else:
+            eof = True
+
+
+def finding_from_match(match):
+    """
+    Flattens a grype match into a finding row (package, version, vulnerability, severity, fix version).
+    """
+    vulnerability = match.get("vulnerability", {})
+    artifact = match.get("artifact", {})
+    fix_versions = vulnerability.get("fix", {}).get("versions") or []
+    return {
+        "vulnerability_id": vulnerability.get("id"),
+        "severity": vulnerability.get("severity") or "Unknown",
+        "package_name": artifact.get("name"),
+        "package_version": artifact.get("version"),
+        "package_type": artifact.get("type"),
+        "fix_version": fix_versions[0] if fix_versions else None,
+    }
+
+
+def table_header():
+    return "".join(name.ljust(width) for name, width in TABLE_COLUMNS).rstrip() + "\n"
+
+
+def format_finding(finding):
+    values = (finding["package_name"], finding["package_version"], finding["fix_version"] or "",
+              finding["package_type"], finding["vulnerability_id"], finding["severity"])
+    return "".join(str(value or "").ljust(width) for value, (_, width) in zip(values, TABLE_COLUMNS)).rstrip() + "\n"
+
+
+def severity_counts(findings):
+    counts = {}
+    for finding in findings:
+        counts[finding["severity"]] = counts.get(finding["severity"], 0) + 1
+    return counts
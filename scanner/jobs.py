@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+JOB_STATES = ("queued", "running", "finished", "failed")
+
+
+class Job:
+    def __init__(self, service, key, callback_url):
+        self.id = str(uuid.uuid4())
+        self.service = service
+        self.key = key  # action_uid the job belongs to
+        self.callback_url = callback_url
+        self.state = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.callback_delivered = False
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "service": self.service,
+            "action_uid": self.key,
+            "state": self.state,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobRegistry:
+    """
+    Runs stage jobs in the background and keeps their state for the job-status endpoint.
+
+    submit() returns at once with the job; the job runs on the executor (a bounded
+    thread pool unless one is given) and, when it ends, its state is POSTed to the
+    callback URL with a few retries. Callbacks are delivered by a separate thread,
+    so a finished job frees its executor slot at once even if the callback target
+    is unreachable. Finished jobs are forgotten after retention seconds, so callers
+    that missed the callback can still poll them until then.
+    """
+    def __init__(self, service, executor=None, max_workers=4, retention=3600, callback_retries=5):
+        self.service = service
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=max_workers)
+        self.retention = retention
+        self.callback_retries = callback_retries
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.deliveries = []  # heap of (due time, sequence, attempt, job)
+        self.sequence = itertools.count()
+        self.delivery_cond = threading.Condition()
+        threading.Thread(target=self._deliver, name=f"{service}-callbacks", daemon=True).start()
+
+    def submit(self, fn, payload, callback_url=None, **options):
+        """
+        Schedules fn(payload) as a new job.
+        :param options: Passed on to the executor's submit, e.g. a priority.
+        :return: The Job. Exceptions raised by the executor (such as a full queue) propagate.
+        """
+        job = Job(self.service, payload.get("action_uid"), callback_url)
+        with self.lock:
+            self._expire()
+            self.jobs[job.id] = job
+        try:
+            self.executor.submit(self._run, job, fn, payload, **options)
+        except Exception:
+            with self.lock:
+                del self.jobs[job.id]
+            raise
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _expire(self):
+        cutoff = time.time() - self.retention
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    def _run(self, job, fn, payload):
+        job.state = "running"
+        job.started_at = time.time()
+        try:
+            job.result = fn(payload)
+            job.state = "finished"
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}", flush=True)
+            job.error = str(e)
+            job.state = "failed"
+        job.finished_at = time.time()
+        if job.callback_url:
+            self._schedule_callback(job, 0, job.finished_at)
+        return job.result
+
+    def _schedule_callback(self, job, attempt, due):
+        with self.delivery_cond:
+            heapq.heappush(self.deliveries, (due, next(self.sequence), attempt, job))
+            self.delivery_cond.notify()
+
+    def _deliver(self):
+        while True:
+            with self.delivery_cond:
+                while not self.deliveries or self.deliveries[0][0] > time.time():
+                    self.delivery_cond.wait(self.deliveries[0][0] - time.time() if self.deliveries else None)
+                _, _, attempt, job = heapq.heappop(self.deliveries)
+            if self._notify(job):
+                continue
+            if attempt + 1 < self.callback_retries:
+                self._schedule_callback(job, attempt + 1, time.time() + min(2 ** attempt, 30))
+            else:
+                print(f"Giving up on the callback of job {job.id}; it can still be polled", flush=True)
+
+    def _notify(self, job):
+        try:
+            response = requests.post(job.callback_url, json=job.to_dict(), timeout=10)
+            if response.status_code < 500:
+                job.callback_delivered = True
+                return True
+        except requests.RequestException as e:
+            print(f"Job {job.id} callback failed: {e}", flush=True)
+        return False
+
+    def get_stats(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        stats = {state: 0 for state in JOB_STATES}
+        for job in jobs:
+            stats[job.state] += 1
+        stats["undelivered_callbacks"] = sum(1 for job in jobs if job.finished_at and job.callback_url and not job.callback_delivered)
+        return stats
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import threading
+
+
+class SbomError(Exception):
+    pass
+
+
+class SbomStore:
+    """
+    SBOMs generated once per image digest with syft, kept on disk for grype.
+
+    Scanning an SBOM skips pulling and cataloguing the image layers, so an image
+    is only unpacked the first time it is seen; later scans, including the
+    re-evaluation of every stored image after a DB update, read the SBOM.
+    The least recently used SBOMs are evicted past max_bytes.
+    """
+    def __init__(self, sbom_dir, max_bytes=2 * 1024 ** 3):
+        self.sbom_dir = sbom_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.generating = {}  # digest -> lock, so concurrent scans of one image run syft once
+        os.makedirs(sbom_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.sbom_dir, digest.replace(":", "_") + ".syft.json")
+
+    def digests(self):
+        return [name[:-len(".syft.json")].replace("_", ":", 1) for name in os.listdir(self.sbom_dir)
+                if name.endswith(".syft.json")]
+
+    def ensure(self, digest, image_tag, usage=None):
+        """
+        Returns the SBOM of an image, generating it from image_tag if it is not stored yet.
+        :param usage: StageUsage recording the syft run, if any.
+        :return: A (path, generated) tuple.
+        """
+        path = self.path(digest)
+        with self.lock:
+            generating = self.generating.setdefault(digest, threading.Lock())
+        try:
+            with generating:
+                if os.path.exists(path):
+                    os.utime(path)
+                    return path, False
+                temp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(temp_path, "w") as sbom_file:
+                    process = subprocess.Popen(["syft", image_tag, "-o", "syft-json", "-q"],
+                                               stdout=sbom_file, stderr=subprocess.PIPE)
+                    _, errors = process.communicate() if usage is None else (None, process.stderr.read())
+                    returncode = process.returncode if usage is None else usage.wait(process)
+                if returncode != 0:
+                    os.remove(temp_path)
+                    raise SbomError(f"syft failed for {image_tag}: {errors.decode('utf-8', 'replace').strip()}")
+                os.replace(temp_path, path)
+        finally:
+            # Failed and cached lookups must not leave their lock behind either
+            with self.lock:
+                self.generating.pop(digest, None)
+        with self.lock:
+            self._evict()
+        return path, True
+
+    def _evict(self):
+        # Must hold the lock
+        entries = []
+        for name in os.listdir(self.sbom_dir):
+            if name.endswith(".syft.json"):
+                stat = os.stat(os.path.join(self.sbom_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.sbom_dir, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            print(f"Evicted SBOM {path}", flush=True)
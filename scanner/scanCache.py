@@ -0,0 +1,145 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+# Lines of "grype db status" that identify the database contents (not its location or validity)
+DB_STATUS_KEYS = ("built", "schema", "checksum", "from")
+
+
+def image_digest(image_tag):
+    """
+    Returns the content-addressed id ("sha256:...") of a local image, or None if it is unknown.
+    """
+    result = subprocess.run(["docker", "image", "inspect", "--format", "{{.Id}}", image_tag],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return (result.stdout.strip() or None) if result.returncode == 0 else None
+
+
+class ScanCache:
+    """
+    On-disk cache of grype results keyed by image digest and vulnerability DB version.
+
+    Entries live in one directory per DB version; when grype's DB changes, the
+    directories of older versions are dropped, so no result computed against an
+    outdated DB is ever served. The current version is the one db_version()
+    last reported for the active DB: a scan that started before a DB refresh
+    neither drops the newer results nor stores its own, which are already
+    outdated. Entries are evicted least recently used first once the cache
+    grows past max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes=512 * 1024 ** 2, db_check_interval=60):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_check_interval = db_check_interval  # seconds a DB version lookup is reused
+        self.lock = threading.Lock()
+        self.db_version_cache = (None, 0.0)
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "stale_stores_skipped": 0, "evictions": 0, "invalidations": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def db_version(self, env=None):
+        """
+        Returns a short hash identifying the vulnerability DB grype currently uses, or None if it has none.
+        It becomes the current version of the cache.
+        :param env: The environment grype runs with, which selects the active DB directory.
+        """
+        version, checked_at = self.db_version_cache
+        if time.time() - checked_at < self.db_check_interval:
+            return version
+        result = subprocess.run(["grype", "db", "status"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+        identity = sorted(
+            line.strip() for line in result.stdout.splitlines()
+            if line.split(":", 1)[0].strip().lower() in DB_STATUS_KEYS
+        )
+        version = hashlib.sha256("\n".join(identity).encode("utf-8")).hexdigest()[:16] if result.returncode == 0 and identity else None
+        self.db_version_cache = (version, time.time())
+        return version
+
+    def forget_db_version(self):
+        """
+        Makes the next db_version() call ask grype again, e.g. right after a DB update.
+        """
+        self.db_version_cache = (None, 0.0)
+
+    def _entry_path(self, digest, db_version):
+        return os.path.join(self.cache_dir, db_version, digest.replace(":", "_") + ".json.gz")
+
+    def _is_current(self, db_version):
+        return db_version is not None and db_version == self.db_version_cache[0]
+
+    def _drop_stale(self, db_version):
+        # Must hold the lock; only the current version may drop the others, which are all older
+        if not self._is_current(db_version):
+            return
+        for name in os.listdir(self.cache_dir):
+            if name != db_version:
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+                self.stats["invalidations"] += 1
+                print(f"Dropped scan results of vulnerability DB {name}", flush=True)
+
+    def get(self, digest, db_version):
+        """
+        :return: The cached {"returncode", "findings", "scanned_at", ...} entry, or None.
+        """
+        path = self._entry_path(digest, db_version)
+        with self.lock:
+            self._drop_stale(db_version)
+            try:
+                with gzip.open(path, "rt", encoding="utf-8") as entry_file:
+                    entry = json.load(entry_file)
+            except (OSError, ValueError):
+                entry = None
+            if entry is None or "findings" not in entry:  # missing, unreadable or written by an older scanner
+                self.stats["misses"] += 1
+                return None
+            os.utime(path)
+            self.stats["hits"] += 1
+        return entry
+
+    def has(self, digest, db_version):
+        return os.path.exists(self._entry_path(digest, db_version))
+
+    def put(self, digest, db_version, returncode, findings):
+        path = self._entry_path(digest, db_version)
+        entry = {"digest": digest, "db_version": db_version, "returncode": returncode,
+                 "findings": findings, "scanned_at": time.time()}
+        with self.lock:
+            if not self._is_current(db_version):
+                # The DB was refreshed while this scan ran
+                self.stats["stale_stores_skipped"] += 1
+                print(f"Not caching a scan made with outdated vulnerability DB {db_version}", flush=True)
+                return
+            self._drop_stale(db_version)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with gzip.open(temp_path, "wt", encoding="utf-8") as entry_file:
+                json.dump(entry, entry_file)
+            os.replace(temp_path, path)
+            self.stats["stores"] += 1
+            self._evict()
+
+    def _evict(self):
+        # Must hold the lock
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.stats["evictions"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["db_version"] = self.db_version_cache[0]
+        return stats
@@ -0,0 +1,66 @@
+import queue
+import threading
+import time
+
+
+class ScanPool:
+    """
+    Fixed number of scan worker threads behind a FIFO queue, with queue metrics.
+
+    submit() has the executor interface JobRegistry expects, so scan jobs run
+    here instead of on request threads and throughput scales with the number of
+    workers rather than with the number of concurrent requests.
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "run_time_total": 0.0,
+        }
+        self.started_at = time.time()
+        for index in range(workers):
+            threading.Thread(target=self._work, name=f"scan-worker-{index}", daemon=True).start()
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            self.stats["submitted"] += 1
+        self.queue.put((time.time(), fn, args, kwargs))
+
+    def _work(self):
+        while True:
+            enqueued_at, fn, args, kwargs = self.queue.get()
+            started_at = time.time()
+            with self.lock:
+                self.running += 1
+                self.stats["wait_time_total"] += started_at - enqueued_at
+                self.stats["wait_time_max"] = max(self.stats["wait_time_max"], started_at - enqueued_at)
+            failed = False
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                print(f"Scan worker task failed: {e}", flush=True)
+            with self.lock:
+                self.running -= 1
+                self.stats["failed" if failed else "completed"] += 1
+                self.stats["run_time_total"] += time.time() - started_at
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["running"] = self.running
+        stats["workers"] = self.workers
+        stats["queued"] = self.queue.qsize()
+        started = stats["completed"] + stats["failed"] + stats["running"]
+        finished = stats["completed"] + stats["failed"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / started if started else 0.0
+        stats["run_time_avg"] = stats["run_time_total"] / finished if finished else 0.0
+        stats["throughput_per_minute"] = finished * 60 / (time.time() - self.started_at)
+        return stats
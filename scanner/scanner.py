@@ -1,6 +1,7 @@
 from datetime import timedelta
 import io
 import subprocess
+import threading
 import time
 import jwt
 import redis
@@ -9,6 +10,14 @@ import os
 from jwt.exceptions import InvalidTokenError
 import requests
 from logQueue import LogQueue
+from jobs import JobRegistry
+from resourceUsage import StageUsage
+from scanCache import ScanCache, image_digest
+from sbomStore import SbomStore
+from grypeReport import finding_from_match, format_finding, iter_matches, severity_counts, table_header
+from grypeDb import GrypeDatabase
+from scanPool import ScanPool
+import tempfile
 
 app = Flask(__name__)
 
@@ -18,7 +27,44 @@ log_queue_port = os.getenv("LOG_QUEUE_PORT", "5672")
 log_queue_name = os.getenv("LOG_QUEUE_NAME", "log-queue")
 
 # Initialize the LogQueue with environment variables
-log_queue = LogQueue(log_queue_host, log_queue_port, log_queue_name)
+log_queue = LogQueue(
+    log_queue_host, log_queue_port, log_queue_name,
+    batch_lines=int(os.getenv("LOG_BATCH_LINES", "200")),
+    batch_interval=int(os.getenv("LOG_BATCH_INTERVAL_MS", "500")) / 1000,
+    max_queued_lines=int(os.getenv("LOG_QUEUE_MAX_LINES", "50000")),
+    overflow=os.getenv("LOG_QUEUE_OVERFLOW", "block"),
+    spill_path=os.getenv("LOG_QUEUE_SPILL_PATH", "/tmp/log-queue-spill.jsonl"),
+    wire_format=os.getenv("LOG_WIRE_FORMAT", "frame"),
+    collapse_progress=os.getenv("LOG_COLLAPSE_PROGRESS", "true").lower() == "true"
+)
+
+# Results of previous scans, reused while the image and the vulnerability DB are unchanged
+scan_cache = ScanCache(
+    os.getenv("SCAN_CACHE_DIR", "/var/cache/continuum/scans"),
+    max_bytes=int(os.getenv("SCAN_CACHE_MAX_MB", "512")) * 1024 * 1024
+)
+
+# "image" lets grype catalogue the image on every scan; "sbom" catalogues it once with syft and scans the stored SBOM
+scan_mode = os.getenv("SCAN_MODE", "image")
+if scan_mode not in ("image", "sbom"):
+    raise ValueError("SCAN_MODE must be image or sbom")
+sbom_store = SbomStore(
+    os.getenv("SBOM_DIR", "/var/cache/continuum/sboms"),
+    max_bytes=int(os.getenv("SBOM_MAX_MB", "2048")) * 1024 * 1024
+)
+# Seconds between checks for a new vulnerability DB, which triggers the re-evaluation of the stored SBOMs
+SBOM_REEVALUATE_INTERVAL = int(os.getenv("SBOM_REEVALUATE_INTERVAL", "600"))
+
+# The vulnerability DB is downloaded at startup and refreshed on a schedule, never by a scan
+grype_db = GrypeDatabase(
+    os.getenv("GRYPE_DB_CACHE_DIR", "/var/cache/continuum/grype-db"),
+    refresh_interval=int(os.getenv("GRYPE_DB_REFRESH_INTERVAL", "21600")),
+    on_update=scan_cache.forget_db_version
+)
+
+# Scans run as background jobs on SCAN_WORKERS worker threads (default: one per core)
+scan_pool = ScanPool(workers=int(os.getenv("SCAN_WORKERS", str(os.cpu_count() or 4))))
+jobs = JobRegistry("scanner", executor=scan_pool)
 
 def format_time(total_seconds):
     """
@@ -43,27 +89,94 @@ def format_time(total_seconds):
     
     return formatted_time
 
-@app.route("/api/v1/trigger-scan", methods=["POST"]) 
-def trigger_scan():
+# Findings per request when sending them to dbproxy
+FINDINGS_BATCH_SIZE = int(os.getenv("FINDINGS_BATCH_SIZE", "5000"))
+
+def run_grype(target, usage=None):
     """
-    Endpoint to trigger a vulnerability scan on a specified image tag.
+    Runs grype with JSON output on an image or "sbom:<path>" target, parsing findings as they are written.
+
+    Returns:
+    - (returncode, findings, errors): grype's exit code, the finding rows and its stderr output.
+    """
+    with tempfile.TemporaryFile(mode="w+") as errors, grype_db.reading() as grype_env:
+        process = subprocess.Popen(["grype", "-q", "-o", "json", target], stdout=subprocess.PIPE, stderr=errors, env=grype_env)
+        stream = io.TextIOWrapper(process.stdout, encoding="utf-8")
+        findings = [finding_from_match(match) for match in iter_matches(stream)]
+        stream.read()  # the rest of the report, so grype never blocks on a full pipe
+        returncode = process.wait() if usage is None else usage.wait(process)
+        errors.seek(0)
+        return returncode, findings, errors.read()
+
+def report_findings(action_uid, digest, findings):
+    """
+    Stores the findings of an action in dbproxy in bulk, replacing any stored earlier for it.
+    """
+    dbproxy_url = 'http://dbproxy:5000/api/v1/vulnerabilities'
+    try:
+        for start in range(0, max(len(findings), 1), FINDINGS_BATCH_SIZE):
+            response = requests.post(dbproxy_url, json={
+                "action_uid": action_uid,
+                "image_digest": digest,
+                "replace": start == 0,
+                "findings": findings[start:start + FINDINGS_BATCH_SIZE],
+            }, timeout=60)
+            response.raise_for_status()
+    except requests.RequestException as e:
+        # The scan itself succeeded; its findings stay in the logs and the scan cache
+        print(f"Failed to store findings in dbproxy: {e}", flush=True)
+
+def run_scan(data):
+    """
+    Runs a vulnerability scan on the image of a trigger-scan request payload.
     Updates the scan status and ETA through a POST request to dbproxy.
     """
     total_time_str = "N/A"
-    status = request.json.get("status")
-    dbproxy_url = 'http://dbproxy:5000/api/v1/update-action'
-    action_uid = request.json.get("action_uid")
-    image_tag = request.json.get("image_tag")
+    status = data.get("status")
+    dbproxy_url = 'http://dbproxy:5000/api/v1/update-actions'
+    action_uid = data.get("action_uid")
+    image_tag = data.get("image_tag")
+    cache_hit = False
+    counts = {}
 
     if status == "OK":
         start_time = time.time()
+        usage = StageUsage(action_uid, "scan")
 
         try:
-            process = subprocess.Popen(["grype", image_tag], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            for line in io.TextIOWrapper(process.stdout, encoding="utf-8"):
-                log_queue.send({"action_uid": action_uid, "service": "scanner", "time": time.time(), "log": line})
-            process.wait()
-            if process.returncode == 0:
+            digest = image_digest(image_tag)
+            db_version = scan_cache.db_version(grype_db.env())
+            cached = scan_cache.get(digest, db_version) if digest and db_version else None
+            if cached is not None:
+                cache_hit = True
+                log_queue.send({"action_uid": action_uid, "service": "scanner", "time": time.time(),
+                                "log": f"Scan cache hit: {digest} was scanned with vulnerability DB {db_version}\n"})
+                returncode, findings = cached["returncode"], cached["findings"]
+            else:
+                target = image_tag
+                if scan_mode == "sbom" and digest:
+                    sbom_path, generated = sbom_store.ensure(digest, image_tag, usage)
+                    log_queue.send({"action_uid": action_uid, "service": "scanner", "time": time.time(),
+                                    "log": f"{'Generated' if generated else 'Reusing'} SBOM of {digest}\n"})
+                    target = f"sbom:{sbom_path}"
+                returncode, findings, errors = run_grype(target, usage)
+                for line in errors.splitlines(keepends=True):
+                    log_queue.send({"action_uid": action_uid, "service": "scanner", "time": time.time(), "log": line})
+                # Failed scans (e.g. an image grype could not read) are not cached
+                if returncode == 0 and digest and db_version:
+                    scan_cache.put(digest, db_version, returncode, findings)
+            if returncode == 0:
+                counts = severity_counts(findings)
+                # The findings table replaces grype's own table output in the logs
+                log_queue.send({"action_uid": action_uid, "service": "scanner", "time": time.time(), "log": table_header()})
+                for finding in findings:
+                    log_queue.send({"action_uid": action_uid, "service": "scanner", "time": time.time(), "log": format_finding(finding)})
+                summary = ", ".join(f"{count} {severity}" for severity, count in sorted(counts.items())) or "none"
+                log_queue.send({"action_uid": action_uid, "service": "scanner", "time": time.time(),
+                                "log": f"{len(findings)} vulnerabilities found: {summary}\n"})
+                report_findings(action_uid, digest, findings)
+            log_queue.flush(action_uid, "scanner")
+            if returncode == 0:
                 status = "OK"
             else:
                 status = "ERROR"
@@ -80,25 +193,120 @@ def trigger_scan():
         end_time = time.time()
         total_time = end_time - start_time
         total_time_str = format_time(total_time)
+        usage.report()
     else:
         status = "N/A"
 
     # Attempt to update the dbproxy with the scan results
     try:
-        requests.post(dbproxy_url, json={"action_uid": action_uid, "status_name": "scanner_status", "status": status, "eta_name": "scanner_eta", "eta": total_time_str})
+        requests.post(dbproxy_url, json={"updates": [
+            {"action_uid": action_uid, "field": "scanner_status", "value": status},
+            {"action_uid": action_uid, "field": "scanner_eta", "value": total_time_str},
+            {"action_uid": action_uid, "field": "scanner_cache_hit", "value": cache_hit},
+        ]})
     except requests.RequestException as e:
         print(f"Failed to update dbproxy: {e}")
 
-    return jsonify({
+    return {
         "status": status,
-        "image_tag": image_tag
-    })
+        "image_tag": image_tag,
+        "cache_hit": cache_hit,
+        "severity_counts": counts
+    }
+
+def reevaluate_sboms(data):
+    """
+    Scans every stored SBOM against the current vulnerability DB and caches the results,
+    so images built before a DB update are re-evaluated without pulling or unpacking them.
+    SBOMs already scanned with this DB are skipped.
+    """
+    db_version = scan_cache.db_version(grype_db.env())
+    if db_version is None:
+        raise RuntimeError("grype has no vulnerability DB")
+    counts = {"evaluated": 0, "skipped": 0, "failed": 0}
+    start_time = time.time()
+    for digest in sbom_store.digests():
+        if scan_cache.has(digest, db_version):
+            counts["skipped"] += 1
+            continue
+        returncode, findings, errors = run_grype(f"sbom:{sbom_store.path(digest)}")
+        if returncode == 0:
+            scan_cache.put(digest, db_version, 0, findings)
+            counts["evaluated"] += 1
+        else:
+            print(f"Re-evaluating {digest} failed: {errors.strip()}", flush=True)
+            counts["failed"] += 1
+    print(f"Re-evaluated SBOMs with vulnerability DB {db_version} in {format_time(time.time() - start_time)}: {counts}", flush=True)
+    return dict(counts, status="OK", db_version=db_version)
+
+def watch_db_updates():
+    """
+    Starts a batch re-evaluation of the stored SBOMs whenever grype's vulnerability DB changes.
+    """
+    evaluated_version = None
+    while True:
+        time.sleep(SBOM_REEVALUATE_INTERVAL)
+        db_version = scan_cache.db_version(grype_db.env())
+        if db_version and db_version != evaluated_version:
+            jobs.submit(reevaluate_sboms, {})
+            evaluated_version = db_version
+
+@app.route("/api/v1/reevaluate-sboms", methods=["POST"])
+def trigger_reevaluation():
+    """
+    Endpoint to re-evaluate every stored SBOM against the current vulnerability DB.
+    Responds 202 with the job id; poll /api/v1/jobs/<job_id> for the counts.
+    """
+    job = jobs.submit(reevaluate_sboms, {})
+    return jsonify({"job_id": job.id, "state": job.state, "status_url": f"/api/v1/jobs/{job.id}"}), 202
+
+@app.route("/api/v1/trigger-scan", methods=["POST"])
+def trigger_scan():
+    """
+    Endpoint to trigger a vulnerability scan on a specified image tag.
+    Responds 202 with the job id; the finished job is POSTed to "callback_url"
+    if given and can be polled at /api/v1/jobs/<job_id>.
+    """
+    job = jobs.submit(run_scan, request.json, request.json.get("callback_url"))
+    return jsonify({"job_id": job.id, "state": job.state, "status_url": f"/api/v1/jobs/{job.id}"}), 202
+
+@app.route("/api/v1/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    Reports the state of a scan job and, once finished, its result.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/api/v1/scan-cache-stats", methods=["GET"])
+def scan_cache_stats():
+    """
+    Reports scan cache hits, misses, evictions and the current vulnerability DB version.
+    """
+    return jsonify(scan_cache.get_stats())
+
+@app.route("/api/v1/scan-stats", methods=["GET"])
+def scan_stats():
+    """
+    Reports the scan worker pool (queued and running scans, wait and run times, throughput),
+    the job states and the vulnerability DB refreshes.
+    """
+    return jsonify({"pool": scan_pool.get_stats(), "jobs": jobs.get_stats(), "db": grype_db.get_stats()})
+
+@app.route("/api/v1/log-queue-stats", methods=["GET"])
+def log_queue_stats():
+    """
+    Reports the publisher counters of the log queue (queued, published, dropped and spilled lines).
+    """
+    return jsonify(log_queue.get_stats())
 
 if __name__ == "__main__":
-    # Delay to ensure dependent services are up
-    time.sleep(15)
-    try:
-        log_queue.connect()
-    except Exception as e:
-        print(f"Failed to connect to log queue: {e}")
+    # The publisher thread keeps retrying until RabbitMQ is up; lines are spooled meanwhile
+    log_queue.connect()
+    grype_db.warm()
+    grype_db.start()
+    if scan_mode == "sbom":
+        threading.Thread(target=watch_db_updates, daemon=True).start()
     app.run(debug=True, host="0.0.0.0")
@@ -0,0 +1,75 @@
+import heapq
+import statistics
+import xml.etree.ElementTree as ElementTree
+
+# Duration assumed for a test without history when no test of the repository has any
+DEFAULT_TEST_DURATION = 1.0
+
+
+def parse_collected(output):
+    """
+    Extracts the test node ids ("path/test_file.py::TestClass::test_name") from "pytest --collect-only -q" output.
+    """
+    return [line.strip() for line in output.splitlines() if "::" in line and not line.startswith(("=", " "))]
+
+
+def junit_key(node_id):
+    """
+    Returns the (classname, name) pair pytest writes to JUnit XML for a test node id.
+    """
+    parts = node_id.split("::")
+    path = parts[0]
+    module = (path[:-3] if path.endswith(".py") else path).replace("/", ".")
+    return ".".join([module] + parts[1:-1]), parts[-1]
+
+
+def balance_shards(tests, durations, shards):
+    """
+    Splits tests into shards of similar total duration with the longest-processing-time-first rule:
+    tests are taken from the longest down and each goes to the currently shortest shard.
+    Tests without history are assumed to take the median known duration.
+
+    :param tests: Test node ids.
+    :param durations: Historical duration in seconds by test node id.
+    :param shards: Number of shards; fewer are returned if there are fewer tests.
+    :return: A list of (expected seconds, [test node ids]) pairs.
+    """
+    known = [durations[test] for test in tests if test in durations]
+    default = statistics.median(known) if known else DEFAULT_TEST_DURATION
+    heap = [(0.0, index, []) for index in range(min(shards, len(tests)))]
+    for test in sorted(tests, key=lambda test: durations.get(test, default), reverse=True):
+        load, index, assigned = heapq.heappop(heap)
+        assigned.append(test)
+        heapq.heappush(heap, (load + durations.get(test, default), index, assigned))
+    return [(load, assigned) for load, _, assigned in sorted(heap, key=lambda shard: shard[1])]
+
+
+def parse_junit(path, node_ids=()):
+    """
+    Reads the test cases of a JUnit XML report.
+
+    :param path: The report file.
+    :param node_ids: Collected node ids, used to report tests under their pytest id instead of classname::name.
+    :return: A list of {"test_id", "outcome", "duration", "message"} dicts.
+    """
+    by_key = {junit_key(node_id): node_id for node_id in node_ids}
+    results = []
+    for _, element in ElementTree.iterparse(path):
+        if element.tag != "testcase":
+            continue
+        key = (element.get("classname", ""), element.get("name", ""))
+        outcome, message = "passed", None
+        for child in element:
+            if child.tag in ("failure", "error"):
+                outcome, message = ("failed" if child.tag == "failure" else "error"), child.get("message")
+                break
+            if child.tag == "skipped":
+                outcome, message = "skipped", child.get("message")
+        results.append({
+            "test_id": by_key.get(key, "::".join(key)),
+            "outcome": outcome,
+            "duration": float(element.get("time") or 0.0),
+            "message": message,
+        })
+        element.clear()
+    return results
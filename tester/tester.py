@@ -1,5 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-import random
+import io
+import shlex
+import subprocess
+import tempfile
 import time
 import jwt
 import redis
@@ -7,9 +11,42 @@ from flask import Flask, redirect, url_for, session, request, jsonify, render_te
 import os
 from jwt.exceptions import InvalidTokenError
 import requests
+from jobs import JobRegistry
+from logQueue import LogQueue
+from resourceUsage import StageUsage
+from testShards import balance_shards, parse_collected, parse_junit
 
 app = Flask(__name__)
 
+# Environment variables for the log queue configuration
+log_queue_host = os.getenv("LOG_QUEUE_HOST", "rabbitmq")
+log_queue_port = os.getenv("LOG_QUEUE_PORT", "5672")
+log_queue_name = os.getenv("LOG_QUEUE_NAME", "log-queue")
+log_queue = LogQueue(
+    log_queue_host, log_queue_port, log_queue_name,
+    batch_lines=int(os.getenv("LOG_BATCH_LINES", "200")),
+    batch_interval=int(os.getenv("LOG_BATCH_INTERVAL_MS", "500")) / 1000,
+    max_queued_lines=int(os.getenv("LOG_QUEUE_MAX_LINES", "50000")),
+    overflow=os.getenv("LOG_QUEUE_OVERFLOW", "block"),
+    spill_path=os.getenv("LOG_QUEUE_SPILL_PATH", "/tmp/log-queue-spill.jsonl"),
+    wire_format=os.getenv("LOG_WIRE_FORMAT", "frame"),
+    collapse_progress=os.getenv("LOG_COLLAPSE_PROGRESS", "true").lower() == "true"
+)
+
+# Test command run inside the built image; it must accept pytest's --collect-only, -q, --junitxml and node ids
+TEST_COMMAND = shlex.split(os.getenv("TEST_COMMAND", "python -m pytest"))
+# Number of containers a test run is split across
+TEST_SHARDS = int(os.getenv("TEST_SHARDS", "4"))
+# Where each shard container writes its JUnit XML report
+TEST_REPORT_PATH = "/tmp/continuum-junit.xml"
+# pytest exit codes that do not fail the stage: all passed, no tests collected
+PASSING_EXIT_CODES = (0, 5)
+# Test results per request when sending them to dbproxy
+RESULTS_BATCH_SIZE = 5000
+
+# Test runs are background jobs on a bounded thread pool
+jobs = JobRegistry("tester", max_workers=int(os.getenv("JOB_WORKERS", "4")))
+
 def format_time(total_seconds):
     """
     Converts total seconds to a formatted string with hours, minutes, seconds, and milliseconds.
@@ -33,44 +70,186 @@ def format_time(total_seconds):
     
     return formatted_time
 
-@app.route("/api/v1/trigger-test", methods=["POST"])
-def trigger_scan():
+def log_line(action_uid, line):
     """
-    Endpoint to trigger a test scan, simulate processing time, and update a remote database with the result.
+    Publishes one line of test output to the log queue.
+    """
+    log_queue.send({"action_uid": action_uid, "service": "tester", "time": time.time(), "log": line})
+
+def test_command(*args):
+    """
+    Returns the docker arguments running TEST_COMMAND with extra arguments, whatever the image's entrypoint.
+    """
+    return ["--entrypoint", TEST_COMMAND[0]], TEST_COMMAND[1:] + list(args)
+
+def collect_tests(image_tag):
+    """
+    Lists the test node ids of the project in an image with pytest --collect-only.
+    """
+    entrypoint, args = test_command("--collect-only", "-q")
+    result = subprocess.run(["docker", "run", "--rm", *entrypoint, image_tag, *args],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode not in PASSING_EXIT_CODES:
+        raise RuntimeError(f"Test collection failed ({result.returncode}): {result.stdout[-2000:]}")
+    return parse_collected(result.stdout)
+
+def fetch_durations(username, repo_name):
+    """
+    Fetches the average duration of each test of the repository in recent runs, or {} if unavailable.
     """
-    dbproxy_url = 'http://dbproxy:5000/api/v1/update-action'
-    total_time_str = "N/A"
     try:
-        status = request.json.get("status")
-        action_uid = request.json.get("action_uid")
-    except Exception as e:
-        # Error handling for malformed request data
-        return jsonify({"error": "Bad request data"}), 400
+        response = requests.get('http://dbproxy:5000/api/v1/test-durations',
+                                params={"user": username, "repo": repo_name}, timeout=10)
+        response.raise_for_status()
+        return response.json()["durations"]
+    except (requests.RequestException, KeyError, ValueError) as e:
+        print(f"No test durations from dbproxy, shards are balanced by count: {e}", flush=True)
+        return {}
+
+def run_shard(action_uid, image_tag, index, tests, report_dir, usage):
+    """
+    Runs one shard of tests in its own container and reads back its JUnit XML report.
+
+    Returns:
+    - (returncode, results): The test command's exit code and the parsed test cases.
+    """
+    name = f"tester-{action_uid}-{index}"
+    entrypoint, args = test_command("-q", f"--junitxml={TEST_REPORT_PATH}", *tests)
+    created = subprocess.run(["docker", "create", "--name", name, *entrypoint, image_tag, *args],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if created.returncode != 0:
+        log_line(action_uid, f"[shard {index}] could not create container: {created.stdout}")
+        return created.returncode, []
+    try:
+        with usage.watch(name):
+            process = subprocess.Popen(["docker", "start", "--attach", name], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in io.TextIOWrapper(process.stdout, encoding="utf-8"):
+                log_line(action_uid, f"[shard {index}] {line}")
+            returncode = process.wait()
+        report = os.path.join(report_dir, f"shard-{index}.xml")
+        copied = subprocess.run(["docker", "cp", f"{name}:{TEST_REPORT_PATH}", report], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        results = parse_junit(report, tests) if copied.returncode == 0 else []
+        for result in results:
+            result["shard"] = index
+        return returncode, results
+    finally:
+        subprocess.run(["docker", "rm", "--force", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def report_test_results(action_uid, username, repo_name, results):
+    """
+    Stores the per-test results of an action in dbproxy in bulk, replacing any stored earlier for it.
+    """
+    dbproxy_url = 'http://dbproxy:5000/api/v1/test-results'
+    try:
+        for start in range(0, max(len(results), 1), RESULTS_BATCH_SIZE):
+            response = requests.post(dbproxy_url, json={
+                "action_uid": action_uid,
+                "git_user_uid": username,
+                "git_repo_name": repo_name,
+                "replace": start == 0,
+                "results": results[start:start + RESULTS_BATCH_SIZE],
+            }, timeout=60)
+            response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"Failed to store test results in dbproxy: {e}", flush=True)
+
+def run_tests(data):
+    """
+    Runs the project's tests inside the built image from a trigger-test request payload, split across
+    TEST_SHARDS containers balanced by historical test durations, and updates a remote database with the result.
+    """
+    dbproxy_url = 'http://dbproxy:5000/api/v1/update-actions'
+    total_time_str = "N/A"
+    status = data.get("status")
+    action_uid = data.get("action_uid")
+    image_tag = data.get("image_tag")
+    repo_name = data.get("repo_name")
+    username = data.get("username")
+    counts = {}
 
     if status == "OK":
         start_time = time.time()
-        time.sleep(5)  # Simulate processing delay
+        usage = StageUsage(action_uid, "test")
+
+        try:
+            tests = collect_tests(image_tag)
+            if not tests:
+                log_line(action_uid, "No tests collected\n")
+                status = "OK"
+            else:
+                shards = balance_shards(tests, fetch_durations(username, repo_name), TEST_SHARDS)
+                log_line(action_uid, f"Running {len(tests)} tests in {len(shards)} shards, expected "
+                                     f"{', '.join(format_time(load) for load, _ in shards)}\n")
+                with tempfile.TemporaryDirectory() as report_dir, ThreadPoolExecutor(max_workers=len(shards)) as pool:
+                    outcomes = list(pool.map(
+                        lambda shard: run_shard(action_uid, image_tag, shard[0], shard[1][1], report_dir, usage),
+                        enumerate(shards)
+                    ))
+                results = [result for _, shard_results in outcomes for result in shard_results]
+                for result in results:
+                    counts[result["outcome"]] = counts.get(result["outcome"], 0) + 1
+                status = "OK" if all(returncode in PASSING_EXIT_CODES for returncode, _ in outcomes) else "ERROR"
+                log_line(action_uid, f"{len(results)} test results: "
+                                     f"{', '.join(f'{count} {outcome}' for outcome, count in sorted(counts.items()))}\n")
+                report_test_results(action_uid, username, repo_name, results)
+        except Exception as e:
+            print(f"Test run failed: {e}", flush=True)
+            log_line(action_uid, f"Test run failed: {e}\n")
+            status = "ERROR"
+        log_queue.flush(action_uid, "tester")
 
-        # Randomly determine the new status
-        status = "ERROR" if bool(random.getrandbits(1)) else "OK"
-        
         end_time = time.time()
         total_time = end_time - start_time
         total_time_str = format_time(total_time)
+        usage.report()
     else:
         status = "N/A"
     
     # Attempt to post update to dbproxy and handle potential network errors
     try:
-        response = requests.post(dbproxy_url, json={"action_uid": action_uid, "status_name": "tester_status", "status": status, "eta_name": "tester_eta", "eta": total_time_str})
+        response = requests.post(dbproxy_url, json={"updates": [
+            {"action_uid": action_uid, "field": "tester_status", "value": status},
+            {"action_uid": action_uid, "field": "tester_eta", "value": total_time_str},
+        ]})
         response.raise_for_status()  # Raises an error for 4XX or 5XX responses
     except requests.RequestException as e:
         print(f"Failed to update dbproxy: {e}", flush=True)
-        # Return an error response indicating the failure to communicate with the dbproxy
-        return jsonify({"error": "Failed to communicate with dbproxy"}), 500
+        # Fails the job, reporting the failure to communicate with the dbproxy
+        raise RuntimeError("Failed to communicate with dbproxy") from e
+
+    return {"status": status, "image_tag": image_tag, "test_counts": counts}
+
+@app.route("/api/v1/trigger-test", methods=["POST"])
+def trigger_scan():
+    """
+    Endpoint to trigger a test run as a background job.
+    Responds 202 with the job id; the finished job is POSTed to "callback_url"
+    if given and can be polled at /api/v1/jobs/<job_id>.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        # Error handling for malformed request data
+        return jsonify({"error": "Bad request data"}), 400
+    job = jobs.submit(run_tests, data, data.get("callback_url"))
+    return jsonify({"job_id": job.id, "state": job.state, "status_url": f"/api/v1/jobs/{job.id}"}), 202
 
-    return jsonify({"status": status})
+@app.route("/api/v1/log-queue-stats", methods=["GET"])
+def log_queue_stats():
+    """
+    Reports the publisher counters of the log queue (queued, published, dropped and spilled lines).
+    """
+    return jsonify(log_queue.get_stats())
+
+@app.route("/api/v1/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    Reports the state of a test job and, once finished, its result.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
 
 if __name__ == "__main__":
-    time.sleep(15)  # Delay to ensure dependent services are up
+    log_queue.connect()  # Retries in the background until RabbitMQ is up
     app.run(debug=True, host="0.0.0.0")
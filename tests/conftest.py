@@ -0,0 +1,11 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Service modules are imported the way each service runs them, from its own directory
+for service in ("builder", "tester"):
+    sys.path.insert(0, os.path.join(ROOT, service))
+
+# A project the tester runs, not part of this suite
+collect_ignore = ["sample_project"]
@@ -0,0 +1,16 @@
+import pytest
+
+from calc import add, mean
+
+
+class TestAdd:
+    def test_integers(self):
+        assert add(2, 3) == 5
+
+    def test_zero(self):
+        assert add(0, 7) == 7
+
+
+@pytest.mark.parametrize("values, expected", [([1, 2, 3], 2), ([4], 4)])
+def test_mean(values, expected):
+    assert mean(values) == expected
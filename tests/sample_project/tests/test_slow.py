@@ -0,0 +1,9 @@
+import time
+
+import pytest
+
+
+# Uneven durations, so balancing by history matters
+@pytest.mark.parametrize("seconds", [0.8, 0.6, 0.5, 0.4, 0.3, 0.2, 0.2, 0.1, 0.1])
+def test_sleep(seconds):
+    time.sleep(seconds)
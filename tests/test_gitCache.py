@@ -0,0 +1,162 @@
+import os
+import subprocess
+import threading
+
+import pytest
+
+from gitCache import MirrorCache, MirrorError
+
+
+def git(*args, cwd=None):
+    result = subprocess.run(["git", "-c", "user.name=Test", "-c", "user.email=test@example.com", *args],
+                            cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+    return result.stdout.strip()
+
+
+class Upstream:
+    """
+    A local bare repository standing in for GitHub, with a working clone to push commits from.
+    """
+    def __init__(self, root, name="project"):
+        self.url = str(root / f"{name}.git")
+        self.work = str(root / f"{name}-work")
+        git("init", "--quiet", "--bare", "--initial-branch=main", self.url)
+        git("clone", "--quiet", self.url, self.work)
+        git("checkout", "--quiet", "-b", "main", cwd=self.work)
+
+    def commit(self, filename, content, branch="main"):
+        with open(os.path.join(self.work, filename), "w") as file:
+            file.write(content)
+        git("add", filename, cwd=self.work)
+        git("commit", "--quiet", "-m", f"Update {filename}", cwd=self.work)
+        git("push", "--quiet", "origin", f"HEAD:{branch}", cwd=self.work)
+        return git("rev-parse", "HEAD", cwd=self.work)
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    return Upstream(tmp_path)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MirrorCache(str(tmp_path / "mirrors"))
+
+
+def test_checkout_default_branch(upstream, cache, tmp_path):
+    commit = upstream.commit("Dockerfile", "FROM python:3.8-slim\n")
+    dest = str(tmp_path / "build")
+
+    assert cache.checkout(upstream.url, dest) == commit
+    with open(os.path.join(dest, "Dockerfile")) as dockerfile:
+        assert dockerfile.read() == "FROM python:3.8-slim\n"
+    assert git("rev-parse", "HEAD", cwd=dest) == commit
+
+
+def test_checkout_fetches_new_commits_into_the_same_mirror(upstream, cache, tmp_path):
+    upstream.commit("app.py", "print(1)\n")
+    first = str(tmp_path / "first")
+    cache.checkout(upstream.url, first)
+    cache.release(first)
+
+    commit = upstream.commit("app.py", "print(2)\n")
+    second = str(tmp_path / "second")
+
+    assert cache.checkout(upstream.url, second) == commit
+    with open(os.path.join(second, "app.py")) as app:
+        assert app.read() == "print(2)\n"
+    assert cache.stats()["mirrors"] == 1
+
+
+def test_checkout_ref(upstream, cache, tmp_path):
+    main = upstream.commit("app.py", "main\n")
+    feature = upstream.commit("app.py", "feature\n", branch="feature")
+    git("tag", "v1", main, cwd=upstream.work)
+    git("push", "--quiet", "origin", "v1", cwd=upstream.work)
+
+    assert cache.checkout(upstream.url, str(tmp_path / "feature"), ref="feature") == feature
+    assert cache.checkout(upstream.url, str(tmp_path / "tag"), ref="v1") == main
+    assert cache.resolve(upstream.url) == main
+
+
+def test_fetch_url_overrides_cache_key(upstream, cache, tmp_path):
+    commit = upstream.commit("app.py", "print(1)\n")
+
+    # The key stays the public URL while the fetch uses another one, like the URL carrying the OAuth token
+    assert cache.checkout("https://github.com/user/project", str(tmp_path / "build"), fetch_url=upstream.url) == commit
+    assert os.path.isdir(cache.mirror_path("https://github.com/user/project"))
+
+
+def test_release_removes_worktree(upstream, cache, tmp_path):
+    upstream.commit("app.py", "print(1)\n")
+    dest = str(tmp_path / "build")
+    cache.checkout(upstream.url, dest)
+
+    cache.release(dest)
+
+    assert not os.path.exists(dest)
+    assert cache.stats()["worktrees"] == 0
+    worktrees = git("-C", cache.mirror_path(upstream.url), "worktree", "list")
+    assert len(worktrees.splitlines()) == 1  # only the bare mirror itself
+
+
+def test_concurrent_checkouts_share_the_mirror(upstream, cache, tmp_path):
+    commit = upstream.commit("app.py", "print(1)\n")
+    results, errors = [], []
+
+    def build(index):
+        try:
+            results.append(cache.checkout(upstream.url, str(tmp_path / f"build-{index}")))
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=build, args=(index,)) for index in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert results == [commit] * 6
+    stats = cache.stats()
+    assert (stats["mirrors"], stats["worktrees"]) == (1, 6)
+
+
+def test_evict_least_recently_used_mirror_not_in_use(tmp_path):
+    cache = MirrorCache(str(tmp_path / "mirrors"), max_bytes=0)
+    old, new = Upstream(tmp_path, "old"), Upstream(tmp_path, "new")
+    old.commit("app.py", "old\n")
+    new.commit("app.py", "new\n")
+
+    old_build = str(tmp_path / "old-build")
+    cache.checkout(old.url, old_build)
+    # Checked out mirrors are never evicted, even past max_bytes
+    assert os.path.isdir(cache.mirror_path(old.url))
+    cache.release(old_build)
+
+    cache.checkout(new.url, str(tmp_path / "new-build"))
+
+    assert not os.path.exists(cache.mirror_path(old.url))
+    assert os.path.isdir(cache.mirror_path(new.url))
+
+
+def test_evict_skips_locked_mirror(upstream, tmp_path):
+    cache = MirrorCache(str(tmp_path / "mirrors"), max_bytes=0)
+    upstream.commit("app.py", "print(1)\n")
+    mirror = cache.fetch(upstream.url)
+
+    with cache._locked(mirror):
+        cache.evict()
+
+    assert os.path.isdir(mirror)
+    cache.evict()
+    assert not os.path.exists(mirror)
+
+
+def test_fetch_failure_does_not_leak_credentials(cache, tmp_path):
+    fetch_url = f"file://secret-token@{tmp_path}/missing.git"
+
+    with pytest.raises(MirrorError) as error:
+        cache.fetch("https://github.com/user/missing", fetch_url)
+
+    assert "secret-token" not in str(error.value)
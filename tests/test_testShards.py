@@ -0,0 +1,149 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from testShards import balance_shards, junit_key, parse_collected, parse_junit
+
+SAMPLE_PROJECT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_project")
+
+JUNIT_REPORT = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites><testsuite name="pytest" tests="5">
+  <testcase classname="tests.test_calc.TestAdd" name="test_integers" time="0.010" />
+  <testcase classname="tests.test_calc" name="test_mean[values0-2]" time="0.020">
+    <failure message="assert 3 == 2">trace</failure>
+  </testcase>
+  <testcase classname="tests.test_calc" name="test_broken_fixture" time="0.001">
+    <error message="fixture 'db' not found">trace</error>
+  </testcase>
+  <testcase classname="tests.test_slow" name="test_sleep[0.8]" time="">
+    <skipped message="not today" />
+  </testcase>
+  <testcase classname="other" name="test_unknown" time="1.5" />
+</testsuite></testsuites>
+"""
+
+
+def run_pytest(*args):
+    return subprocess.run([sys.executable, "-m", "pytest", *args], cwd=SAMPLE_PROJECT,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+
+@pytest.fixture(scope="module")
+def collected():
+    result = run_pytest("--collect-only", "-q")
+    assert result.returncode == 0, result.stdout
+    return parse_collected(result.stdout)
+
+
+def test_parse_collected_keeps_only_node_ids(collected):
+    assert len(collected) == 13
+    assert "tests/test_calc.py::TestAdd::test_zero" in collected
+    assert "tests/test_slow.py::test_sleep[0.2_1]" in collected
+    assert all("::" in test and "collected" not in test for test in collected)
+
+
+def test_parse_collected_ignores_summary_and_errors():
+    output = "tests/test_a.py::test_one\n\n= 1 error =\n  tests/test_b.py::indented\n1 test collected in 0.01s\n"
+    assert parse_collected(output) == ["tests/test_a.py::test_one"]
+
+
+def test_junit_key():
+    assert junit_key("tests/test_calc.py::TestAdd::test_zero") == ("tests.test_calc.TestAdd", "test_zero")
+    assert junit_key("tests/test_slow.py::test_sleep[0.5]") == ("tests.test_slow", "test_sleep[0.5]")
+    assert junit_key("test_top.py::test_one") == ("test_top", "test_one")
+
+
+def test_parse_junit_outcomes(tmp_path):
+    report = tmp_path / "junit.xml"
+    report.write_text(JUNIT_REPORT)
+    node_ids = ["tests/test_calc.py::TestAdd::test_integers", "tests/test_calc.py::test_mean[values0-2]",
+                "tests/test_slow.py::test_sleep[0.8]"]
+
+    results = {result["test_id"]: result for result in parse_junit(str(report), node_ids)}
+
+    assert results["tests/test_calc.py::TestAdd::test_integers"] == {
+        "test_id": "tests/test_calc.py::TestAdd::test_integers", "outcome": "passed", "duration": 0.01, "message": None}
+    assert results["tests/test_calc.py::test_mean[values0-2]"]["outcome"] == "failed"
+    assert results["tests/test_calc.py::test_mean[values0-2]"]["message"] == "assert 3 == 2"
+    # Test cases that were not collected are reported as classname::name
+    assert results["tests.test_calc::test_broken_fixture"]["outcome"] == "error"
+    assert results["tests/test_slow.py::test_sleep[0.8]"]["outcome"] == "skipped"
+    assert results["tests/test_slow.py::test_sleep[0.8]"]["duration"] == 0.0
+    assert results["other::test_unknown"]["duration"] == 1.5
+
+
+def test_parse_junit_real_report(tmp_path, collected):
+    report = tmp_path / "junit.xml"
+    result = run_pytest("-q", f"--junitxml={report}", *[test for test in collected if "test_calc" in test])
+    assert result.returncode == 0, result.stdout
+
+    results = parse_junit(str(report), collected)
+
+    assert sorted(result["test_id"] for result in results) == sorted(test for test in collected if "test_calc" in test)
+    assert {result["outcome"] for result in results} == {"passed"}
+
+
+def test_balance_shards_longest_first():
+    durations = {"a": 5.0, "b": 4.0, "c": 3.0, "d": 3.0, "e": 2.0, "f": 1.0}
+
+    shards = balance_shards(list(durations), durations, 2)
+
+    assert [load for load, _ in shards] == [9.0, 9.0]
+    assert sorted(test for _, tests in shards for test in tests) == sorted(durations)
+    assert shards[0][1][0] == "a" and shards[1][1][0] == "b"
+
+
+def test_balance_shards_uses_median_for_tests_without_history():
+    durations = {"a": 6.0, "b": 2.0, "c": 4.0}
+
+    shards = balance_shards(["a", "b", "c", "new1", "new2"], durations, 2)
+
+    # new1 and new2 are assumed to take the median, 4s, for 20s in total: [a, new2] and [c, new1, b]
+    assert [load for load, _ in shards] == [10.0, 10.0]
+    assert [sorted(tests) for _, tests in shards] == [["a", "new2"], ["b", "c", "new1"]]
+
+
+def test_balance_shards_without_any_history_splits_by_count():
+    tests = [f"t{index}" for index in range(10)]
+
+    shards = balance_shards(tests, {}, 4)
+
+    assert sorted(len(assigned) for _, assigned in shards) == [2, 2, 3, 3]
+
+
+def test_balance_shards_never_returns_empty_shards():
+    assert len(balance_shards(["a", "b"], {}, 4)) == 2
+    assert balance_shards([], {}, 4) == []
+
+
+def sample_history(tmp_path, collected):
+    # A JUnit report of a serial run of the sample project where every sleep took exactly its parameter
+    cases = []
+    for test in collected:
+        classname, name = junit_key(test)
+        seconds = name[len("test_sleep["):].split("_")[0].rstrip("]") if name.startswith("test_sleep[") else "0.0"
+        cases.append(f'<testcase classname="{classname}" name="{name}" time="{seconds}" />')
+    report = tmp_path / "serial.xml"
+    report.write_text(f'<testsuites><testsuite name="pytest">{"".join(cases)}</testsuite></testsuites>')
+    return {result["test_id"]: result["duration"] for result in parse_junit(str(report), collected)}
+
+
+def test_planned_shards_of_sample_project(tmp_path, collected):
+    # Balanced from the history of a serial run, like the tester does
+    history = sample_history(tmp_path, collected)
+    assert sum(history.values()) == pytest.approx(3.2)
+
+    shards = balance_shards(collected, history, 4)
+
+    # 3.2s of sleeps over 4 shards, and no shard can be shorter than the longest test: 0.8s each
+    assert [load for load, _ in shards] == pytest.approx([0.8, 0.8, 0.8, 0.8])
+    slow = [[test[len("tests/test_slow.py::"):] for test in tests if "test_slow" in test] for _, tests in shards]
+    assert slow == [
+        ["test_sleep[0.8]"],
+        ["test_sleep[0.6]", "test_sleep[0.2_1]"],
+        ["test_sleep[0.5]", "test_sleep[0.2_0]", "test_sleep[0.1_0]"],
+        ["test_sleep[0.4]", "test_sleep[0.3]", "test_sleep[0.1_1]"],
+    ]
+    assert sorted(test for _, tests in shards for test in tests) == sorted(collected)